@@ -1,6 +1,12 @@
 """Plex ctions for use in token specifications."""
 
 class Action(object):
+    # True if the action only affects the tokens produced, so that they
+    # can be replayed from a Caches.TokenCache instead
+    cacheable = True
+    # True if Lexicon.count_tokens() must still perform the action
+    counting = False
+
     def same_as(self, other):
         return self is other
 
@@ -23,9 +29,12 @@ class Return(Action):
 
 
 class Call(Action):
-    """Internal Plex action which causes a function to be called."""
+    """Internal Plex action which causes a function to be called. The
+    tokens are only cached if the function is marked with pure()."""
     def __init__(self, function):
         self.function = function
+        self.cacheable = getattr(function, 'plex_pure', False)
+        self.counting = getattr(function, 'plex_side_effect', False)
 
     def perform(self, token_stream, text):
         return self.function(token_stream, text)
@@ -41,6 +50,8 @@ class Begin(Action):
     """Begin(state_name) is a Plex action which causes the Scanner to enter the
     state |state_name|. See the docstring of Plex.Lexicon for more information.
     """
+    counting = True
+
     def __init__(self, state_name):
         self.state_name = state_name
 
@@ -54,6 +65,44 @@ class Begin(Action):
         return isinstance(other, Begin) and self.state_name == other.state_name
 
 
+class Count(Action):
+    """Internal Plex action which stands for the action |action| of
+    token number |token_number| in Lexicon.count_tokens(). The action is
+    kept as |action| only if it is still to be performed."""
+
+    def __init__(self, token_number, action):
+        self.token_number = token_number
+        if action.counting:
+            self.action = action
+        else:
+            self.action = None
+
+    def perform(self, token_stream, text):
+        if self.action is not None:
+            return self.action.perform(token_stream, text)
+
+    def __repr__(self):
+        return "Count(%d)" % self.token_number
+
+
+class SideEffect(Action):
+    """Internal Plex action which stands for the action |action| of a
+    token left out of a projection of a Lexicon (see Lexicon.project())
+    which must still be performed, as it is marked with side_effect().
+    The value it returns is discarded."""
+    counting = True
+
+    def __init__(self, action):
+        self.action = action
+        self.cacheable = action.cacheable
+
+    def perform(self, token_stream, text):
+        self.action.perform(token_stream, text)
+
+    def __repr__(self):
+        return "SideEffect(%s)" % repr(self.action)
+
+
 class Ignore(Action):
     """IGNORE is a Plex action which causes its associated token
     to be ignored. See the docstring of Plex.Lexicon  for more
@@ -83,4 +132,33 @@ class Text(Action):
 TEXT = Text()
 TEXT.__doc__ = Text.__doc__
 
+class Discard(Ignore):
+    """DISCARD is the action given to the tokens left out of a projection
+    of a Lexicon (see Lexicon.project()). It ignores the token, like
+    IGNORE, but the Scanner does not even take the token's text.
+    """
+
+    def __repr__(self):
+        return "DISCARD"
+
+DISCARD = Discard()
+DISCARD.__doc__ = Discard.__doc__
+
+
+def pure(function):
+    """Mark |function|, used as the action of a token, as having no
+    effects outside the Scanner and always giving the same tokens for
+    the same input, so that a Caches.TokenCache can replay the tokens
+    of a scan using it rather than scanning again.
+    """
+    function.plex_pure = True
+    return function
+
 
+def side_effect(function):
+    """Mark |function|, used as the action of a token, as doing
+    something which must still be done when Lexicon.count_tokens()
+    counts the tokens instead of producing them.
+    """
+    function.plex_side_effect = True
+    return function
@@ -0,0 +1,56 @@
+"""Plex scanners driven by an asyncore event loop.
+
+An AsyncScanner is an asyncore dispatcher for a socket which gives the
+data received to a Scanner using its feed() method. The event loop only
+waits when the data received so far is used up, and every token that
+data completes is handed on in one list, so a single thread can scan
+the input of many connections without blocking on any of them.
+"""
+
+import asyncore
+
+from Scanners import Scanner
+
+
+class AsyncScanner(asyncore.dispatcher):
+    """
+    AsyncScanner(lexicon, sock, map = None, scanner_class = Scanner)
+
+        An asyncore dispatcher which scans the data received on the
+        socket |sock| using a Scanner of class |scanner_class|, which
+        must take (lexicon, stream) arguments. |map| is the asyncore
+        socket map to use.
+
+    Override handle_tokens() to do something with the tokens. The
+    |scanner| attribute is the Scanner, whose position(), begin() and
+    so on can be used as usual while handling its tokens.
+    """
+
+    read_size = 0x10000   # bytes to recv() at a time
+    scanner = None        # the Scanner
+
+    def __init__(self, lexicon, sock, map=None, scanner_class=Scanner):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.scanner = scanner_class(lexicon, None)
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        data = self.recv(self.read_size)
+        if data:
+            tokens = self.scanner.feed(data)
+            if tokens:
+                self.handle_tokens(tokens)
+
+    def handle_close(self):
+        self.close()
+        if not self.scanner.closed:
+            self.handle_tokens(self.scanner.close())
+
+    def handle_tokens(self, tokens):
+        """
+        Called with a list of the (value, text) tokens completed by the
+        data received. The list after the connection closes ends with
+        (None, '').
+        """
@@ -0,0 +1,294 @@
+"""Plex token caches.
+
+A TokenCache keeps the tokens of each input it has scanned in a
+directory, keyed on a hash of the input and the Lexicon's fingerprint(),
+so that scanning an unchanged input again replays the tokens without
+running the DFA or the actions. The tokens are stored in columns of
+machine integers -- value ids, offsets, text lengths, lines and
+columns -- with tables of the distinct values and of any texts which
+are not simply a slice of the input.
+
+A LineCache is an in-memory LRU cache of the tokens of single lines,
+for a Scanner's |line_cache| attribute, which pays off on input such as
+logs where the same lines turn up again and again.
+
+Scans whose Lexicon has actions calling functions not marked with
+Actions.pure() are not cached, since replaying them would skip the
+calls.
+"""
+
+import array
+import hashlib
+import os
+import cPickle
+from collections import OrderedDict
+
+from Scanners import Scanner
+
+FORMAT_VERSION = 1
+
+# Name and array typecode of each column of a cache file
+columns = (
+    ('values', 'l'),     # index in the value table
+    ('offsets', 'l'),    # start_pos of the token
+    ('lengths', 'l'),    # length of the text, or -1 - index in the text table
+    ('lines', 'l'),      # start_line
+    ('cols', 'l'),       # start_col
+)
+
+
+class TokenCache:
+    """
+    TokenCache(directory)
+
+        A cache of the tokens of scans, kept in files in |directory|,
+        which is created if need be.
+
+    Attributes:
+
+        hits        number of scans replayed from the cache
+        misses      number of scans recorded into the cache
+        bypassed    number of scans which could not be cached
+    """
+
+    directory = None
+    hits = 0
+    misses = 0
+    bypassed = 0
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def scan(self, lexicon, stream, name='', scanner_class=Scanner):
+        """
+        Return an object with the read() and position() methods of a
+        Scanner which gives the tokens of |stream|, a file object or
+        string, as a Scanner of class |scanner_class| for |lexicon|
+        would. The whole of |stream| is read at once to find the key.
+        """
+        if isinstance(stream, basestring):
+            content = stream
+        else:
+            content = stream.read()
+        if not isinstance(content, str) or lexicon.uncacheable_tokens():
+            self.bypassed = self.bypassed + 1
+            return scanner_class(lexicon, content, name)
+        file_name = self.file_name(lexicon, content, scanner_class)
+        try:
+            f = open(file_name, 'rb')
+        except IOError:
+            self.misses = self.misses + 1
+            return RecordingScanner(
+                scanner_class(lexicon, content, name), content, file_name)
+        try:
+            tables = cPickle.load(f)
+        finally:
+            f.close()
+        self.hits = self.hits + 1
+        return CachedScanner(tables, content, name)
+
+    def file_name(self, lexicon, content, scanner_class):
+        """Return the name of the cache file for scanning |content|."""
+        key = hashlib.sha1()
+        key.update(lexicon.fingerprint())
+        key.update("%s.%s/%d" % (scanner_class.__module__,
+                                 scanner_class.__name__, FORMAT_VERSION))
+        return os.path.join(
+            self.directory,
+            "%s-%s.plex" % (hashlib.sha1(content).hexdigest(),
+                            key.hexdigest()[:16]))
+
+
+class RecordingScanner:
+    """
+    RecordingScanner(scanner, content, file_name)
+
+        Passes on the tokens read from |scanner|, which is scanning the
+        string |content|, and writes them to the cache file |file_name|
+        once the end of the input is read.
+    """
+
+    scanner = None    # the Scanner
+    content = None
+    file_name = None
+    values = None     # {(type, value): index in value table}
+    value_table = None
+    texts = None      # [text which is not a slice of the content]
+    columns = None    # {column name: array}
+
+    def __init__(self, scanner, content, file_name):
+        self.scanner = scanner
+        self.content = content
+        self.file_name = file_name
+        self.values = {}
+        self.value_table = []
+        self.texts = []
+        self.columns = {}
+        for column, typecode in columns:
+            self.columns[column] = array.array(typecode)
+
+    def read(self):
+        scanner = self.scanner
+        value, text = scanner.read()
+        if value is None:
+            if self.columns is not None:
+                self.write(scanner.start_line, scanner.start_col)
+        elif self.columns is not None:
+            self.record(value, text)
+        return value, text
+
+    def position(self):
+        return self.scanner.position()
+
+    def record(self, value, text):
+        scanner = self.scanner
+        try:
+            key = (type(value), value)
+            index = self.values.get(key)
+        except TypeError:
+            # An unhashable value: give up recording
+            self.columns = None
+            return
+        if index is None:
+            index = len(self.value_table)
+            self.values[key] = index
+            self.value_table.append(value)
+        start = scanner.start_pos
+        length = len(text)
+        if self.content[start:start + length] != text:
+            length = -1 - len(self.texts)
+            self.texts.append(text)
+        columns = self.columns
+        columns['values'].append(index)
+        columns['offsets'].append(start)
+        columns['lengths'].append(length)
+        columns['lines'].append(scanner.start_line)
+        columns['cols'].append(scanner.start_col)
+
+    def write(self, end_line, end_col):
+        tables = {
+            'version': FORMAT_VERSION,
+            'end': (end_line, end_col),
+            'value_table': self.value_table,
+            'text_table': self.texts,
+        }
+        for column, typecode in columns:
+            tables[column] = (typecode, self.columns[column].tostring())
+        self.columns = None
+        # Write a temporary file and rename it, so that readers never see
+        # a partly written cache file
+        temp_name = "%s.%d.tmp" % (self.file_name, os.getpid())
+        f = open(temp_name, 'wb')
+        try:
+            cPickle.dump(tables, f, 2)
+        finally:
+            f.close()
+        os.rename(temp_name, self.file_name)
+
+
+class CachedScanner:
+    """
+    CachedScanner(tables, content, name)
+
+        Replays the tokens of a scan of the string |content| from the
+        |tables| read from a cache file.
+    """
+
+    name = None
+    content = None
+    value_table = None
+    texts = None
+    end = None         # (line, col) of the end of the input
+    columns = None     # {column name: array}
+    count = 0          # number of tokens
+    index = -1         # index of the last token read
+    start_line = 0
+    start_col = 0
+
+    def __init__(self, tables, content, name):
+        self.content = content
+        self.name = name
+        self.value_table = tables['value_table']
+        self.texts = tables['text_table']
+        self.end = tables['end']
+        self.columns = {}
+        for column, typecode in columns:
+            data = array.array(tables[column][0])
+            data.fromstring(tables[column][1])
+            self.columns[column] = data
+        self.count = len(self.columns['values'])
+
+    def read(self):
+        index = self.index + 1
+        if index >= self.count:
+            self.index = self.count
+            self.start_line, self.start_col = self.end
+            return None, ''
+        self.index = index
+        columns = self.columns
+        length = columns['lengths'][index]
+        if length < 0:
+            text = self.texts[-1 - length]
+        else:
+            start = columns['offsets'][index]
+            text = self.content[start:start + length]
+        self.start_line = columns['lines'][index]
+        self.start_col = columns['cols'][index]
+        return self.value_table[columns['values'][index]], text
+
+    def position(self):
+        return (self.name, self.start_line, self.start_col)
+
+
+class LineCache:
+    """
+    LineCache(size = 10000)
+
+        A cache of the tokens of up to |size| lines, keyed on the line
+        and the name of the state it is scanned in, from which the least
+        recently used line is dropped when it is full. See the line
+        cache mode of Scanners.Scanner.
+
+    Attributes:
+
+        hits        number of lines found in the cache
+        misses      number of lines scanned and added to the cache
+        bypassed    number of lines which could not be cached
+    """
+
+    size = 0
+    entries = None      # OrderedDict {(state_name, line): (tokens, state_name)}
+    hits = 0
+    misses = 0
+    bypassed = 0
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """Return the entry for |key|, or None."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses = self.misses + 1
+        else:
+            self.hits = self.hits + 1
+            # Now the most recently used
+            self.entries[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        entries = self.entries
+        entries[key] = entry
+        if len(entries) > self.size:
+            entries.popitem(last=False)
+
+    def hit_rate(self):
+        """Return the fraction of the lines read which were found in the
+        cache, counting lines which could not be cached as misses."""
+        lines = self.hits + self.misses + self.bypassed
+        if not lines:
+            return 0.0
+        return float(self.hits) / lines
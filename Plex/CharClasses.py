@@ -0,0 +1,225 @@
+"""Plex DFAs over character equivalence classes.
+
+Two characters are equivalent if every state of a DFA has the same
+transition on both of them. A ClassMachine numbers the equivalence
+classes of the byte characters, so that a block of input can be turned
+into class ids with a single str.translate() call, and gives each DFA
+state a row: a list indexed by class id whose entries are the rows of
+the target states. Characters which only reach a state through the
+'else' transition simply belong to the classes of their targets, and
+characters which NoCase() treats alike end up in the same class.
+"""
+
+NUM_CHARS = 256
+
+
+class ClassMachine:
+    """
+    ClassMachine(fast_machine) is the FastMachine |fast_machine| in
+    class-indexed form.
+
+    Attributes:
+
+        num_classes     number of classes of byte characters
+        translation     256 character string for str.translate(),
+                        mapping each character to chr(class id)
+        newline_class   class id of newline, which is in a class of its
+                        own because the Scanner precedes it with EOL
+        bol_class, eol_class, eof_class, end_class
+                        class ids of the special symbols BOL, EOL and
+                        EOF and of end of input (the empty string)
+        action_index    index of the action in each row
+        classes         {char: class id} including the special symbols
+        rows            {id(dfa_state): row}
+    """
+
+    num_classes = 0
+    translation = None
+    newline_class = 0
+    bol_class = eol_class = eof_class = end_class = 0
+    action_index = 0
+    classes = None
+    rows = None
+
+    def __init__(self, fast_machine):
+        states = fast_machine.states
+        signatures = {}
+        char_class = []
+        representatives = []
+        for code in xrange(NUM_CHARS):
+            c = chr(code)
+            signature = tuple([id(target(state, c)) for state in states])
+            if c == '\n':
+                signature = ('\n',) + signature
+            class_id = signatures.get(signature)
+            if class_id is None:
+                class_id = len(representatives)
+                signatures[signature] = class_id
+                representatives.append(c)
+            char_class.append(class_id)
+        n = len(representatives)
+        self.num_classes = n
+        self.translation = ''.join(map(chr, char_class))
+        self.newline_class = char_class[ord('\n')]
+        self.bol_class = n
+        self.eol_class = n + 1
+        self.eof_class = n + 2
+        self.end_class = n + 3
+        self.action_index = n + 4
+        classes = {'bol': n, 'eol': n + 1, 'eof': n + 2, '': n + 3}
+        for code in xrange(NUM_CHARS):
+            classes[chr(code)] = char_class[code]
+        self.classes = classes
+        rows = {}
+        for state in states:
+            rows[id(state)] = [None] * (n + 5)
+        for state in states:
+            row = rows[id(state)]
+            for class_id in xrange(n):
+                new_state = target(state, representatives[class_id])
+                if new_state:
+                    row[class_id] = rows[id(new_state)]
+            for class_id, event in ((n, 'bol'), (n + 1, 'eol'), (n + 2, 'eof')):
+                new_state = state.get(event)
+                if new_state:
+                    row[class_id] = rows[id(new_state)]
+            row[n + 4] = state['action']
+        self.rows = rows
+
+
+def target(state, c):
+    """Return the state reached from FastMachine state |state| on the
+    character |c|, or None, as the Scanner would find it."""
+    new_state = state.get(c, -1)
+    if new_state == -1:
+        new_state = state.get('else')
+    return new_state
+
+
+class ArrayMachine:
+    """
+    ArrayMachine(class_machine, fast_machine, numpy) is the ClassMachine
+    |class_machine| of the Lexicon DFA |fast_machine| in the form of
+    arrays of the |numpy| module, for running the DFA on many strings
+    in step.
+
+    Attributes:
+
+        table           [state index, class id] --> state index, where
+                        state index 0 is a dead state
+        tokens          [state index] --> number of the token whose
+                        action the state has, or 0
+        char_classes    [character code] --> class id
+        initial_states  {state_name: state index}
+    """
+
+    class_machine = None
+    table = None
+    tokens = None
+    char_classes = None
+    initial_states = None
+
+    def __init__(self, class_machine, fast_machine, numpy):
+        self.class_machine = class_machine
+        states = fast_machine.states
+        rows = class_machine.rows
+        index = {}
+        for i in xrange(len(states)):
+            index[id(rows[id(states[i])])] = i + 1
+        num_events = class_machine.action_index
+        table = numpy.zeros((len(states) + 1, num_events), numpy.intp)
+        tokens = numpy.zeros(len(states) + 1, numpy.int32)
+        priorities = fast_machine.priorities
+        for i in xrange(len(states)):
+            row = rows[id(states[i])]
+            for event in xrange(num_events):
+                if row[event]:
+                    table[i + 1, event] = index[id(row[event])]
+            # Lexicon gives each token the priority -token_number
+            tokens[i + 1] = -priorities.get(states[i]['number'], 0)
+        self.table = table
+        self.tokens = tokens
+        self.char_classes = numpy.fromstring(
+            class_machine.translation, numpy.uint8).astype(numpy.intp)
+        self.initial_states = {}
+        for name, state in fast_machine.initial_states.items():
+            self.initial_states[name] = index[id(rows[id(state)])]
+
+    def match_whole(self, numpy, strings, state_name):
+        """Return an array of the numbers of the tokens matching the whole
+        of each byte string in |strings| in the named state, or 0. A token
+        matches the whole string if a Scanner reading the string alone
+        would return it as its first token, with all the text."""
+        class_machine = self.class_machine
+        n = len(strings)
+        lengths = numpy.array(map(len, strings), numpy.intp)
+        width = n and int(lengths.max())
+        codes = numpy.array(strings, 'S%d' % max(width, 1)).view(
+            numpy.uint8).reshape(n, max(width, 1))
+        # The Scanner goes on to BOL after a final newline, but the token
+        # may end before it
+        ends_with_newline = (lengths > 0) & (
+            codes[numpy.arange(n), numpy.maximum(lengths - 1, 0)] == 10)
+        codes = codes[:, :width]
+        events = self.char_classes[codes]
+        newline_rows = numpy.nonzero((codes == 10).any(1))[0]
+        if len(newline_rows):
+            events, width = self.expand_newlines(
+                numpy, events, lengths, newline_rows)
+        # Longest first, so that the strings still being read at each
+        # step are a prefix of the rows
+        order = numpy.argsort(-lengths, kind = 'mergesort')
+        events = events[order]
+        counts = numpy.searchsorted(-lengths[order], -numpy.arange(width))
+        table = self.table
+        tokens = self.tokens
+        initial_state = self.initial_states[state_name]
+        state = numpy.empty(n, numpy.intp)
+        state.fill(table[initial_state, class_machine.bol_class])
+        for j in xrange(width):
+            k = counts[j]
+            state[:k] = table[state[:k], events[:k, j]]
+        state[order] = state.copy()
+        found = tokens[state]
+        # An empty string can be matched before the initial BOL
+        found[(lengths == 0) & (found == 0)] = tokens[initial_state]
+        # Like the Scanner, take the last accepting state reached on the
+        # symbols which follow the text, allowing for tokens which end
+        # with Bol, Eol or Eof
+        state = numpy.where(ends_with_newline,
+                            table[state, class_machine.bol_class], state)
+        found = numpy.where(tokens[state] != 0, tokens[state], found)
+        for class_id in (class_machine.eol_class, class_machine.eof_class):
+            state = table[state, class_id]
+            found = numpy.where(tokens[state] != 0, tokens[state], found)
+        return found
+
+    def expand_newlines(self, numpy, events, lengths, newline_rows):
+        """The Scanner presents each newline as EOL, newline, BOL, so
+        rewrite the events of the rows with newlines in them to match,
+        updating |lengths|. The BOL after a final newline is left to
+        match_whole(). Returns (events, width)."""
+        class_machine = self.class_machine
+        newline_class = class_machine.newline_class
+        newline_events = (class_machine.eol_class, newline_class,
+                          class_machine.bol_class)
+        expanded = []
+        for i in newline_rows:
+            row = []
+            for class_id in events[i, :lengths[i]]:
+                if class_id == newline_class:
+                    row.extend(newline_events)
+                else:
+                    row.append(class_id)
+            if events[i, lengths[i] - 1] == newline_class:
+                del row[-1]
+            expanded.append(row)
+        width = max(events.shape[1], max(map(len, expanded)))
+        if width > events.shape[1]:
+            wider = numpy.zeros((events.shape[0], width), events.dtype)
+            wider[:, :events.shape[1]] = events
+            events = wider
+        for i, row in zip(newline_rows, expanded):
+            events[i, :len(row)] = row
+            lengths[i] = len(row)
+        return events, width
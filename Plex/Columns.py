@@ -0,0 +1,85 @@
+"""Plex columnar token output.
+
+Lexicon.scan_columns() writes the tokens it recognises straight into a
+TokenColumns: one growable typed array per field, so that millions of
+tokens cost no Python objects each, and can be handed to NumPy (or
+anything else which takes the buffer of an array) without copying.
+The text of a token is not kept; its start and end offsets give it as
+a slice of the input.
+"""
+
+import array
+
+import Actions
+
+# Name, array typecode and NumPy type of each column
+columns = (
+    ('rule', 'i', 'int32'),     # token number
+    ('start', 'l', 'int64'),    # offset of the start of the token
+    ('end', 'l', 'int64'),      # offset just after the end of the token
+    ('line', 'i', 'int32'),     # line number, 1-based
+    ('col', 'i', 'int32'),      # position in the line, 0-based
+)
+
+
+class TokenColumns:
+    """
+    TokenColumns(value_table)
+
+        The tokens of a scan, as the arrays |rule|, |start|, |end|,
+        |line| and |col|, with the Lexicon's |value_table| (see
+        Lexicon.value_table()) giving the value of each rule.
+    """
+
+    value_table = None
+    rule = start = end = line = col = None   # array.array
+
+    def __init__(self, value_table):
+        self.value_table = value_table
+        for name, typecode, _ in columns:
+            setattr(self, name, array.array(typecode))
+
+    def __len__(self):
+        return len(self.rule)
+
+    def tokens(self, source):
+        """Return a list of the (value, text) tokens, given the string
+        |source| which was scanned. The value of a token whose action
+        is TEXT is its text."""
+        value_table = self.value_table
+        rules = self.rule
+        starts = self.start
+        ends = self.end
+        result = []
+        for i in xrange(len(rules)):
+            text = source[starts[i]:ends[i]]
+            value = value_table[rules[i]]
+            if value is Actions.TEXT:
+                value = text
+            result.append((value, text))
+        return result
+
+    def arrays(self):
+        """Return a dictionary of the NumPy arrays of the columns, which
+        share the memory of the arrays they were made from."""
+        import numpy
+        result = {}
+        for name, typecode, numpy_type in columns:
+            data = getattr(self, name)
+            if data.itemsize != numpy.dtype(numpy_type).itemsize:
+                # A C long of 32 bits
+                result[name] = numpy.array(data, numpy_type)
+            else:
+                result[name] = numpy.frombuffer(data, numpy_type)
+        return result
+
+    def structured_array(self):
+        """Return the columns as a NumPy structured array, with a field
+        for each column."""
+        import numpy
+        dtype = numpy.dtype([(name, numpy_type)
+                             for name, _, numpy_type in columns])
+        result = numpy.empty(len(self), dtype)
+        for name, data in self.arrays().items():
+            result[name] = data
+        return result
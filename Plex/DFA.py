@@ -6,13 +6,25 @@
 #
 #=======================================================================
 
+import Errors
 import Machines
+import Reports
 from Transitions import TransitionMap
 
-def nfa_to_dfa(old_machine, debug = None):
+def nfa_to_dfa(old_machine, debug = None, report = None, limits = None,
+               processes = None, state_map = None):
     """
     Given a nondeterministic Machine, return a new equivalent
-    Machine which is deterministic.
+    Machine which is deterministic. If |report| is a BuildReport,
+    the time spent in each phase and the state sets behind the
+    new states are recorded in it. If |limits| is a Limits instance,
+    construction of any initial state which exceeds them is abandoned,
+    either raising Errors.StateExplosion or, if limits.fallback is
+    true, leaving that initial state to be built lazily while scanning.
+    If |processes| is greater than 1, the initial states are worked on
+    in parallel by a pool of that many processes. If |state_map| is
+    a StateMap, the new machine is built in it and it is kept up to
+    date for use with update_dfa().
     """
     # We build a new machine whose states correspond to sets of states
     # in the old machine. Initially we add a new state corresponding to
@@ -23,29 +35,313 @@ def nfa_to_dfa(old_machine, debug = None):
     # on that character from any of the old states. As new combinations of
     # old states are created, new states are added as needed until closure
     # is reached.
-    new_machine = Machines.FastMachine()
-    state_map = StateMap(new_machine)
-    # Seed the process using the initial states of the old machine.
-    # Make the corresponding new states into initial states of the new
-    # machine with the same names.
-    for (key, old_state) in old_machine.initial_states.items():
-        new_state = state_map.old_to_new(epsilon_closure(old_state))
+    if processes > 1 and len(old_machine.initial_states) > 1 \
+            and not debug and state_map is None:
+        return parallel_nfa_to_dfa(old_machine, processes, report, limits)
+    if report:
+        from Timing import time
+        time1 = time()
+        # Epsilon closures are cached on the old states, so working them
+        # all out first costs nothing extra and keeps the phases separate.
+        for old_state in old_machine.states:
+            epsilon_closure(old_state)
+        time2 = time()
+        # The transitions are only written into the tables afterwards
+        pending = []
+    else:
+        pending = None
+    if state_map is None:
+        state_map = StateMap(Machines.FastMachine())
+    new_machine = state_map.new_machine
+    lazy_state_map = None
+    # Start conditions never share states, so the states of the new machine
+    # are worked out one initial state at a time. The new state corresponding
+    # to each initial old state becomes an initial state of the new machine
+    # with the same name.
+    for (key, initial_state) in old_machine.initial_states.items():
+        first_state = len(new_machine.states)
+        if pending is not None:
+            first_pending = len(pending)
+        if limits:
+            limits.start()
+        new_state = state_map.old_to_new(epsilon_closure(initial_state))
         new_machine.make_initial_state(key, new_state)
-    # Tricky bit here: we add things to the end of this list while we're
-    # iterating over it. The iteration stops when closure is achieved.
-    for new_state in new_machine.states:
+        reason = determinize(state_map, first_state, pending, limits)
+        if reason:
+            state_sets = state_map.state_sets(first_state)
+            if not limits.fallback:
+                raise Errors.StateExplosion(
+                    key, reason, limits.offenders(state_sets))
+            # Any transitions already written belong to the states
+            # discarded
+            state_map.discard(first_state)
+            if pending is not None:
+                del pending[first_pending:]
+            if lazy_state_map is None:
+                lazy_state_map = LazyStateMap(new_machine, old_machine)
+            new_machine.make_initial_state(
+                key, lazy_state_map.old_to_new(epsilon_closure(initial_state)))
+            limits.fell_back.append(key)
+    if report:
+        time3 = time()
+        for new_state, event, target in pending:
+            new_machine.add_transitions(new_state, event, target)
+        time4 = time()
+        report.add_time('closure', time2 - time1)
+        report.add_time('subset', time3 - time2)
+        report.add_time('tables', time4 - time3)
+        report.dfa_ranges = report.dfa_ranges + len(pending)
+        report.analyse_state_sets(state_map.state_sets())
+    if debug:
+        debug.write("\n===== State Mapping =====\n")
+        state_map.dump(debug)
+    return new_machine
+
+def determinize(state_map, first_state, pending, limits = None):
+    """
+    Find the transitions of the new states of |state_map| from index
+    |first_state| of the new machine's states list onwards, adding new
+    states as they are reached, until closure is achieved. The transitions
+    are appended to |pending| as (new_state, event, target_new_state)
+    tuples, to be written into the tables afterwards, or written straight
+    away if |pending| is None. Returns None, or a description of the
+    limit exceeded if |limits| stopped the work.
+    """
+    new_machine = state_map.new_machine
+    states = new_machine.states
+    # Tricky bit here: we add things to the end of the states list while
+    # we're iterating over it. The iteration stops when closure is achieved.
+    i = first_state
+    while i < len(states):
+        if limits:
+            reason = limits.exceeded(len(states) - first_state)
+            if reason:
+                return reason
+        new_state = states[i]
+        i = i + 1
         transitions = TransitionMap()
         for old_state in state_map.new_to_old(new_state).keys():
             for event, old_target_states in old_state.transitions.items():
                 if event and old_target_states:
                     transitions.add_set(event, set_epsilon_closure(old_target_states))
         for event, old_states in transitions.items():
-            new_machine.add_transitions(new_state, event, state_map.old_to_new(old_states))
-    if debug:
-        debug.write("\n===== State Mapping =====\n")
-        state_map.dump(debug)
+            target = state_map.old_to_new(old_states)
+            if pending is None:
+                new_machine.add_transitions(new_state, event, target)
+            else:
+                pending.append((new_state, event, target))
+    return None
+
+def update_dfa(state_map, old_machine, key, limits = None):
+    """
+    Rebuild the part of the deterministic machine of |state_map| which
+    belongs to the initial state named |key| of |old_machine|, after
+    tokens have been added to or removed from that initial state. New
+    states whose set of old states is unchanged are kept along with their
+    transitions, so the work done depends on the number of new states
+    affected by the change rather than on the size of the machine.
+    If |limits| are exceeded, Errors.StateExplosion is raised and the new
+    machine is left as it was.
+    """
+    new_machine = state_map.new_machine
+    states = new_machine.states
+    old_initial = new_machine.initial_states.get(key)
+    initial_state = old_machine.initial_states[key]
+    # Only the closure of the initial state sees the tokens coming and going
+    initial_state.epsilon_closure = None
+    if limits:
+        limits.start()
+    first_state = len(states)
+    new_initial = state_map.old_to_new(epsilon_closure(initial_state))
+    pending = []
+    reason = determinize(state_map, first_state, pending, limits)
+    if reason:
+        offenders = limits.offenders(
+            map(state_map.new_to_old, states[first_state:]))
+        state_map.discard(first_state)
+        raise Errors.StateExplosion(key, reason, offenders)
+    for new_state, event, target in pending:
+        new_machine.add_transitions(new_state, event, target)
+    new_machine.make_initial_state(key, new_initial)
+    if old_initial is not None and old_initial is not new_initial:
+        unreachable = reachable_states(old_initial)
+        for state_id in reachable_states(new_initial):
+            unreachable.pop(state_id, None)
+        state_map.forget(unreachable)
+
+def reachable_states(new_state):
+    """Return {id(state): state} for the states of a FastMachine reachable
+    from |new_state|, including itself."""
+    result = {id(new_state): new_state}
+    todo = [new_state]
+    while todo:
+        state = todo.pop()
+        for target in state.values():
+            if isinstance(target, dict) and id(target) not in result:
+                result[id(target)] = target
+                todo.append(target)
+    return result
+
+def parallel_nfa_to_dfa(old_machine, processes, report = None, limits = None):
+    """
+    Version of nfa_to_dfa() which hands the part of |old_machine|
+    reachable from each initial state to a pool of |processes| worker
+    processes, and merges the results into one new machine, renumbering
+    the states. Limits apply to each initial state separately.
+    """
+    import multiprocessing
+    from Timing import time
+    state_tokens = limits and limits.state_tokens or report and report.state_tokens
+    jobs = []
+    for key, initial_state in old_machine.initial_states.items():
+        encoded = encode_nfa(initial_state, state_tokens)
+        jobs.append((len(encoded), key, initial_state, encoded))
+    # Biggest first, to keep the pool busy
+    jobs.sort(lambda a, b: cmp(b[0], a[0]))
+    if limits:
+        limit_args = (limits.max_states, limits.max_time)
+    else:
+        limit_args = (None, None)
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(
+            determinize_encoded,
+            [(encoded,) + limit_args for _, _, _, encoded in jobs],
+            1)
+    finally:
+        pool.close()
+        pool.join()
+    time1 = time()
+    # Actions can't be sent to other processes, so the workers give
+    # priorities, which are mapped back to the actions of the old states.
+    actions = {}
+    for old_state in old_machine.states:
+        if old_state.action is not None:
+            actions[old_state.action_priority] = old_state.action
+    new_machine = Machines.FastMachine()
+    lazy_state_map = None
+    num_ranges = 0
+    for (_, key, initial_state, _), result in zip(jobs, results):
+        if result[0] == 'limit':
+            _, reason, contributions, cpu_time = result
+            if not limits.fallback:
+                offenders = limits.rules and \
+                    Reports.top_rules(contributions, limits.rules, 5) or []
+                raise Errors.StateExplosion(key, reason, offenders)
+            if lazy_state_map is None:
+                lazy_state_map = LazyStateMap(new_machine, old_machine)
+            new_machine.make_initial_state(
+                key, lazy_state_map.old_to_new(epsilon_closure(initial_state)))
+            limits.fell_back.append(key)
+        else:
+            _, priorities, transitions, contributions, cpu_time = result
+            new_states = []
+            for priority in priorities:
+                new_states.append(
+                    new_machine.new_state(actions.get(priority), priority))
+            for i, event, j in transitions:
+                new_machine.add_transitions(new_states[i], event, new_states[j])
+            new_machine.make_initial_state(key, new_states[0])
+            num_ranges = num_ranges + len(transitions)
+        if report:
+            report.add_time('subset', cpu_time)
+            for token_number, count in contributions.items():
+                report.contributions[token_number] = \
+                    report.contributions.get(token_number, 0) + count
+    if report:
+        report.add_time('tables', time() - time1)
+        report.dfa_ranges = report.dfa_ranges + num_ranges
     return new_machine
 
+def encode_nfa(initial_state, state_tokens = None):
+    """
+    Return a picklable description of the part of an NFA reachable from
+    |initial_state|, as a list with an entry for each state, the initial
+    state first. Each entry is a tuple ([(event, [target_index])],
+    priority or None, token_number).
+    """
+    index = {initial_state: 0}
+    states = [initial_state]
+    i = 0
+    while i < len(states):
+        for event, targets in states[i].transitions.items():
+            for target in targets:
+                if target not in index:
+                    index[target] = len(states)
+                    states.append(target)
+        i = i + 1
+    result = []
+    for state in states:
+        transitions = []
+        for event, targets in state.transitions.items():
+            transitions.append((event, [index[target] for target in targets]))
+        if state.action is not None:
+            priority = state.action_priority
+        else:
+            priority = None
+        if state_tokens:
+            token_number = state_tokens[state.number]
+        else:
+            token_number = 0
+        result.append((transitions, priority, token_number))
+    return result
+
+def determinize_encoded(args):
+    """
+    Worker function for parallel_nfa_to_dfa(). |args| is a tuple
+    (encoded_nfa, max_states, max_time) where |encoded_nfa| is as
+    returned by encode_nfa(). Returns either
+
+        ('dfa', priorities, transitions, contributions, cpu_time)
+
+    where |priorities| gives the priority of the action of each new
+    state (the initial state first) and |transitions| is a list of
+    (state_index, event, target_index), or, if a limit was exceeded,
+
+        ('limit', reason, contributions, cpu_time)
+
+    |contributions| is as for Reports.count_contributions().
+    """
+    from Timing import time
+    time1 = time()
+    encoded, max_states, max_time = args
+    old_machine = Machines.Machine()
+    old_states = []
+    state_tokens = [0]
+    for transitions, priority, token_number in encoded:
+        old_states.append(old_machine.new_state())
+        state_tokens.append(token_number)
+    for old_state, (transitions, priority, token_number) in zip(old_states, encoded):
+        for event, targets in transitions:
+            for target in targets:
+                old_state.add_transition(event, old_states[target])
+        if priority is not None:
+            # The priority stands in for the action
+            old_state.set_action(priority, priority)
+    new_machine = Machines.FastMachine()
+    state_map = StateMap(new_machine)
+    state_map.old_to_new(epsilon_closure(old_states[0]))
+    if max_states is not None or max_time is not None:
+        limits = Limits(max_states, max_time)
+        limits.start()
+    else:
+        limits = None
+    pending = []
+    reason = determinize(state_map, 0, pending, limits)
+    contributions = {}
+    Reports.count_contributions(contributions, state_map.state_sets(), state_tokens)
+    if reason:
+        return ('limit', reason, contributions, time() - time1)
+    index = {}
+    priorities = []
+    for new_state in new_machine.states:
+        index[id(new_state)] = len(priorities)
+        priorities.append(new_state['action'])
+    transitions = []
+    for new_state, event, target in pending:
+        transitions.append((index[id(new_state)], event, index[id(target)]))
+    return ('dfa', priorities, transitions, contributions, time() - time1)
+
 def set_epsilon_closure(state_set):
     """
     Given a set of states, return the union of the epsilon
@@ -88,7 +384,7 @@ class StateMap:
     sets of states from the old machine and states of the new machine.
     """
     new_machine     = None # Machine
-    old_to_new_dict = None # {(old_state,...) : new_state}
+    old_to_new_dict = None # {frozenset(old_states) : new_state}
     new_to_old_dict = None # {id(new_state) : old_state_set}
 
     def __init__(self, new_machine):
@@ -107,8 +403,8 @@ class StateMap:
         key = self.make_key(old_state_set)
         new_state = self.old_to_new_dict.get(key, None)
         if not new_state:
-            action = self.highest_priority_action(old_state_set)
-            new_state = self.new_machine.new_state(action)
+            action, priority = self.highest_priority(old_state_set)
+            new_state = self.new_machine.new_state(action, priority)
             self.old_to_new_dict[key] = new_state
             self.new_to_old_dict[id(new_state)] = old_state_set
             #for old_state in old_state_set.keys():
@@ -116,6 +412,11 @@ class StateMap:
         return new_state
 
     def highest_priority_action(self, state_set):
+        return self.highest_priority(state_set)[0]
+
+    def highest_priority(self, state_set):
+        """Return (action, priority) for the highest priority action of
+        the states in |state_set|, or (None, None) if there is none."""
         best_action = None
         best_priority = Machines.LOWEST_PRIORITY
         for state in state_set.keys():
@@ -123,24 +424,173 @@ class StateMap:
             if priority > best_priority:
                 best_action = state.action
                 best_priority = priority
-        return best_action
+        if best_action is None:
+            return (None, None)
+        return (best_action, best_priority)
 
     def new_to_old(self, new_state):
         """Given a new state, return a set of corresponding old states."""
         return self.new_to_old_dict[id(new_state)]
 
+    def discard(self, first_state):
+        """Forget the new states numbered from index |first_state| of the
+        new machine's states list onwards."""
+        states = self.new_machine.states
+        for new_state in states[first_state:]:
+            old_state_set = self.new_to_old_dict.pop(id(new_state))
+            del self.old_to_new_dict[self.make_key(old_state_set)]
+        del states[first_state:]
+        if states:
+            self.new_machine.next_number = states[-1]['number'] + 1
+        else:
+            self.new_machine.next_number = 1
+
+    def forget(self, new_states):
+        """Remove the states in |new_states| ({id(new_state): new_state})
+        from the new machine."""
+        for state_id in new_states:
+            old_state_set = self.new_to_old_dict.pop(state_id, None)
+            if old_state_set is not None:
+                del self.old_to_new_dict[self.make_key(old_state_set)]
+        machine = self.new_machine
+        machine.states = [new_state for new_state in machine.states
+                          if id(new_state) not in new_states]
+
+    def state_sets(self, first_state = 0):
+        """Return the old state sets in the order of the new states,
+        from the new state numbered |first_state| on. Lazily built
+        states, which have no state set here, are left out."""
+        new_to_old = self.new_to_old_dict
+        result = []
+        for new_state in self.new_machine.states[first_state:]:
+            old_state_set = new_to_old.get(id(new_state))
+            if old_state_set is not None:
+                result.append(old_state_set)
+        return result
+
     def make_key(self, state_set):
         """
-        Convert a set of states into a uniquified
-        sorted tuple suitable for use as a dictionary key.
+        Convert a set of states into a frozenset suitable for use
+        as a dictionary key. This is much cheaper than sorting the
+        states when the sets are large.
         """
-        lst = state_set.keys()
-        lst.sort()
-        return tuple(lst)
+        return frozenset(state_set)
 
     def dump(self, file):
         from Transitions import state_set_str
         for new_state in self.new_machine.states:
-            old_state_set = self.new_to_old_dict[id(new_state)]
+            old_state_set = self.new_to_old_dict.get(id(new_state))
+            if old_state_set is None:
+                continue
             file.write("   State %s <-- %s\n" % (
                     new_state['number'], state_set_str(old_state_set)))
+
+
+class LazyStateMap(StateMap):
+    """
+    A StateMap whose new states are LazyState instances, which work out
+    their transitions the first time each input event is looked up.
+    """
+    old_machine = None # Machine, kept alive while its states are in use
+
+    def __init__(self, new_machine, old_machine):
+        StateMap.__init__(self, new_machine)
+        self.old_machine = old_machine
+
+    def old_to_new(self, old_state_set):
+        key = self.make_key(old_state_set)
+        new_state = self.old_to_new_dict.get(key, None)
+        if new_state is None:
+            new_state = LazyState(self)
+            new_state['number'] = self.new_machine.next_number
+            action, priority = self.highest_priority(old_state_set)
+            new_state['action'] = action
+            if priority is not None:
+                self.new_machine.priorities[new_state['number']] = priority
+            self.new_machine.next_number = self.new_machine.next_number + 1
+            self.new_machine.states.append(new_state)
+            self.old_to_new_dict[key] = new_state
+            self.new_to_old_dict[id(new_state)] = old_state_set
+        return new_state
+
+    def transition(self, new_state, event):
+        """Return the state reached from |new_state| on |event|, or None."""
+        if not event:
+            return None
+        old_target_states = {}
+        for old_state in self.new_to_old(new_state).keys():
+            old_states = old_state.transitions.get(event)
+            if old_states:
+                old_target_states.update(old_states)
+        if not old_target_states:
+            return None
+        return self.old_to_new(set_epsilon_closure(old_target_states))
+
+
+class LazyState(dict):
+    """
+    A state of a FastMachine whose transitions are filled in on demand
+    by its LazyStateMap. Scanners only ever look up transitions using
+    get(), which does the work the first time each event is seen.
+    """
+    def __init__(self, state_map):
+        dict.__init__(self)
+        self.state_map = state_map
+
+    def get(self, event, default = None):
+        try:
+            return self[event]
+        except KeyError:
+            new_state = self.state_map.transition(self, event)
+            self[event] = new_state
+            return new_state
+
+
+class Limits:
+    """
+    Limits(max_states, max_time, fallback) bounds the work done by
+    nfa_to_dfa() on each initial state. |max_states| is the maximum
+    number of DFA states built for one initial state and |max_time| the
+    maximum number of cpu seconds spent on it; either may be None.
+    start() is called before each initial state is begun.
+    If |fallback| is true, initial states whose construction hits a
+    limit are built lazily instead, and their names are added to the
+    |fell_back| list.
+    """
+    max_states = None
+    max_time = None
+    fallback = 0
+    rules = None        # Lexicon rules, for naming offenders
+    state_tokens = None # [token_number] indexed by NFA state number
+
+    def __init__(self, max_states = None, max_time = None, fallback = 0):
+        self.max_states = max_states
+        self.max_time = max_time
+        self.fallback = fallback
+        self.fell_back = []
+
+    def start(self):
+        if self.max_time is not None:
+            from Timing import time
+            self.time = time
+            self.stop_time = time() + self.max_time
+
+    def exceeded(self, num_states):
+        """Return a description of the limit exceeded by an initial
+        state with |num_states| new states so far, or None."""
+        if self.max_states is not None and num_states > self.max_states:
+            return "DFA construction stopped after %d states (limit %d)" % (
+                num_states, self.max_states)
+        if self.max_time is not None and self.time() > self.stop_time:
+            return "DFA construction stopped after %d states " \
+                   "(time limit %s seconds)" % (num_states, self.max_time)
+        return None
+
+    def offenders(self, state_sets, n = 5):
+        """Return up to |n| (dfa_states, token_number, pattern_str) tuples
+        for the tokens contributing most states to |state_sets|."""
+        if not self.rules:
+            return []
+        contributions = {}
+        Reports.count_contributions(contributions, state_sets, self.state_tokens)
+        return Reports.top_rules(contributions, self.rules, n)
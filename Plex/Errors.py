@@ -32,6 +32,23 @@ class AmbiguousAction(PlexError):
                            "same string")
 
 
+class StateExplosion(PlexError):
+    """Raised when building the DFA for a Lexicon state exceeds the limits
+    given to the Lexicon constructor. |offenders| is a list of
+    (dfa_states, token_number, pattern_str) for the token rules
+    contributing most states, largest first.
+    """
+    def __init__(self, state_name, reason, offenders):
+        self.state_name = state_name
+        self.reason = reason
+        self.offenders = offenders
+        lines = ["State %s: %s" % (repr(state_name), reason)]
+        for count, token_number, re_str in offenders:
+            lines.append("  token number %d (%d states): %s" % (
+                token_number, count, re_str))
+        PlexError.__init__(self, "\n".join(lines))
+
+
 class UnrecognizedInput(PlexError):
     def __init__(self, scanner, state_name):
         self.scanner = scanner
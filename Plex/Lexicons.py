@@ -6,11 +6,22 @@
 #
 #=======================================================================
 
+import array
+import copy
+import cPickle
+import types
+
 import Actions
+import CharClasses
+import Columns
 import DFA
 import Errors
 import Machines
+import Optimize
+import Patterns
 import Regexps
+import Reports
+import Scanners
 
 # debug_flags for Lexicon constructor
 DUMP_NFA = 1
@@ -94,50 +105,165 @@ class Lexicon:
           2) Calling the begin(state_name) method of the Scanner.
 
     To change back to the default state, use '' as the state name.
+
+    Construction reports
+    --------------------
+
+    If the |report| argument is true, a Reports.BuildReport describing the
+    time taken by each construction phase, the sizes of the automata built
+    for each state and the tokens responsible for most DFA states is kept
+    as the |report| attribute of the Lexicon.
+
+    Patterns are simplified using Optimize.optimize() before being turned
+    into an NFA, unless |optimize| is false.
+
+    Construction limits
+    -------------------
+
+    A careless pattern can make the DFA for a state grow enormous. If
+    |max_states| (a number of DFA states) or |max_time| (cpu seconds) is
+    given, building a state which exceeds the limit raises
+    Errors.StateExplosion naming the token rules contributing most
+    states. If |fallback| is also true, the DFA for that state is instead
+    built lazily while scanning, and its name is listed in the
+    |lazy_states| attribute of the Lexicon.
+
+    The DFAs for different states are independent of each other. If
+    |processes| is greater than 1 and there is more than one state, they
+    are built in parallel by that many worker processes. The limits then
+    apply to each state separately.
+
+    Incremental updates
+    -------------------
+
+    If |incremental| is true, the Lexicon keeps its NFA and the mapping
+    from NFA state sets to DFA states, and tokens can be changed without
+    rebuilding everything:
+
+        add_tokens(token_definitions, state_name) --> [token_number]
+        remove_token(token_number)
+
+    Only the DFA states whose NFA state sets involve the changed tokens
+    are worked out again. Added tokens have lower priority than all
+    existing ones, and token numbers of removed tokens are not reused.
+    Scanners pick up the changes the next time they enter the state.
+    Construction limits apply to each update, but states which exceed
+    them are not built lazily; the update is abandoned instead.
+
+    Projections
+    -----------
+
+        project(only) --> Lexicon
+
+    returns a copy of the Lexicon in which only the tokens selected by
+    |only| produce anything; the actions of the others are replaced by
+    Actions.DISCARD, unless they are marked with Actions.side_effect().
+    A Scanner created with only=... scans with such a
+    copy, so the tokens it leaves out cost no more than matching them.
     """
 
     machine = None # Machine
     tables = None # StateTableMachine
-
-    def __init__(self, specifications, debug=None, debug_flags=7, timings=False):
+    optimize = True # simplify patterns before building the NFA
+    rules = None # [(state_name, RE, Action) or None if removed] indexed by token_number - 1
+    report = None # Reports.BuildReport
+    lazy_states = () # names of states whose DFA is built while scanning
+    incremental = False # keep what is needed for add_tokens/remove_token
+    nfa = None # Machine, if incremental
+    state_map = None # DFA.StateMap, if incremental
+    state_tokens = None # [token_number] indexed by NFA state number, if incremental
+    token_states = None # [NFA state each token starts from], if incremental
+    limits = None # DFA.Limits, if incremental
+    patterns = None # {state_name: Patterns.StatePatterns}, see get_patterns()
+    class_machine = None # CharClasses.ClassMachine, see get_class_machine()
+    array_machine = None # CharClasses.ArrayMachine, see classify()
+    prefilters = None # {state_name: Patterns.Prefilter}, see get_prefilters()
+    fingerprint_digest = None # see fingerprint()
+    lines_independent = None # see line_cacheable()
+    projections = None # {frozenset: Lexicon}, see project()
+    counter = None # Lexicon with Count actions, see get_counter()
+
+    def __init__(self, specifications, debug=None, debug_flags=7, timings=False,
+                 report=False, max_states=None, max_time=None, fallback=False,
+                 optimize=True, processes=None, incremental=False):
         if not isinstance(specifications, list):
             raise Errors.InvalidScanner("Scanner definition is not a list")
-        if timings:
+        if report:
+            report = Reports.BuildReport()
+            self.report = report
+        if timings or report:
             from Timing import time
             total_time = 0.0
             time1 = time()
+        self.rules = []
+        self.optimize = optimize
+        self.incremental = incremental
+        if incremental:
+            self.token_states = []
         nfa = Machines.Machine()
         default_initial_state = nfa.new_initial_state('')
+        # Token number owning each NFA state, 0 for initial states
+        state_tokens = [0, 0]
         token_number = 1
         for spec in specifications:
             if isinstance(spec, State):
                 user_initial_state = nfa.new_initial_state(spec.name)
+                state_tokens.append(0)
                 for token in spec.tokens:
-                    self.add_token_to_machine(
+                    re, action = self.add_token_to_machine(
                         nfa, user_initial_state, token, token_number)
+                    self.rules.append((spec.name, re, action))
+                    state_tokens.extend(
+                        [token_number] * (nfa.next_state_number - len(state_tokens)))
                     token_number = token_number + 1
             elif isinstance(spec, tuple):
-                self.add_token_to_machine(
+                re, action = self.add_token_to_machine(
                     nfa, default_initial_state, spec, token_number)
+                self.rules.append(('', re, action))
+                state_tokens.extend(
+                    [token_number] * (nfa.next_state_number - len(state_tokens)))
                 token_number = token_number + 1
             else:
                 raise Errors.InvalidToken(
                     token_number,
                     "Expected a token definition (tuple) or State instance")
 
-        if timings:
+        if timings or report:
             time2 = time()
             total_time = total_time + (time2 - time1)
             time3 = time()
+        if report:
+            report.add_time('nfa', time2 - time1)
+            report.rules = self.rules
+            report.state_tokens = state_tokens
+            report.analyse_nfa(nfa)
         if debug and (debug_flags & 1):
             debug.write("\n============= NFA ===========\n")
             nfa.dump(debug)
 
-        dfa = DFA.nfa_to_dfa(nfa, debug = (debug_flags & 3) == 3 and debug)
-
-        if timings:
+        if max_states is not None or max_time is not None:
+            limits = DFA.Limits(max_states, max_time, fallback)
+            limits.rules = self.rules
+            limits.state_tokens = state_tokens
+        else:
+            limits = None
+        if incremental:
+            self.nfa = nfa
+            self.state_map = DFA.StateMap(Machines.FastMachine())
+            self.state_tokens = state_tokens
+            self.limits = limits
+        dfa = DFA.nfa_to_dfa(nfa, debug = (debug_flags & 3) == 3 and debug,
+                             report = report, limits = limits,
+                             processes = processes,
+                             state_map = self.state_map)
+        if limits:
+            self.lazy_states = limits.fell_back
+
+        if timings or report:
             time4 = time()
             total_time = total_time + (time4 - time3)
+        if report:
+            report.analyse_dfa(dfa)
         if debug and (debug_flags & 2):
             debug.write("\n============= DFA ===========\n")
             dfa.dump(debug)
@@ -161,12 +287,371 @@ class Lexicon:
                 action = Actions.Call(action_spec)
             else:
                 action = Actions.Return(action_spec)
+            if self.incremental:
+                # Give the token a state of its own, so that it can be
+                # unlinked from the initial state again
+                token_state = machine.new_state()
+                initial_state.link_to(token_state)
+                self.token_states.append(token_state)
+                initial_state = token_state
             final_state = machine.new_state()
-            re.build_machine(machine, initial_state, final_state,
-                                              match_bol = 1, nocase = 0)
+            if self.optimize:
+                built_re = Optimize.optimize(re)
+            else:
+                built_re = re
+            built_re.build_machine(machine, initial_state, final_state,
+                                   match_bol = 1, nocase = 0)
             final_state.set_action(action, priority = -token_number)
         except Errors.PlexError, e:
             raise e.__class__("Token number %d: %s" % (token_number, e))
+        return (re, action)
+
+    def add_tokens(self, token_definitions, state_name = ''):
+        """Add the tokens in the list |token_definitions| to the state
+        named |state_name|, creating the state if there is none of that
+        name. Returns a list of the new token numbers. The Lexicon must
+        have been created with incremental=1."""
+        self.check_incremental()
+        nfa = self.nfa
+        rules = self.rules
+        state_tokens = self.state_tokens
+        first_token = len(rules)
+        initial_state = nfa.initial_states.get(state_name)
+        if initial_state is None:
+            initial_state = nfa.new_initial_state(state_name)
+            state_tokens.append(0)
+        try:
+            for token in token_definitions:
+                token_number = len(rules) + 1
+                re, action = self.add_token_to_machine(
+                    nfa, initial_state, token, token_number)
+                rules.append((state_name, re, action))
+                state_tokens.extend(
+                    [token_number] * (nfa.next_state_number - len(state_tokens)))
+            DFA.update_dfa(self.state_map, nfa, state_name, self.limits)
+            self.machine_changed()
+        except Errors.PlexError:
+            for token_state in self.token_states[first_token:]:
+                del initial_state.transitions.get_epsilon()[token_state]
+            del self.token_states[first_token:]
+            del rules[first_token:]
+            state_tokens.extend([0] * (nfa.next_state_number - len(state_tokens)))
+            initial_state.epsilon_closure = None
+            raise
+        self.update_lazy_states(state_name)
+        return range(first_token + 1, len(rules) + 1)
+
+    def remove_token(self, token_number):
+        """Remove the token numbered |token_number|. The Lexicon must
+        have been created with incremental=1."""
+        self.check_incremental()
+        if not 0 < token_number <= len(self.rules) \
+                or self.rules[token_number - 1] is None:
+            raise Errors.InvalidToken(token_number, "No such token")
+        state_name = self.rules[token_number - 1][0]
+        initial_state = self.nfa.initial_states[state_name]
+        token_state = self.token_states[token_number - 1]
+        links = initial_state.transitions.get_epsilon()
+        del links[token_state]
+        try:
+            DFA.update_dfa(self.state_map, self.nfa, state_name, self.limits)
+        except Errors.PlexError:
+            links[token_state] = 1
+            initial_state.epsilon_closure = None
+            raise
+        self.rules[token_number - 1] = None
+        self.machine_changed()
+        self.update_lazy_states(state_name)
+
+    def check_incremental(self):
+        if not self.incremental:
+            raise Errors.PlexError(
+                "Lexicon was not created with incremental=1")
+
+    def machine_changed(self):
+        # Forget everything derived from the DFA
+        self.patterns = None
+        self.class_machine = None
+        self.array_machine = None
+        self.prefilters = None
+        self.fingerprint_digest = None
+        self.lines_independent = None
+        self.projections = None
+        self.counter = None
+
+    def update_lazy_states(self, state_name):
+        # An updated state is always built in full
+        if state_name in self.lazy_states:
+            self.lazy_states.remove(state_name)
+
+    def get_patterns(self):
+        """Return {state_name: Patterns.StatePatterns} for the states which
+        Scanners using the 're' engine can match with Python re patterns.
+        The patterns are made the first time they are asked for."""
+        if self.patterns is None:
+            self.patterns = Patterns.lexicon_patterns(self)
+        return self.patterns
+
+    def get_prefilters(self):
+        """Return a dictionary {state_name: Patterns.Prefilter} of the
+        patterns used in search mode to find where tokens could begin."""
+        if self.prefilters is None:
+            self.prefilters = Patterns.lexicon_prefilters(self)
+        return self.prefilters
+
+    def get_class_machine(self):
+        """Return the CharClasses.ClassMachine used by Scanners whose engine
+        is 'classes', or None if some states are built while scanning.
+        It is made the first time it is asked for."""
+        if self.lazy_states:
+            return None
+        if self.class_machine is None:
+            self.class_machine = CharClasses.ClassMachine(self.machine)
+        return self.class_machine
+
+    def classify(self, strings, state_name = ''):
+        """
+        Return a NumPy array giving, for each byte string in the list
+        |strings|, the number of the token which matches the whole string
+        in the state named |state_name|, or 0 if no token does. The rule
+        for token number n is self.rules[n - 1]. The DFA is run on all
+        of the strings in step, using NumPy arrays, so this is much
+        faster than scanning many short strings one at a time.
+        """
+        import numpy
+        if self.array_machine is None:
+            class_machine = self.get_class_machine()
+            if class_machine is None:
+                raise Errors.PlexError(
+                    "classify() needs the DFA of every state to be built")
+            self.array_machine = CharClasses.ArrayMachine(
+                class_machine, self.machine, numpy)
+        return self.array_machine.match_whole(numpy, strings, state_name)
+
+    def scan_many(self, texts):
+        """
+        For each string in the iterable |texts|, yield the list of
+        (value, text) tokens that a new Scanner would read from it,
+        up to end of file. One Scanner is reset() for each string, so
+        this avoids most of the cost of scanning many small inputs.
+        """
+        scanner = Scanners.Scanner(self, '')
+        reset = scanner.reset
+        read = scanner.read
+        for text in texts:
+            reset(text)
+            tokens = []
+            while 1:
+                token = read()
+                if token[0] is None:
+                    break
+                tokens.append(token)
+            yield tokens
+
+    def search(self, stream, name = ''):
+        """
+        Yield a tuple (value, text, pos, line, col) for each token found
+        in |stream|, a file-like object or a string, by a Scanner in
+        search mode. |pos| is the position of the token in the input,
+        and |line| and |col| are as returned by Scanner.position().
+        """
+        scanner = Scanners.Scanner(self, stream, name)
+        scanner.search = 1
+        read = scanner.read
+        while 1:
+            value, text = read()
+            if value is None:
+                return
+            yield (value, text, scanner.start_pos, scanner.start_line,
+                   scanner.start_col)
+
+    def fingerprint(self):
+        """Return a string which is the same for Lexicons with the same
+        rules, and different otherwise, for use as a cache key. Functions
+        used as actions are identified by their code, default arguments
+        and closure contents as well as their names, and values by their
+        pickles where they have them (see action_key())."""
+        if self.fingerprint_digest is None:
+            import hashlib
+            digest = hashlib.sha1()
+            for rule in self.rules:
+                if rule is not None:
+                    state_name, re, action = rule
+                    digest.update(repr((state_name, str(re),
+                                        action_key(action, {}))))
+                else:
+                    digest.update(repr(rule))
+            self.fingerprint_digest = digest.hexdigest()
+        return self.fingerprint_digest
+
+    def uncacheable_tokens(self):
+        """Return a list of the numbers of the tokens whose actions
+        prevent their scans from being cached (see Actions.pure())."""
+        result = []
+        for token_number in xrange(1, len(self.rules) + 1):
+            rule = self.rules[token_number - 1]
+            if rule is not None and not rule[2].cacheable:
+                result.append(token_number)
+        return result
+
+    def line_cacheable(self):
+        """Return true if a Scanner can scan with a Caches.LineCache:
+        no token can run on past a newline, so that each line is scanned
+        the same way wherever it appears, and all of the actions are
+        cacheable (see uncacheable_tokens())."""
+        if self.lines_independent is None:
+            self.lines_independent = (
+                not self.lazy_states and not self.uncacheable_tokens()
+                and self.tokens_end_at_newlines())
+        return self.lines_independent
+
+    def tokens_end_at_newlines(self):
+        # True if the DFA can make no transitions after a newline
+        for state in self.machine.states:
+            new_state = CharClasses.target(state, '\n')
+            if new_state:
+                for event, target in new_state.items():
+                    if target and event not in ('action', 'number'):
+                        return False
+        return True
+
+    def project(self, only):
+        """
+        Return a copy of the Lexicon which only produces the tokens in
+        |only|, a collection of token values and token numbers. A token
+        whose action returns a fixed value is kept if the value is in
+        |only|; any other token is kept if its number is. Tokens whose
+        action is Begin are always kept, and the actions of the tokens
+        left out are still performed if they are marked with
+        Actions.side_effect(), though they produce nothing. The copy is
+        made the first time the same tokens are asked for, and shares
+        the Lexicon's rules except for the actions.
+        """
+        only = frozenset(only)
+        if self.projections is None:
+            self.projections = {}
+        projection = self.projections.get(only)
+        if projection is None:
+            actions = []
+            for token_number in xrange(1, len(self.rules) + 1):
+                rule = self.rules[token_number - 1]
+                action = None
+                if rule is not None:
+                    action = rule[2]
+                    if isinstance(action, Actions.Return):
+                        keep = action.value in only
+                    else:
+                        keep = (token_number in only
+                                or isinstance(action, (Actions.Begin,
+                                                       Actions.Ignore)))
+                    if not keep:
+                        if action.counting:
+                            action = Actions.SideEffect(action)
+                        else:
+                            action = Actions.DISCARD
+                actions.append(action)
+            projection = self.copy_with_actions(actions)
+            self.projections[only] = projection
+        return projection
+
+    def count_tokens(self, stream, name='', engine='classes'):
+        """
+        Scan |stream|, a file object or string, as a Scanner using
+        |engine| (by default the usually fastest, 'classes') would, and
+        return a tuple (counts, lines), where
+        |counts| is an array.array of the number of times each token
+        was recognised, indexed by token number, and |lines| is the
+        number of lines read. No token text is taken and no actions are
+        performed, except for Begin and calls of functions marked with
+        Actions.side_effect(). A unicode string is scanned with 'dfa';
+        the 'classes' engine raises PlexTypeError on unicode read from
+        a file object.
+        """
+        counts = array.array('l', [0]) * (len(self.rules) + 1)
+        scanner = self.get_counting_scanner(stream, name, engine)
+        scanner.count_tokens(counts)
+        return counts, scanner.cur_line
+
+    def scan_columns(self, stream, name='', engine='classes'):
+        """
+        Scan |stream|, a file object or string, as count_tokens() does,
+        and return a Columns.TokenColumns holding the token number,
+        start and end offsets, line and column of each token, other
+        than those whose action is IGNORE or Begin. Its |value_table|
+        gives the value of each token number.
+        """
+        columns = Columns.TokenColumns(self.value_table())
+        recorded = [0]
+        for rule in self.rules:
+            recorded.append(rule is not None and not isinstance(
+                rule[2], (Actions.Ignore, Actions.Begin)))
+        scanner = self.get_counting_scanner(stream, name, engine)
+        scanner.scan_columns(columns, recorded)
+        return columns
+
+    def value_table(self):
+        """
+        Return a list giving for each token number the value of the
+        token: the value returned by its action if that is fixed, TEXT if
+        the value is the token's text, or otherwise the action itself.
+        Index 0 is None.
+        """
+        result = [None]
+        for rule in self.rules:
+            value = None
+            if rule is not None:
+                value = rule[2]
+                if isinstance(value, Actions.Return):
+                    value = value.value
+            result.append(value)
+        return result
+
+    def get_counting_scanner(self, stream, name, engine):
+        # A Scanner for count_tokens() and scan_columns() using |engine|,
+        # or 'dfa' for a unicode string (see Scanner.input_engine)
+        scanner = Scanners.Scanner(self.get_counter(), stream, name)
+        scanner.engine = engine
+        return scanner
+
+    def get_counter(self):
+        # The copy of the Lexicon used by count_tokens(), in which each
+        # action is an Actions.Count
+        if self.counter is None:
+            actions = []
+            for token_number in xrange(1, len(self.rules) + 1):
+                rule = self.rules[token_number - 1]
+                if rule is not None:
+                    actions.append(Actions.Count(token_number, rule[2]))
+                else:
+                    actions.append(None)
+            self.counter = self.copy_with_actions(actions)
+        return self.counter
+
+    def copy_with_actions(self, actions):
+        """Return a copy of the Lexicon in which token number n has the
+        action actions[n - 1], for project() and count_tokens()."""
+        if self.lazy_states:
+            raise Errors.PlexError(
+                "Cannot copy a Lexicon whose states %s are built "
+                "while scanning" % ", ".join(map(repr, self.lazy_states)))
+        result = copy.copy(self)
+        result.incremental = False
+        result.machine_changed()
+        result.rules = rules = []
+        for token_number in xrange(1, len(self.rules) + 1):
+            rule = self.rules[token_number - 1]
+            if rule is not None:
+                rule = rule[:2] + (actions[token_number - 1],)
+            rules.append(rule)
+        machine = self.machine.copy()
+        priorities = machine.priorities
+        for state in machine.states:
+            priority = priorities.get(state['number'])
+            # Lexicon gives each token the priority -token_number
+            if priority is not None and state['action'] is not None:
+                state['action'] = actions[-priority - 1]
+        result.machine = machine
+        return result
 
     def parse_token_definition(self, token_spec):
         if not isinstance(token_spec, tuple):
@@ -182,4 +667,51 @@ class Lexicon:
         return self.machine.get_initial_state(name)
 
 
-
+def action_key(action, seen):
+    """Return a description of the Action |action| for fingerprint()
+    which does not depend on where objects happen to be in memory, as
+    repr() often does. |seen| maps the ids of the functions already
+    being described to 1, for functions which refer to themselves."""
+    if isinstance(action, Actions.Call):
+        return ('Call', value_key(action.function, seen))
+    elif isinstance(action, Actions.Return):
+        return ('Return', value_key(action.value, seen))
+    elif isinstance(action, Actions.SideEffect):
+        return ('SideEffect', action_key(action.action, seen))
+    else:
+        return repr(action)
+
+
+def value_key(value, seen):
+    # Part of action_key()
+    if isinstance(value, types.FunctionType):
+        if id(value) in seen:
+            return ('recursive', value.__name__)
+        seen[id(value)] = 1
+        cells = value.func_closure or ()
+        return ('function', value.__module__, value.__name__,
+                code_key(value.func_code),
+                tuple([value_key(default, seen)
+                       for default in value.func_defaults or ()]),
+                tuple([value_key(cell.cell_contents, seen)
+                       for cell in cells]))
+    elif isinstance(value, types.MethodType):
+        return ('method', value_key(value.im_func, seen),
+                value_key(value.im_self, seen))
+    try:
+        return ('pickle', cPickle.dumps(value, 2))
+    except Exception:
+        return ('repr', repr(value))
+
+
+def code_key(code):
+    # Part of action_key(): what makes a code object behave as it does
+    consts = []
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            const = code_key(const)
+        else:
+            const = repr(const)
+        consts.append(const)
+    return (code.co_code, tuple(consts), code.co_names, code.co_varnames,
+            code.co_freevars)
@@ -113,6 +113,7 @@ class FastMachine:
     initial_states = None # {state_name:state}
     states = None # [state]
                   # where state = {event:state, 'else':state, 'action':Action}
+    priorities = None # {state number: priority of the state's action}
     next_number = 1       # for debugging
 
     new_state_template = {
@@ -122,6 +123,7 @@ class FastMachine:
     def __init__(self, old_machine = None):
         self.initial_states = initial_states = {}
         self.states = []
+        self.priorities = {}
         if old_machine:
             self.old_to_new = old_to_new = {}
             for old_state in old_machine.states:
@@ -142,9 +144,14 @@ class FastMachine:
         for state in self.states:
             state.clear()
 
-    def new_state(self, action = None):
+    def new_state(self, action = None, priority = None):
         number = self.next_number
         self.next_number = number + 1
+        if priority is not None:
+            self.priorities[number] = priority
+        elif number in self.priorities:
+            # Left over from a discarded state
+            del self.priorities[number]
         result = self.new_state_template.copy()
         result['number'] = number
         result['action'] = action
@@ -169,6 +176,25 @@ class FastMachine:
     def get_initial_state(self, name):
         return self.initial_states[name]
 
+    def copy(self):
+        """Return a copy of the machine with states of its own, so that
+        their actions can be changed."""
+        result = FastMachine()
+        result.next_number = self.next_number
+        result.priorities = self.priorities.copy()
+        new_states = {}
+        for state in self.states:
+            new_state = state.copy()
+            new_states[id(state)] = new_state
+            result.states.append(new_state)
+        for new_state in result.states:
+            for event, state in new_state.items():
+                if state and event not in ('action', 'number'):
+                    new_state[event] = new_states[id(state)]
+        for name, state in self.initial_states.items():
+            result.initial_states[name] = new_states[id(state)]
+        return result
+
     def dump(self, file):
         file.write("Plex.FastMachine:\n")
         file.write("   Initial states:\n")
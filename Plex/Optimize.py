@@ -0,0 +1,234 @@
+"""Plex regular expression simplification.
+
+The RE constructors build trees naively: Str() is a Seq of single
+character ranges, Opt() is an Alt with Empty, and nested Alts and Seqs
+are never flattened. optimize() rewrites a tree into an equivalent one
+which produces a smaller NFA. It is applied to every token pattern
+before the Lexicon builds its machine.
+"""
+
+from Plex.Regexps import RE, Seq, Alt, Rep1, SwitchCase, RawCodeRange
+from Plex.Regexps import SpecialSymbol, RawNewline, Empty
+
+
+def optimize(re):
+    """Return an RE matching the same strings as |re|, with nested
+    sequences and alternatives flattened, duplicate alternatives removed,
+    adjacent character ranges merged and common prefixes and suffixes of
+    alternatives factored out. The result is remembered by |re|.
+    """
+    result = re.optimized
+    if result is None:
+        result = Optimizer().optimize(re)
+        re.optimized = result
+    return result
+
+
+class Optimizer:
+    """Helper class used by optimize(). Structural keys of the REs seen are
+    remembered for the life of the Optimizer."""
+
+    keys = None # {id(re): (re, key)}
+
+    def __init__(self):
+        self.keys = {}
+
+    def optimize(self, re):
+        if isinstance(re, Seq):
+            return self.optimize_seq(re.re_list, re)
+        elif isinstance(re, Alt):
+            return self.optimize_alt(re.re_list, re)
+        elif isinstance(re, Rep1):
+            sub_re = self.optimize(re.re)
+            if isinstance(sub_re, Rep1):
+                return sub_re
+            elif sub_re is re.re:
+                return re
+            else:
+                return Rep1(sub_re)
+        elif isinstance(re, SwitchCase):
+            sub_re = self.optimize(re.re)
+            if isinstance(sub_re, SwitchCase):
+                # The innermost case setting wins
+                return sub_re
+            elif sub_re is re.re:
+                return re
+            else:
+                return SwitchCase(sub_re, re.nocase)
+        else:
+            return re
+
+    def optimize_seq(self, re_list, original = None):
+        result = []
+        for re in re_list:
+            re = self.optimize(re)
+            if isinstance(re, Seq):
+                result.extend(re.re_list)
+            else:
+                result.append(re)
+        if len(result) == 1:
+            return result[0]
+        if original is not None and tuple(result) == tuple(original.re_list):
+            return original
+        return Seq(*result)
+
+    def optimize_alt(self, re_list, original = None):
+        alternatives = []
+        for re in re_list:
+            re = self.optimize(re)
+            if isinstance(re, Alt):
+                alternatives.extend(re.re_list)
+            else:
+                alternatives.append(re)
+        alternatives = self.remove_duplicates(alternatives)
+        alternatives = self.merge_ranges(alternatives)
+        alternatives = self.factor_prefixes(alternatives)
+        alternatives = self.factor_suffixes(alternatives)
+        if len(alternatives) == 1:
+            return alternatives[0]
+        if original is not None and tuple(alternatives) == tuple(original.re_list):
+            return original
+        return Alt(*alternatives)
+
+    def remove_duplicates(self, alternatives):
+        seen = {}
+        result = []
+        for re in alternatives:
+            key = self.key(re)
+            if key not in seen:
+                seen[key] = 1
+                result.append(re)
+        return result
+
+    def merge_ranges(self, alternatives):
+        """Replace the character ranges among |alternatives| by the
+        fewest ranges covering the same characters."""
+        ranges = []
+        for re in alternatives:
+            if isinstance(re, RawCodeRange):
+                ranges.append(re.range)
+        if len(ranges) < 2:
+            return alternatives
+        ranges.sort()
+        merged = []
+        for code1, code2 in ranges:
+            if merged and code1 <= merged[-1][1]:
+                if code2 > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], code2)
+            else:
+                merged.append((code1, code2))
+        if len(merged) == len(ranges):
+            return alternatives
+        result = []
+        for re in alternatives:
+            if isinstance(re, RawCodeRange):
+                if merged:
+                    for code1, code2 in merged:
+                        result.append(RawCodeRange(code1, code2))
+                    merged = None
+            else:
+                result.append(re)
+        return result
+
+    def factor_prefixes(self, alternatives):
+        """Turn alternatives sharing a first item, such as Seq(a, b) and
+        Seq(a, c), into Seq(a, Alt(b, c))."""
+        groups = {}
+        order = []
+        for re in alternatives:
+            first, rest = self.split_first(re)
+            key = self.key(first)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (first, [])
+                order.append(key)
+            group[1].append(rest)
+        if len(order) == len(alternatives):
+            return alternatives
+        result = []
+        for key in order:
+            first, rests = groups[key]
+            if len(rests) == 1:
+                result.append(self.join(first, rests[0]))
+            else:
+                rest = self.optimize_alt(rests)
+                result.append(self.optimize_seq((first, rest)))
+        return result
+
+    def factor_suffixes(self, alternatives):
+        """Turn alternatives sharing a last item, such as Seq(a, c) and
+        Seq(b, c), into Seq(Alt(a, b), c). This is only done where the
+        leading parts agree on nullable and match_nl, so that the last
+        item is built with the same beginning-of-line handling."""
+        groups = {}
+        order = []
+        for re in alternatives:
+            rest, last = self.split_last(re)
+            key = (self.key(last), rest.nullable, rest.match_nl)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (last, [])
+                order.append(key)
+            group[1].append(rest)
+        if len(order) == len(alternatives):
+            return alternatives
+        result = []
+        for key in order:
+            last, rests = groups[key]
+            if len(rests) == 1:
+                result.append(self.join(rests[0], last))
+            else:
+                rest = self.optimize_alt(rests)
+                result.append(self.optimize_seq((rest, last)))
+        return result
+
+    def split_first(self, re):
+        if isinstance(re, Seq) and len(re.re_list) > 1:
+            re_list = re.re_list
+            if len(re_list) == 2:
+                return re_list[0], re_list[1]
+            return re_list[0], Seq(*re_list[1:])
+        return re, Empty
+
+    def split_last(self, re):
+        if isinstance(re, Seq) and len(re.re_list) > 1:
+            re_list = re.re_list
+            if len(re_list) == 2:
+                return re_list[0], re_list[1]
+            return Seq(*re_list[:-1]), re_list[-1]
+        return Empty, re
+
+    def join(self, re1, re2):
+        if re1 is Empty:
+            return re2
+        if re2 is Empty:
+            return re1
+        return self.optimize_seq((re1, re2))
+
+    def key(self, re):
+        """Return a hashable value which is the same for structurally
+        identical REs."""
+        entry = self.keys.get(id(re))
+        if entry is not None:
+            return entry[1]
+        if isinstance(re, RawCodeRange):
+            key = ('R', re.range)
+        elif re is RawNewline:
+            key = ('N',)
+        elif isinstance(re, SpecialSymbol):
+            key = ('S', re.sym)
+        elif isinstance(re, Seq):
+            key = ('Q',) + tuple(map(self.key, re.re_list))
+        elif isinstance(re, Alt):
+            keys = map(self.key, re.re_list)
+            keys.sort()
+            key = ('A',) + tuple(keys)
+        elif isinstance(re, Rep1):
+            key = ('P', self.key(re.re))
+        elif isinstance(re, SwitchCase):
+            key = ('C', re.nocase, self.key(re.re))
+        else:
+            key = ('?', id(re))
+        # Keep |re| alive so that its id is not reused
+        self.keys[id(re)] = (re, key)
+        return key
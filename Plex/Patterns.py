@@ -0,0 +1,327 @@
+"""Plex lexicons translated into Python re patterns.
+
+The Python re module is a backtracking matcher: it takes the first
+alternative that leads to a match rather than the longest match, so it
+can't stand in for the DFA in general. It can do so for a token pattern
+which is LL(1), meaning that every choice within it (which alternative,
+whether to repeat again, whether to take an optional part) is decided
+by the next character. The greedy match found by re is then the
+longest one.
+
+For each state of a Lexicon, a StatePatterns records a compiled re
+pattern for each character which can begin exactly one of the state's
+tokens, provided that token is LL(1). Other tokens can't match text
+starting with that character, so the longest match is that token's.
+At every other character the Scanner uses the DFA as usual.
+
+For search mode, a Prefilter is a single re pattern for each state
+which matches wherever one of the state's tokens could begin. It is
+made from the literal characters, character sets and Bol/Eol/Eof at
+the start of each token pattern, so it can be wrong only by matching
+where no token actually begins, and the Scanner can use it to skip
+the text in between.
+"""
+
+import re as re_module
+
+import Optimize
+from Regexps import Seq, Alt, Rep1, SwitchCase, RawCodeRange, RawNewline
+from Regexps import SpecialSymbol, union_first_sets, BOL, EOL, EOF
+
+# Only byte strings are matched using patterns
+NUM_CHARS = 256
+
+
+class Untranslatable(Exception):
+    """Raised when a pattern can't be translated."""
+
+
+def lexicon_patterns(lexicon):
+    """Return a dictionary {state_name: StatePatterns} for the states of
+    |lexicon| which can use re patterns at all."""
+    result = {}
+    for state_name, rules in rules_by_state(lexicon).items():
+        state_patterns = StatePatterns(rules)
+        if state_patterns.table:
+            result[state_name] = state_patterns
+    return result
+
+def lexicon_prefilters(lexicon):
+    """Return a dictionary {state_name: Prefilter} for the states of
+    |lexicon| which have one."""
+    result = {}
+    for state_name, rules in rules_by_state(lexicon).items():
+        prefilter = make_prefilter(rules)
+        if prefilter is not None:
+            result[state_name] = prefilter
+    return result
+
+def rules_by_state(lexicon):
+    """Return {state_name: [(RE, Action)]} in priority order."""
+    result = {}
+    for token_number in xrange(1, len(lexicon.rules) + 1):
+        rule = lexicon.rules[token_number - 1]
+        if rule is not None:
+            state_name, re, action = rule
+            if lexicon.optimize:
+                re = Optimize.optimize(re)
+            result.setdefault(state_name, []).append((re, action))
+    return result
+
+
+class StatePatterns:
+    """The re patterns of one state of a Lexicon. |table| maps each
+    character at which a pattern can be used to a tuple (match, action)
+    where |match| is the match method of the compiled pattern."""
+
+    table = None # {char: (match_method, Action)}
+
+    def __init__(self, rules):
+        """|rules| is a list of (RE, Action) in priority order."""
+        self.table = {}
+        for re, action in rules:
+            if uses_specials(re):
+                # Bol, Eol and Eof aren't characters of the text
+                return
+        starts = [0] * NUM_CHARS
+        usable = []
+        for re, action in rules:
+            ranges = first_chars(re, 0)
+            for code1, code2 in ranges:
+                for code in xrange(code1, code2):
+                    starts[code] = starts[code] + 1
+            try:
+                if not is_ll1(re, 0, ()):
+                    continue
+                pattern = re_module.compile(translate(re, 0))
+            except Untranslatable:
+                continue
+            usable.append((ranges, pattern.match, action))
+        for ranges, match, action in usable:
+            for code1, code2 in ranges:
+                for code in xrange(code1, code2):
+                    if starts[code] == 1:
+                        self.table[chr(code)] = (match, action)
+
+
+class Prefilter:
+    """The search mode prefilter of one state of a Lexicon. |search| is
+    the search method of a compiled pattern matching wherever a token
+    could begin, and a token beginning |width| or more characters from
+    the end of the text searched is always found."""
+
+    search = None
+    width = 0
+
+    def __init__(self, search, width):
+        self.search = search
+        self.width = width
+
+
+def make_prefilter(rules):
+    """Return a Prefilter for |rules|, a list of (RE, Action), or None
+    if a token could match the empty string."""
+    alternatives = []
+    width = 1
+    for re, action in rules:
+        if re.nullable:
+            return None
+        prefix = leading_pattern(re, 0)
+        if prefix is None:
+            ranges, specials = re.first_set()
+            parts = [char_class(clip_ranges(ranges))]
+            for sym in specials:
+                parts.append(special_patterns[sym])
+            prefix = ("|".join(parts), 1, 0)
+        alternatives.append(prefix[0])
+        width = max(width, prefix[1])
+    pattern = re_module.compile("|".join(alternatives), re_module.M)
+    return Prefilter(pattern.search, width)
+
+# Bol, Eol and Eof as re assertions, given re.M
+special_patterns = {BOL: "^", EOL: "$", EOF: "\\Z"}
+
+def leading_pattern(re, nocase):
+    """Return a tuple (pattern, width, exact) where |pattern| is Python
+    re syntax that matches wherever a non-empty match of |re| could
+    begin, |width| is the most characters it matches and |exact| is true
+    if it matches exactly what |re| does, or None if there is no such
+    pattern without repetition."""
+    if isinstance(re, RawCodeRange) or re is RawNewline:
+        return (translate(re, nocase), 1, 1)
+    elif isinstance(re, SpecialSymbol):
+        return (special_patterns[re.sym], 0, 1)
+    elif isinstance(re, Seq):
+        parts = []
+        width = 0
+        exact = 1
+        for sub_re in re.re_list:
+            if sub_re.nullable:
+                exact = 0
+                break
+            prefix = leading_pattern(sub_re, nocase)
+            if prefix is None:
+                exact = 0
+                break
+            parts.append(prefix[0])
+            width = width + prefix[1]
+            if not prefix[2]:
+                exact = 0
+                break
+        if not parts:
+            return None
+        return ("".join(parts), width, exact)
+    elif isinstance(re, Alt):
+        parts = []
+        width = 0
+        for sub_re in re.re_list:
+            prefix = leading_pattern(sub_re, nocase)
+            if prefix is None:
+                return None
+            parts.append(prefix[0])
+            width = max(width, prefix[1])
+        return ("(?:%s)" % "|".join(parts), width, 0)
+    elif isinstance(re, Rep1):
+        prefix = leading_pattern(re.re, nocase)
+        return prefix and (prefix[0], prefix[1], 0)
+    elif isinstance(re, SwitchCase):
+        return leading_pattern(re.re, re.nocase)
+    else:
+        return None
+
+
+def uses_specials(re):
+    """Return true if |re| matches any of the special symbols."""
+    if isinstance(re, SpecialSymbol):
+        return 1
+    for sub_re in sub_res(re):
+        if uses_specials(sub_re):
+            return 1
+    return 0
+
+def sub_res(re):
+    if isinstance(re, Seq) or isinstance(re, Alt):
+        return re.re_list
+    elif isinstance(re, Rep1) or isinstance(re, SwitchCase):
+        return (re.re,)
+    return ()
+
+def first_chars(re, nocase):
+    """Return the character ranges which can begin a non-empty match of
+    |re|, limited to the byte characters."""
+    ranges, specials = re.first_set(nocase)
+    return clip_ranges(ranges)
+
+def clip_ranges(ranges):
+    result = []
+    for code1, code2 in ranges:
+        code1 = max(code1, 0)
+        code2 = min(code2, NUM_CHARS)
+        if code1 < code2:
+            result.append((code1, code2))
+    return tuple(result)
+
+def overlap(ranges1, ranges2):
+    """Return true if two sorted tuples of ranges have a code in common."""
+    i = j = 0
+    while i < len(ranges1) and j < len(ranges2):
+        code1, code2 = ranges1[i]
+        code3, code4 = ranges2[j]
+        if code1 < code4 and code3 < code2:
+            return 1
+        if code2 <= code4:
+            i = i + 1
+        else:
+            j = j + 1
+    return 0
+
+def union(ranges1, ranges2):
+    return union_first_sets([(ranges1, ()), (ranges2, ())])[0]
+
+def is_ll1(re, nocase, follow):
+    """Return true if every choice made while matching |re| is decided by
+    the next character, when |re| is followed by text beginning with one
+    of the character ranges |follow|."""
+    if isinstance(re, RawCodeRange) or re is RawNewline:
+        return 1
+    elif isinstance(re, Seq):
+        re_list = re.re_list
+        i = len(re_list)
+        while i:
+            i = i - 1
+            sub_re = re_list[i]
+            if not is_ll1(sub_re, nocase, follow):
+                return 0
+            if sub_re.nullable:
+                follow = union(first_chars(sub_re, nocase), follow)
+            else:
+                follow = first_chars(sub_re, nocase)
+        return 1
+    elif isinstance(re, Alt):
+        seen = ()
+        for sub_re in re.re_list:
+            ranges = first_chars(sub_re, nocase)
+            if overlap(ranges, seen):
+                return 0
+            seen = union(ranges, seen)
+            if not is_ll1(sub_re, nocase, follow):
+                return 0
+        return not (re.nullable and overlap(seen, follow))
+    elif isinstance(re, Rep1):
+        if re.re.nullable:
+            return 0
+        ranges = first_chars(re.re, nocase)
+        if overlap(ranges, follow):
+            return 0
+        return is_ll1(re.re, nocase, union(ranges, follow))
+    elif isinstance(re, SwitchCase):
+        return is_ll1(re.re, re.nocase, follow)
+    else:
+        raise Untranslatable(re)
+
+def translate(re, nocase):
+    """Return Python re syntax for an RE accepted by is_ll1()."""
+    if isinstance(re, RawCodeRange):
+        ranges = [re.range]
+        if nocase:
+            if re.uppercase_range:
+                ranges.append(re.uppercase_range)
+            if re.lowercase_range:
+                ranges.append(re.lowercase_range)
+        return char_class(clip_ranges(ranges))
+    elif re is RawNewline:
+        return "\\n"
+    elif isinstance(re, Seq):
+        return "".join([translate(sub_re, nocase) for sub_re in re.re_list])
+    elif isinstance(re, Alt):
+        # Alternatives are tried in order, so an empty match comes last
+        non_nullable = []
+        nullable = []
+        for sub_re in re.re_list:
+            if sub_re.nullable:
+                nullable.append(translate(sub_re, nocase))
+            else:
+                non_nullable.append(translate(sub_re, nocase))
+        if nullable == [""]:
+            return "(?:%s)?" % "|".join(non_nullable)
+        return "(?:%s)" % "|".join(non_nullable + nullable)
+    elif isinstance(re, Rep1):
+        return "(?:%s)+" % translate(re.re, nocase)
+    elif isinstance(re, SwitchCase):
+        return translate(re.re, re.nocase)
+    else:
+        raise Untranslatable(re)
+
+def char_class(ranges):
+    if not ranges:
+        # Can't match any byte character
+        return "(?!)"
+    if len(ranges) == 1 and ranges[0][1] - ranges[0][0] == 1:
+        return "\\x%02x" % ranges[0][0]
+    parts = []
+    for code1, code2 in ranges:
+        if code2 - code1 == 1:
+            parts.append("\\x%02x" % code1)
+        else:
+            parts.append("\\x%02x-\\x%02x" % (code1, code2 - 1))
+    return "[%s]" % "".join(parts)
@@ -1,7 +1,9 @@
 """Plex regular expressions."""
 
+import copy
 import sys
 import types
+import weakref
 
 from Plex import Errors
 
@@ -79,11 +81,77 @@ def CodeRange(code1, code2):
     else:
         return RawCodeRange(code1, code2)
 
+#
+#     Interning
+#
+#     REs are immutable once built, so constructing a structurally identical
+#     RE returns the existing instance. This makes REs which are built over
+#     and over again, such as those for single characters, cost nothing
+#     after the first time, and lets derived data be computed once per RE.
+#
+
+interned = weakref.WeakValueDictionary() # {(class, args...) : RE}
+
+class InternedClass(type):
+    """Metaclass of RE which returns an existing instance when one has
+    already been constructed from the same arguments."""
+
+    def __call__(cls, *args):
+        key = (cls,) + args
+        try:
+            re = interned.get(key)
+        except TypeError:
+            # Unhashable argument; let the constructor complain about it
+            return type.__call__(cls, *args)
+        if re is None:
+            re = type.__call__(cls, *args)
+            interned[key] = re
+        return re
+
+def labelled(re, s):
+    """
+    Return an RE matching the same strings as |re| whose str() is |s|.
+    Interned REs are shared, so they must never be labelled in place.
+    """
+    if re.str == s:
+        return re
+    key = (labelled, re, s)
+    result = interned.get(key)
+    if result is None:
+        result = copy.copy(re)
+        result.str = s
+        result.first_sets = None
+        result.optimized = None
+        interned[key] = result
+    return result
+
+def union_first_sets(first_sets):
+    """
+    Combine a list of first sets as returned by RE.first_set() into one.
+    """
+    code_list = []
+    specials = {}
+    for ranges, syms in first_sets:
+        code_list.extend(ranges)
+        for sym in syms:
+            specials[sym] = 1
+    code_list.sort()
+    ranges = []
+    for code1, code2 in code_list:
+        if ranges and code1 <= ranges[-1][1]:
+            if code2 > ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], code2)
+        else:
+            ranges.append((code1, code2))
+    specials = specials.keys()
+    specials.sort()
+    return (tuple(ranges), tuple(specials))
+
 #
 #     Abstract classes
 #
 
-class RE:
+class RE(object):
     """RE is the base class for regular expression constructors.
     The following operators are defined on REs:
 
@@ -91,9 +159,13 @@ class RE:
          re1 | re2         is an RE which matches either |re1| or |re2|
     """
 
+    __metaclass__ = InternedClass
+
     nullable = 1 # True if this RE can match 0 input symbols
     match_nl = 1 # True if this RE can match a string ending with '\n'
     str = None     # Set to a string to override the class's __str__ result
+    first_sets = None # {nocase: first set}, filled in by first_set()
+    optimized = None  # simplified equivalent, filled in by Optimize.optimize()
 
     def build_machine(self, machine, initial_state, final_state,
                                         match_bol, nocase):
@@ -117,6 +189,29 @@ class RE:
         initial_state.add_transition(c, s)
         return s
 
+    def first_set(self, nocase = 0):
+        """
+        Return a tuple (ranges, specials) describing the input symbols which
+        can begin a non-empty match of this RE. |ranges| is a sorted tuple
+        of non-overlapping (code1, code2) character code ranges and
+        |specials| a sorted tuple of the special symbols BOL, EOL and EOF.
+        The optional BOL which may precede any RE is not included. If
+        |nocase| is true, case is ignored as by NoCase(). The result is
+        remembered.
+        """
+        first_sets = self.first_sets
+        if first_sets is None:
+            first_sets = self.first_sets = {}
+        result = first_sets.get(nocase)
+        if result is None:
+            result = self.calc_first_set(nocase)
+            first_sets[nocase] = result
+        return result
+
+    def calc_first_set(self, nocase):
+        raise NotImplementedError("%s.calc_first_set not implemented" %
+                                  self.__class__.__name__)
+
     def __add__(self, other):
         return Seq(self, other)
 
@@ -163,8 +258,7 @@ def Char(c):
         result = CodeRange(ord(c), ord(c) + 1)
     else:
         result = SpecialSymbol(c)
-    result.str = "Char(%s)" % repr(c)
-    return result
+    return labelled(result, "Char(%s)" % repr(c))
 
 class RawCodeRange(RE):
     """
@@ -193,8 +287,17 @@ class RawCodeRange(RE):
             if self.lowercase_range:
                 initial_state.add_transition(self.lowercase_range, final_state)
 
+    def calc_first_set(self, nocase):
+        ranges = [self.range]
+        if nocase:
+            if self.uppercase_range:
+                ranges.append(self.uppercase_range)
+            if self.lowercase_range:
+                ranges.append(self.lowercase_range)
+        return union_first_sets([(ranges, ())])
+
     def calc_str(self):
-        return "CodeRange(%d,%d)" % (self.code1, self.code2)
+        return "CodeRange(%d,%d)" % self.range
 
 class _RawNewline(RE):
     """
@@ -210,6 +313,9 @@ class _RawNewline(RE):
         s = self.build_opt(m, initial_state, EOL)
         s.add_transition((nl_code, nl_code + 1), final_state)
 
+    def calc_first_set(self, nocase):
+        return (((nl_code, nl_code + 1),), (EOL,))
+
 RawNewline = _RawNewline()
 
 
@@ -232,6 +338,9 @@ class SpecialSymbol(RE):
             initial_state = self.build_opt(m, initial_state, BOL)
         initial_state.add_transition(self.sym, final_state)
 
+    def calc_first_set(self, nocase):
+        return ((), (self.sym,))
+
 
 class Seq(RE):
     """Seq(re1, re2, re3...) is an RE which matches |re1| followed by
@@ -274,6 +383,14 @@ class Seq(RE):
                 s1 = s2
                 match_bol = re.match_nl or (match_bol and re.nullable)
 
+    def calc_first_set(self, nocase):
+        first_sets = []
+        for re in self.re_list:
+            first_sets.append(re.first_set(nocase))
+            if not re.nullable:
+                break
+        return union_first_sets(first_sets)
+
     def calc_str(self):
         return "Seq(%s)" % ','.join(map(str, self.re_list))
 
@@ -313,6 +430,12 @@ class Alt(RE):
             for re in self.non_nullable_res:
                 re.build_machine(m, initial_state, final_state, 0, nocase)
 
+    def calc_first_set(self, nocase):
+        first_sets = []
+        for re in self.re_list:
+            first_sets.append(re.first_set(nocase))
+        return union_first_sets(first_sets)
+
     def calc_str(self):
         return "Alt(%s)" % ','.join(map(str, self.re_list))
 
@@ -334,6 +457,9 @@ class Rep1(RE):
         s2.link_to(s1)
         s2.link_to(final_state)
 
+    def calc_first_set(self, nocase):
+        return self.re.first_set(nocase)
+
     def calc_str(self):
         return "Rep1(%s)" % self.re
 
@@ -357,6 +483,9 @@ class SwitchCase(RE):
         self.re.build_machine(m, initial_state, final_state, match_bol,
                                                     self.nocase)
 
+    def calc_first_set(self, nocase):
+        return self.re.first_set(self.nocase)
+
     def calc_str(self):
         if self.nocase:
             name = "NoCase"
@@ -371,20 +500,18 @@ class SwitchCase(RE):
 #     These REs are defined in terms of the primitive REs.
 #
 
-Empty = Seq()
+Empty = labelled(Seq(), "Empty")
 Empty.__doc__ = \
     """
     Empty is an RE which matches the empty string.
     """
-Empty.str = "Empty"
 
 def Str1(s):
     """
     Str1(s) is an RE which matches the literal string |s|.
     """
     result = apply(Seq, tuple(map(Char, s)))
-    result.str = "Str(%s)" % repr(s)
-    return result
+    return labelled(result, "Str(%s)" % repr(s))
 
 def Str(*strs):
     """
@@ -395,8 +522,7 @@ def Str(*strs):
         return Str1(strs[0])
     else:
         result = apply(Alt, tuple(map(Str1, strs)))
-        result.str = "Str(%s)" % ','.join(map(repr, strs))
-        return result
+        return labelled(result, "Str(%s)" % ','.join(map(repr, strs)))
 
 def Any(s):
     """
@@ -404,8 +530,7 @@ def Any(s):
     """
     #result = apply(Alt, tuple(map(Char, s)))
     result = CodeRanges(chars_to_ranges(s))
-    result.str = "Any(%s)" % repr(s)
-    return result
+    return labelled(result, "Any(%s)" % repr(s))
 
 def AnyBut(s):
     """
@@ -416,15 +541,13 @@ def AnyBut(s):
     ranges.insert(0, -sys.maxint)
     ranges.append(sys.maxint)
     result = CodeRanges(ranges)
-    result.str = "AnyBut(%s)" % repr(s)
-    return result
+    return labelled(result, "AnyBut(%s)" % repr(s))
 
-AnyChar = AnyBut("")
+AnyChar = labelled(AnyBut(""), "AnyChar")
 AnyChar.__doc__ = \
     """
     AnyChar is an RE which matches any single character (including a newline).
     """
-AnyChar.str = "AnyChar"
 
 def Range(s1, s2 = None):
     """
@@ -435,13 +558,13 @@ def Range(s1, s2 = None):
     """
     if s2:
         result = CodeRange(ord(s1), ord(s2) + 1)
-        result.str = "Range(%s,%s)" % (s1, s2)
+        result = labelled(result, "Range(%s,%s)" % (s1, s2))
     else:
         ranges = []
         for i in range(0, len(s1), 2):
             ranges.append(CodeRange(ord(s1[i]), ord(s1[i+1]) + 1))
         result = apply(Alt, tuple(ranges))
-        result.str = "Range(%s)" % repr(s1)
+        result = labelled(result, "Range(%s)" % repr(s1))
     return result
 
 def Opt(re):
@@ -449,23 +572,21 @@ def Opt(re):
     Opt(re) is an RE which matches either |re| or the empty string.
     """
     result = Alt(re, Empty)
-    result.str = "Opt(%s)" % re
-    return result
+    return labelled(result, "Opt(%s)" % re)
 
 def Rep(re):
     """
     Rep(re) is an RE which matches zero or more repetitions of |re|.
     """
     result = Opt(Rep1(re))
-    result.str = "Rep(%s)" % re
-    return result
+    return labelled(result, "Rep(%s)" % re)
 
 def NoCase(re):
     """
     NoCase(re) is an RE which matches the same strings as RE, but treating
     upper and lower case letters as equivalent.
     """
-    return SwitchCase(re, nocase = 1)
+    return SwitchCase(re, 1)
 
 def Case(re):
     """
@@ -473,30 +594,27 @@ def Case(re):
     upper and lower case letters as distinct, i.e. it cancels the effect
     of any enclosing NoCase().
     """
-    return SwitchCase(re, nocase = 0)
+    return SwitchCase(re, 0)
 
 #
 #     RE Constants
 #
 
-Bol = Char(BOL)
+Bol = labelled(Char(BOL), "Bol")
 Bol.__doc__ = \
     """
     Bol is an RE which matches the beginning of a line.
     """
-Bol.str = "Bol"
 
-Eol = Char(EOL)
+Eol = labelled(Char(EOL), "Eol")
 Eol.__doc__ = \
     """
     Eol is an RE which matches the end of a line.
     """
-Eol.str = "Eol"
 
-Eof = Char(EOF)
+Eof = labelled(Char(EOF), "Eof")
 Eof.__doc__ = \
     """
     Eof is an RE which matches the end of the file.
     """
-Eof.str = "Eof"
 
@@ -0,0 +1,239 @@
+"""Plex lexicon construction reports."""
+
+import sys
+
+# Construction phases, in the order they happen
+PHASES = (
+    ('nfa', "RE to NFA"),
+    ('closure', "Epsilon closures"),
+    ('subset', "Subset construction"),
+    ('tables', "Table emission"),
+)
+
+
+class StateReport:
+    """Sizes of the automata built for one user-defined state of a Lexicon."""
+
+    name = ''             # state name
+    nfa_states = 0        # NFA states reachable from the initial state
+    nfa_transitions = 0   # (event, target) pairs out of those states
+    dfa_states = 0        # DFA states reachable from the initial state
+    dfa_transitions = 0   # dict entries leading out of those states
+
+    def __init__(self, name):
+        self.name = name
+
+    def as_dict(self):
+        return {
+            'nfa_states': self.nfa_states,
+            'nfa_transitions': self.nfa_transitions,
+            'dfa_states': self.dfa_states,
+            'dfa_transitions': self.dfa_transitions,
+        }
+
+
+class BuildReport:
+    """A BuildReport records what went into constructing a Lexicon. It is
+    available as the |report| attribute of a Lexicon built with report=1.
+
+    Attributes:
+
+        phase_times     {phase: cpu_seconds} for each phase in PHASES
+        states          {state_name: StateReport}
+        nfa_states      total NFA states
+        nfa_transitions total NFA (event, target) pairs
+        nfa_ranges      total NFA character range events
+        dfa_states      total DFA states
+        dfa_transitions total DFA transition entries
+        dfa_ranges      character ranges handed to the table emitter
+        table_bytes     approximate memory used by the DFA tables
+        contributions   {token_number: DFA states whose NFA state set
+                        includes a state belonging to that token}
+        rules           [(state_name, pattern, action)] indexed by
+                        token_number - 1
+        state_tokens    [token_number] indexed by NFA state number,
+                        0 for states belonging to no token
+
+    Methods:
+
+        top_rules(n) --> [(dfa_states, token_number, pattern_str)]
+        as_dict() --> dict suitable for serialising
+        dump(file)
+    """
+
+    nfa_states = 0
+    nfa_transitions = 0
+    nfa_ranges = 0
+    dfa_states = 0
+    dfa_transitions = 0
+    dfa_ranges = 0
+    table_bytes = 0
+
+    def __init__(self):
+        self.phase_times = {}
+        for phase, _ in PHASES:
+            self.phase_times[phase] = 0.0
+        self.states = {}
+        self.contributions = {}
+        self.rules = []
+        self.state_tokens = []
+
+    def add_time(self, phase, seconds):
+        self.phase_times[phase] = self.phase_times[phase] + seconds
+
+    def total_time(self):
+        total = 0.0
+        for phase, _ in PHASES:
+            total = total + self.phase_times[phase]
+        return total
+
+    def analyse_nfa(self, nfa):
+        """Record the sizes of the NFA |nfa|."""
+        transitions = 0
+        ranges = 0
+        for state in nfa.states:
+            for event, targets in state.transitions.items():
+                transitions = transitions + len(targets)
+                if isinstance(event, tuple):
+                    ranges = ranges + 1
+        self.nfa_states = len(nfa.states)
+        self.nfa_transitions = transitions
+        self.nfa_ranges = ranges
+        for name, initial_state in nfa.initial_states.items():
+            state_report = self.get_state(name)
+            seen = {}
+            todo = [initial_state]
+            while todo:
+                state = todo.pop()
+                if state in seen:
+                    continue
+                seen[state] = 1
+                for event, targets in state.transitions.items():
+                    state_report.nfa_transitions = \
+                        state_report.nfa_transitions + len(targets)
+                    todo.extend(targets.keys())
+            state_report.nfa_states = len(seen)
+
+    def analyse_dfa(self, dfa):
+        """Record the sizes of the FastMachine |dfa|."""
+        self.dfa_states = len(dfa.states)
+        transitions = 0
+        table_bytes = sys.getsizeof(dfa.states)
+        for state in dfa.states:
+            transitions = transitions + count_dfa_transitions(state)
+            table_bytes = table_bytes + sys.getsizeof(state)
+        self.dfa_transitions = transitions
+        self.table_bytes = table_bytes
+        for name, initial_state in dfa.initial_states.items():
+            state_report = self.get_state(name)
+            seen = {}
+            todo = [initial_state]
+            while todo:
+                state = todo.pop()
+                if id(state) in seen:
+                    continue
+                seen[id(state)] = 1
+                state_report.dfa_transitions = \
+                    state_report.dfa_transitions + count_dfa_transitions(state)
+                for key, target in state.items():
+                    if isinstance(target, dict):
+                        todo.append(target)
+            state_report.dfa_states = len(seen)
+
+    def analyse_state_sets(self, state_sets):
+        """Count, for each token, the DFA states built from NFA state sets
+        which include one of its NFA states. |state_sets| is a list of NFA
+        state sets, one per DFA state.
+        """
+        count_contributions(self.contributions, state_sets, self.state_tokens)
+
+    def get_state(self, name):
+        state_report = self.states.get(name)
+        if state_report is None:
+            state_report = StateReport(name)
+            self.states[name] = state_report
+        return state_report
+
+    def top_rules(self, n=10):
+        """Return a list of up to |n| tuples (dfa_states, token_number,
+        pattern_str) for the tokens contributing most DFA states, largest
+        first.
+        """
+        return top_rules(self.contributions, self.rules, n)
+
+    def as_dict(self):
+        states = {}
+        for name, state_report in self.states.items():
+            states[name] = state_report.as_dict()
+        return {
+            'phase_times': self.phase_times.copy(),
+            'states': states,
+            'nfa_states': self.nfa_states,
+            'nfa_transitions': self.nfa_transitions,
+            'nfa_ranges': self.nfa_ranges,
+            'dfa_states': self.dfa_states,
+            'dfa_transitions': self.dfa_transitions,
+            'dfa_ranges': self.dfa_ranges,
+            'table_bytes': self.table_bytes,
+            'top_rules': self.top_rules(),
+        }
+
+    def dump(self, file):
+        file.write("Plex.BuildReport:\n")
+        file.write("   Phases (cpu seconds):\n")
+        for phase, description in PHASES:
+            file.write("      %-20s %7.2f\n" % (
+                description, self.phase_times[phase]))
+        file.write("      %-20s %7.2f\n" % ("TOTAL", self.total_time()))
+        file.write("   NFA: %d states, %d transitions, %d ranges\n" % (
+            self.nfa_states, self.nfa_transitions, self.nfa_ranges))
+        file.write("   DFA: %d states, %d transitions, %d ranges, "
+                   "~%d bytes\n" % (self.dfa_states, self.dfa_transitions,
+                                    self.dfa_ranges, self.table_bytes))
+        file.write("   States:\n")
+        names = self.states.keys()
+        names.sort()
+        for name in names:
+            s = self.states[name]
+            file.write("      %-12s NFA %d/%d  DFA %d/%d\n" % (
+                repr(name), s.nfa_states, s.nfa_transitions,
+                s.dfa_states, s.dfa_transitions))
+        file.write("   Top rules by DFA states:\n")
+        for count, token_number, re_str in self.top_rules():
+            file.write("      %6d  token %d: %s\n" % (
+                count, token_number, re_str))
+
+
+def count_contributions(contributions, state_sets, state_tokens):
+    """Add to |contributions| ({token_number: count}) one for each token
+    owning a state in each of the NFA state sets in |state_sets|.
+    |state_tokens| maps NFA state numbers to token numbers.
+    """
+    for state_set in state_sets:
+        tokens = {}
+        for state in state_set:
+            tokens[state_tokens[state.number]] = 1
+        for token_number in tokens:
+            if token_number:
+                contributions[token_number] = \
+                    contributions.get(token_number, 0) + 1
+
+def top_rules(contributions, rules, n):
+    """Return a list of up to |n| tuples (count, token_number, pattern_str)
+    from |contributions|, largest first. |rules| is the rules list of the
+    Lexicon.
+    """
+    result = []
+    for token_number, count in contributions.items():
+        re = rules[token_number - 1][1]
+        result.append((count, token_number, str(re)))
+    result.sort(lambda a, b: cmp(b[0], a[0]) or cmp(a[1], b[1]))
+    return result[:n]
+
+def count_dfa_transitions(state):
+    """Count the transition entries of a FastMachine state."""
+    n = 0
+    for key, target in state.items():
+        if target is not None and key != 'action' and key != 'number':
+            n = n + 1
+    return n
@@ -7,8 +7,14 @@
 #
 #=======================================================================
 
+import copy
+import time
+
+import Actions
 import Errors
+from Actions import DISCARD, IGNORE
 from Regexps import BOL, EOL, EOF
+from Tokens import TokenText
 
 class Scanner:
     """
@@ -29,6 +35,9 @@ class Scanner:
         read() --> (value, text)
             Reads the next lexical token from the stream.
 
+        reset(stream, name = '')
+            Starts scanning a new stream or string.
+
         position() --> (name, line, col)
             Returns the position of the last token read using the
             read() method.
@@ -40,6 +49,95 @@ class Scanner:
             Causes return of a token value to the caller of the
             Scanner.
 
+        checkpoint() --> dict
+            Records the Scanner's progress, for restore() or resume().
+
+        feed(data) --> [(value, text), ...]
+            Gives the Scanner more input and returns the tokens now
+            complete.
+
+        close()
+            Signals the end of the input given by feed() or of a stream
+            read in follow mode.
+
+    Engines:
+
+        Setting the |engine| attribute to 're' before reading any tokens
+        makes the Scanner match tokens with Python re patterns wherever
+        that is known to give the same result as the Lexicon's DFA (see
+        Plex.Patterns), which is faster for long tokens. The whole input
+        is read into memory, as re can only match complete strings.
+
+        Setting it to 'classes' makes the Scanner translate each block
+        of input into character class ids (see Plex.CharClasses) and
+        run the DFA on those, which avoids hashing every character.
+        The input must be a byte string.
+
+        An input the engine cannot handle, such as a unicode string, is
+        scanned with 'dfa' instead, leaving |engine| as it is for the
+        next input given to reset().
+
+    Recovery mode:
+
+        Setting the |error_token| attribute to a value other than None
+        makes the Scanner return unrecognised input as a token with
+        that value, instead of raising UnrecognizedInput. The error
+        token covers the input up to the next position at which a token
+        can be recognised, and the |errors| attribute counts them.
+
+    Follow mode:
+
+        Setting the |follow| attribute to true makes the Scanner treat
+        an empty read as meaning that there is no more data yet, like
+        tail -f, rather than as the end of the input. It waits and reads
+        again, keeping any partly matched token pending, until close()
+        is called, so the end of the input (including Eof) is only seen
+        after that. The 're' engine is not used, as it needs the whole
+        input.
+
+    Search mode:
+
+        Setting the |search| attribute to true makes the Scanner skip
+        over any input that does not begin a token, instead of raising
+        UnrecognizedInput, so that read() returns only the tokens found
+        in the text. The |skipped| attribute counts the characters
+        skipped. Where it can, the Scanner searches the buffer for the
+        next place a token could begin, using a single re pattern
+        built from the beginnings of the token patterns (see
+        Plex.Patterns), rather than trying the DFA at every character.
+        See also Lexicon.search().
+
+    Line cache mode:
+
+        Setting the |line_cache| attribute to a Caches.LineCache makes
+        the Scanner look up each whole line of input, with the name of
+        the state it starts in, in the cache, and replay the tokens
+        found there, with their positions moved to the current line,
+        instead of scanning the line again. Lines are only cached if
+        Lexicon.line_cacheable() says that no token can run on past a
+        newline and no action calls a function not marked with
+        Actions.pure(); otherwise the Scanner scans as usual. It is not
+        used in search or recovery mode.
+
+    Lazy text mode:
+
+        Setting the |lazy_text| attribute to true makes the Scanner
+        give each token's text as a Tokens.TokenText, which refers to
+        the text in the buffer by its position and only copies it out
+        when asked for it with text() or str(). Actions are passed the
+        TokenText too. The text of tokens whose action is IGNORE is not
+        taken at all. This saves copying the text of long tokens whose
+        text is not used, at the cost of keeping the buffers they were
+        read from alive as long as their TokenTexts are.
+
+    Token records:
+
+        Setting the |token_class| attribute to Tokens.Token (or a
+        subclass taking the same arguments) makes read() return a Token
+        for each token, giving its start and end offsets, lines and
+        columns and the state it was scanned in, instead of a (value,
+        text) tuple. A Token unpacks like the tuple.
+
     """
 
     buffer = ''
@@ -56,31 +154,105 @@ class Scanner:
     state_name = ''       # Name of initial state
     queue = None          # list of tokens to be returned
     trace = 0
+    engine = 'dfa'        # 'dfa', 're' (see run_re()) or 'classes'
+                          # (see run_machine_classes())
+    input_engine = None   # engine used in place of |engine| for the
+                          # current input, which it cannot handle
+    input_complete = 0    # true when the whole stream is in the buffer
+    pattern_table = None  # {char: (match, action)} for the current state
+    classes = None        # bytearray of the class ids of the buffer
+    class_machine = None  # CharClasses.ClassMachine
+    initial_row = None    # row of the ClassMachine for the current state
+    search = 0            # true to skip unrecognised input
+    skipped = 0           # characters skipped in search mode
+    prefilter = None      # Patterns.Prefilter for the current state
+    error_token = None    # value of error tokens in recovery mode
+    checkpoint_attributes = () # names of attributes saved by checkpoint()
+    follow = 0            # true to wait for a growing stream
+    closed = 0            # true once close() has been called
+    poll_interval = 0.1   # seconds between reads in follow mode
+    read_size = 0x1000    # characters to read from the stream at a time
+    errors = 0            # number of error tokens produced
+    recovering = 0        # true while recover() waits for input to feed()
+    line_cache = None     # Caches.LineCache in line cache mode
+    line_tokens = None    # [(value, text, col, end, start_state)] of the
+                          # line being read, |end| relative to its start
+    token_line = 0        # line number of the tokens in line_tokens
+    token_line_pos = 0    # position in input of the start of that line
+    token_line_length = 0 # length of that line, including the newline
+    lazy_text = 0         # true to give token text as Tokens.TokenText
+    token_class = None    # Tokens.Token or a subclass, to return records
+    start_state = ''      # name of the state the last token was scanned in
 
-    def __init__(self, lexicon, stream, name=''):
+    def __init__(self, lexicon, stream, name='', only=None):
         """
-        Scanner(lexicon, stream, name = '')
+        Scanner(lexicon, stream, name = '', only = None)
 
             |lexicon| is a Plex.Lexicon instance specifying the lexical tokens
             to be recognised.
 
             |stream| can be a file object or anything which implements a
-            compatible read() method.
+            compatible read() method, or None if the input is to be
+            given using feed().
 
             |name| is optional, and may be the name of the file being
             scanned or any other identifying string.
+
+            |only| is optional, and may be a collection of the values
+            and numbers of the only tokens to be returned, as for
+            Lexicon.project(). The text of the other tokens is not taken
+            and their actions are not performed, except for Begin and
+            calls of functions marked with Actions.side_effect().
         """
+        if only is not None:
+            lexicon = lexicon.project(only)
         self.lexicon = lexicon
-        self.stream = stream
-        self.name = name
-        self.queue = []
         self.initial_state = None
         self.begin('')
+        self.reset(stream, name)
+
+    def reset(self, stream, name=''):
+        """
+        Start scanning |stream| from the beginning, in the default
+        state, as though the Scanner had just been created for it.
+        |stream| may also be a string, which is then scanned directly,
+        so that one Scanner can be reused cheaply for many small inputs.
+        """
+        if isinstance(stream, basestring):
+            self.buffer = stream
+            self.stream = exhausted_stream
+            self.input_complete = 1
+            if isinstance(stream, str):
+                self.input_engine = None
+            else:
+                # As in read_all()
+                self.input_engine = 'dfa'
+        else:
+            self.buffer = ''
+            self.stream = stream
+            self.input_complete = 0
+            self.input_engine = None
+            # The re patterns are only used on complete input
+            self.pattern_table = None
+        self.name = name
+        self.queue = []
+        self.line_tokens = []
+        self.prefilter = None
+        if self.state_name != '':
+            self.begin('')
+        self.buf_start_pos = 0
         self.next_pos = 0
         self.cur_pos = 0
+        self.cur_line = 1
         self.cur_line_start = 0
+        self.start_pos = 0
+        self.skipped = 0
+        self.errors = 0
+        self.recovering = 0
+        self.closed = 0
         self.cur_char = BOL
         self.input_state = 1
+        self.classes = None
 
     def read(self):
         """
@@ -88,9 +260,14 @@ class Scanner:
         tuple (value, text), where |value| is the value associated with
         the token as specified by the Lexicon, and |text| is the actual
         string read from the stream. Returns (None, '') on end of file.
+        Returns a |token_class| record instead if that is set.
         """
         queue = self.queue
         while not queue:
+            if self.line_cache is not None:
+                token = self.read_cached_line()
+                if token is not None:
+                    return token
             self.text, action = self.scan_a_token()
             if action is None:
                 self.produce(None)
@@ -103,32 +280,330 @@ class Scanner:
         del queue[0]
         return result
 
+    def read_cached_line(self):
+        """
+        Version of read() for line cache mode, which returns the next
+        token of the line being read, going on to the next line at the
+        start of a line, or None if the line cannot be cached.
+        """
+        line_tokens = self.line_tokens
+        while not line_tokens:
+            if not (self.cur_char == BOL and self.input_state == 1
+                    and self.cur_pos == self.cur_line_start):
+                return None
+            if self.search or self.error_token is not None \
+                    or not self.lexicon.line_cacheable():
+                self.line_cache.bypassed = self.line_cache.bypassed + 1
+                return None
+            if not self.scan_a_line():
+                return None
+        value, text, col, end, start_state = line_tokens.pop(0)
+        line = self.start_line = self.token_line
+        self.start_col = col
+        token_class = self.token_class
+        if token_class is None:
+            return (value, text)
+        pos = self.token_line_pos
+        if end == self.token_line_length:
+            end_line = line + 1
+            end_col = 0
+        else:
+            end_line = line
+            end_col = end
+        return token_class(value, text, pos + col, pos + end, line, col,
+                           end_line, end_col, start_state)
+
+    def scan_a_line(self):
+        """
+        Put the tokens of the line beginning at the current position
+        into |line_tokens|, from the line cache if it is there, or
+        else by scanning it, and move on to the start of the next line.
+        Returns false if the rest of the input has no newline.
+        """
+        base = self.buf_start_pos
+        i = self.cur_pos - base
+        j = self.buffer.find('\n', i)
+        while j < 0:
+            if self.input_complete:
+                return 0
+            data = self.stream.read(self.read_size)
+            if not data:
+                return 0
+            discard = self.start_pos - base
+            j = len(self.buffer) - discard
+            self.buffer = self.buffer[discard:] + data
+            base = self.buf_start_pos = base + discard
+            self.classes = None
+            i = i - discard
+            j = self.buffer.find('\n', j)
+        line_cache = self.line_cache
+        key = (self.state_name, self.buffer[i:j + 1])
+        entry = line_cache.get(key)
+        self.token_line = self.cur_line
+        line_pos = self.token_line_pos = base + i
+        self.token_line_length = j + 1 - i
+        if entry is not None:
+            tokens, state_name = entry
+            self.line_tokens.extend(tokens)
+            self.jump_to(base + j + 1)
+            if state_name != self.state_name:
+                self.begin(state_name)
+            return 1
+        # Scan the line. If there is an error, the tokens read so far
+        # are returned first, and the line is not cached; read() then
+        # scans on from the error without the cache, raising it again.
+        end_pos = base + j + 1
+        line_tokens = self.line_tokens
+        queue = self.queue
+        while self.cur_pos < end_pos:
+            try:
+                self.text, action = self.scan_a_token()
+            except Errors.UnrecognizedInput:
+                if line_tokens:
+                    return 1
+                raise
+            if action is None:
+                break
+            value = action.perform(self, self.text)
+            if value is not None:
+                self.produce(value)
+            col = self.start_col
+            end = self.cur_pos - line_pos
+            for value, text in queue:
+                line_tokens.append((value, text, col, end, self.start_state))
+            del queue[:]
+        line_cache.put(key, (line_tokens[:], self.state_name))
+        return 1
+
     def scan_a_token(self):
         """
         Read the next input sequence recognised by the machine
         and return (text, action). Returns ('', None) on end of
         file.
         """
+        if self.search:
+            return self.search_a_token()
+        if self.recovering:
+            # Carry on with the error token begun before feed() ran
+            # out of input
+            return self.recover()
         self.start_pos = self.cur_pos
         self.start_line = self.cur_line
         self.start_col = self.cur_pos - self.cur_line_start
+        self.start_state = self.state_name
 
-        action = self.run_machine_inlined()
+        engine = self.input_engine or self.engine
+        if engine == 'dfa':
+            action = self.run_machine_inlined()
+        elif engine == 're':
+            action = self.run_re()
+        else:
+            action = self.run_machine_classes()
         if action:
             if self.trace:
                 print "Scanner: read: Performing", action, "%d:%d" % (
                     self.start_pos, self.cur_pos)
+            if action is DISCARD:
+                return ('', action)
             base = self.buf_start_pos
-            text = self.buffer[self.start_pos - base : self.cur_pos - base]
+            if self.lazy_text:
+                if action is IGNORE:
+                    return ('', action)
+                start_pos = self.start_pos
+                text = TokenText(self.buffer, start_pos - base, start_pos,
+                                 self.cur_pos - start_pos)
+            else:
+                text = self.buffer[self.start_pos - base : self.cur_pos - base]
             return (text, action)
         else:
             if self.cur_pos == self.start_pos:
+                if self.cur_char == BOL:
+                    self.next_char()
                 if self.cur_char == EOL:
                     self.next_char()
                 if not self.cur_char or self.cur_char == EOF:
                     return ('', None)
+            if self.error_token is not None:
+                return self.recover()
             raise Errors.UnrecognizedInput(self, self.state_name)
 
+    def count_tokens(self, counts):
+        """
+        Scan the rest of the input with a Lexicon made by
+        Lexicon.count_tokens(), whose actions are all Actions.Count,
+        adding 1 to counts[n] for each token number n recognised. Text
+        is only taken for actions still to be performed.
+        """
+        run_engine = self.run_engine
+        while 1:
+            self.start_pos = self.cur_pos
+            line = self.cur_line
+            line_start = self.cur_line_start
+            action = run_engine()
+            if action:
+                counts[action.token_number] += 1
+                if action.action is not None:
+                    self.perform_counted(action, line, line_start)
+            elif self.end_of_input(line, line_start):
+                return
+
+    def scan_columns(self, columns, recorded):
+        """
+        Version of count_tokens() for Lexicon.scan_columns(), which
+        appends each token recognised whose number n has recorded[n]
+        true to the Columns.TokenColumns |columns|.
+        """
+        run_engine = self.run_engine
+        add_rule = columns.rule.append
+        add_start = columns.start.append
+        add_end = columns.end.append
+        add_line = columns.line.append
+        add_col = columns.col.append
+        while 1:
+            start_pos = self.start_pos = self.cur_pos
+            line = self.cur_line
+            line_start = self.cur_line_start
+            action = run_engine()
+            if action:
+                token_number = action.token_number
+                if recorded[token_number]:
+                    add_rule(token_number)
+                    add_start(start_pos)
+                    add_end(self.cur_pos)
+                    add_line(line)
+                    add_col(start_pos - line_start)
+                if action.action is not None:
+                    self.perform_counted(action, line, line_start)
+            elif self.end_of_input(line, line_start):
+                return
+
+    def perform_counted(self, action, line, line_start):
+        # Perform the action kept by the Actions.Count |action| for the
+        # token just recognised, which began on |line|
+        self.start_line = line
+        self.start_col = self.start_pos - line_start
+        base = self.buf_start_pos
+        self.text = text = self.buffer[
+            self.start_pos - base : self.cur_pos - base]
+        action.action.perform(self, text)
+
+    def end_of_input(self, line, line_start):
+        """Called by count_tokens() and scan_columns() when no token
+        is recognised at |start_pos|, which is on |line|. Returns true
+        at the end of the input, and otherwise raises UnrecognizedInput
+        as scan_a_token() does."""
+        if self.cur_pos == self.start_pos:
+            if self.cur_char == BOL:
+                self.next_char()
+            if self.cur_char == EOL:
+                self.next_char()
+            if not self.cur_char or self.cur_char == EOF:
+                return 1
+        self.start_line = line
+        self.start_col = self.start_pos - line_start
+        raise Errors.UnrecognizedInput(self, self.state_name)
+
+    def search_a_token(self):
+        """
+        Version of scan_a_token() for search mode, which moves on by one
+        character (or BOL, EOL) wherever no token can be recognised.
+        """
+        while 1:
+            cur_pos = self.start_pos = self.cur_pos
+            self.start_line = self.cur_line
+            self.start_col = cur_pos - self.cur_line_start
+            self.start_state = self.state_name
+            action = self.run_engine()
+            if action is DISCARD:
+                return ('', action)
+            if action:
+                base = self.buf_start_pos
+                text = self.buffer[self.start_pos - base : self.cur_pos - base]
+                return (text, action)
+            if self.input_state >= 4:
+                return ('', None)
+            self.skip_unrecognised()
+            self.skipped = self.skipped + self.cur_pos - cur_pos
+
+    def recover(self):
+        """
+        Called by scan_a_token() in recovery mode when no token can be
+        recognised. Moves on to the next position where one can, and
+        returns (text, action) for an error token covering the text
+        skipped. If the Scanner runs out of input given by feed(), the
+        error token is carried on by the next call.
+        """
+        if not self.recovering:
+            self.errors = self.errors + 1
+            self.recovering = 1
+        while 1:
+            cur_pos = self.cur_pos
+            cur_line = self.cur_line
+            cur_line_start = self.cur_line_start
+            cur_char = self.cur_char
+            input_state = self.input_state
+            next_pos = self.next_pos
+            if self.run_engine():
+                self.cur_pos = cur_pos
+                self.cur_line = cur_line
+                self.cur_line_start = cur_line_start
+                self.cur_char = cur_char
+                self.input_state = input_state
+                self.next_pos = next_pos
+                break
+            if input_state >= 4:
+                break
+            self.skip_unrecognised()
+        self.recovering = 0
+        base = self.buf_start_pos
+        text = self.buffer[self.start_pos - base : self.cur_pos - base]
+        return (text, Actions.Return(self.error_token))
+
+    def run_engine(self):
+        """Run the machine using the current engine, as scan_a_token()
+        does."""
+        engine = self.input_engine or self.engine
+        if engine == 'dfa':
+            return self.run_machine_inlined()
+        elif engine == 're':
+            return self.run_re()
+        else:
+            return self.run_machine_classes()
+
+    def skip_unrecognised(self):
+        """Move on by one character, BOL or EOL, and then to where the
+        Prefilter of the current state says a token could begin."""
+        self.next_char()
+        prefilter = self.prefilter
+        if prefilter is None:
+            prefilter = self.get_prefilter()
+        if prefilter:
+            self.skip_to_candidate(prefilter)
+
+    def get_prefilter(self):
+        """Return the Patterns.Prefilter for the current state, or 0 if
+        there is none."""
+        prefilter = self.lexicon.get_prefilters().get(self.state_name)
+        if prefilter is None or not isinstance(self.buffer, str):
+            # The patterns only know about byte strings
+            prefilter = 0
+        self.prefilter = prefilter
+        return prefilter
+
+    def skip_to_candidate(self, prefilter):
+        """Jump to the next position in the buffer where the Prefilter
+        |prefilter| says a token could begin."""
+        buffer = self.buffer
+        i = self.cur_pos - self.buf_start_pos
+        m = prefilter.search(buffer, i)
+        if m is not None and m.start() < len(buffer):
+            j = m.start()
+        else:
+            # A token could begin too near the end to be matched
+            j = len(buffer) - prefilter.width
+        if j > i:
+            self.jump_to(self.buf_start_pos + j)
+
     def run_machine(self):
         """
         Run the machine until no more transitions are possible.
@@ -185,7 +660,9 @@ class Scanner:
                         next_pos = next_pos + 1
                     else:
                         discard = self.start_pos - buf_start_pos
-                        data = self.stream.read(0x1000)
+                        data = self.stream.read(self.read_size)
+                        if not data and self.follow:
+                            data = self.wait_for_data()
                         buffer = self.buffer[discard:] + data
                         self.buffer = buffer
                         buf_start_pos = buf_start_pos + discard
@@ -228,7 +705,8 @@ class Scanner:
                     (action, cur_pos, cur_line, cur_line_start,
                         cur_char, input_state, next_pos) = backup_state
                 else:
-                    action = None
+                    # Leave the Scanner where the token would have begun
+                    return None
                 break # while 1
                 # End inlined: action = self.back_up()
         self.cur_pos = cur_pos
@@ -242,13 +720,312 @@ class Scanner:
                 print "Doing", action #TRACE#
         return action
 
+    def run_machine_classes(self):
+        """
+        Version of run_machine_inlined() which looks up transitions in
+        the rows of the Lexicon's ClassMachine, indexed by the class ids
+        of the input characters.
+        """
+        row = self.initial_row
+        if row is None:
+            row = self.get_initial_row()
+            if row is None:
+                return self.run_machine_inlined()
+        class_machine = self.class_machine
+        translation = class_machine.translation
+        action_index = class_machine.action_index
+        newline_class = class_machine.newline_class
+        bol_class = class_machine.bol_class
+        eol_class = class_machine.eol_class
+        eof_class = class_machine.eof_class
+        end_class = class_machine.end_class
+        cur_pos = self.cur_pos
+        cur_line = self.cur_line
+        cur_line_start = self.cur_line_start
+        cur_class = class_machine.classes[self.cur_char]
+        input_state = self.input_state
+        next_pos = self.next_pos
+        buffer = self.buffer
+        classes = self.classes
+        if classes is None or len(classes) != len(buffer):
+            classes = self.classes = bytearray(buffer.translate(translation))
+        buf_start_pos = self.buf_start_pos
+        buf_len = len(buffer)
+        backup_state = None
+        while 1:
+            action = row[action_index]
+            if action:
+                backup_state = (
+                    action, cur_pos, cur_line, cur_line_start, cur_class, input_state, next_pos)
+            new_row = row[cur_class]
+            if new_row:
+                row = new_row
+                # Begin inlined: self.next_char()
+                if input_state == 1:
+                    cur_pos = next_pos
+                    buf_index = next_pos - buf_start_pos
+                    if buf_index < buf_len:
+                        cur_class = classes[buf_index]
+                        next_pos = next_pos + 1
+                    else:
+                        discard = self.start_pos - buf_start_pos
+                        data = self.stream.read(self.read_size)
+                        if not data and self.follow:
+                            data = self.wait_for_data()
+                        if type(data) is not str:
+                            raise Errors.PlexTypeError(
+                                "The 'classes' engine needs byte string input")
+                        buffer = self.buffer[discard:] + data
+                        self.buffer = buffer
+                        classes = classes[discard:] + bytearray(
+                            data.translate(translation))
+                        self.classes = classes
+                        buf_start_pos = buf_start_pos + discard
+                        self.buf_start_pos = buf_start_pos
+                        buf_len = len(buffer)
+                        buf_index = buf_index - discard
+                        if data:
+                            cur_class = classes[buf_index]
+                            next_pos = next_pos + 1
+                        else:
+                            cur_class = end_class
+                    if cur_class == end_class:
+                        cur_class = eol_class
+                        input_state = 4
+                    elif cur_class == newline_class:
+                        cur_class = eol_class
+                        input_state = 2
+                elif input_state == 2:
+                    cur_class = newline_class
+                    input_state = 3
+                elif input_state == 3:
+                    cur_line = cur_line + 1
+                    cur_line_start = cur_pos = next_pos
+                    cur_class = bol_class
+                    input_state = 1
+                elif input_state == 4:
+                    cur_class = eof_class
+                    input_state = 5
+                else: # input_state = 5
+                    cur_class = end_class
+                # End inlined self.next_char()
+            else: # not new_row
+                if backup_state:
+                    (action, cur_pos, cur_line, cur_line_start,
+                        cur_class, input_state, next_pos) = backup_state
+                else:
+                    return None
+                break # while 1
+        self.cur_pos = cur_pos
+        self.cur_line = cur_line
+        self.cur_line_start = cur_line_start
+        if input_state == 1:
+            if cur_class == bol_class:
+                self.cur_char = BOL
+            else:
+                self.cur_char = buffer[cur_pos - buf_start_pos]
+        elif input_state == 2 or input_state == 4:
+            self.cur_char = EOL
+        elif input_state == 3:
+            self.cur_char = '\n'
+        elif cur_class == eof_class:
+            self.cur_char = EOF
+        else:
+            self.cur_char = ''
+        self.input_state = input_state
+        self.next_pos = next_pos
+        return action
+
+    def get_initial_row(self):
+        """Return the row of the ClassMachine for the current state, or
+        None if the Lexicon has no ClassMachine or tracing is on."""
+        class_machine = self.lexicon.get_class_machine()
+        if class_machine is None or self.trace:
+            return None
+        self.class_machine = class_machine
+        self.initial_row = class_machine.rows[id(self.initial_state)]
+        return self.initial_row
+
+    def run_re(self):
+        """
+        Version of run_machine_inlined() which matches the token using
+        a Python re pattern of the Lexicon if there is one for the current
+        state and character, and runs the machine otherwise.
+        """
+        table = self.pattern_table
+        if table is None:
+            table = self.get_pattern_table()
+        if self.input_state <= 2:
+            buffer = self.buffer
+            i = self.cur_pos - self.buf_start_pos
+            entry = table.get(buffer[i:i+1])
+            if entry is not None:
+                m = entry[0](buffer, i)
+                if m is not None:
+                    end = m.end()
+                    if end > i:
+                        self.jump_to(self.buf_start_pos + end)
+                        return entry[1]
+        return self.run_machine_inlined()
+
+    def get_pattern_table(self):
+        """Return the table of re patterns for the current state, as
+        described in Plex.Patterns, reading the input first if need be."""
+        if self.follow or isinstance(self.stream, FeedStream):
+            # The input is never complete
+            self.input_engine = 'dfa'
+        elif not self.input_complete:
+            self.read_all()
+        state_patterns = self.lexicon.get_patterns().get(self.state_name)
+        if state_patterns is None or self.trace or self.input_engine:
+            table = {}
+        else:
+            table = state_patterns.table
+        self.pattern_table = table
+        return table
+
+    def read_all(self):
+        """Read the rest of the stream into the buffer."""
+        discard = self.start_pos - self.buf_start_pos
+        chunks = [self.buffer[discard:]]
+        while 1:
+            data = self.stream.read(max(self.read_size, 0x10000))
+            if not data:
+                break
+            chunks.append(data)
+        self.buffer = ''.join(chunks)
+        self.buf_start_pos = self.buf_start_pos + discard
+        self.input_complete = 1
+        if not isinstance(self.buffer, str):
+            # The patterns only know about byte strings
+            self.input_engine = 'dfa'
+
+    def jump_to(self, pos):
+        """
+        Move on to position |pos| of the input, which must be in the
+        buffer, as though the machine had matched the characters
+        from the current position up to it.
+        """
+        buffer = self.buffer
+        base = self.buf_start_pos
+        i = self.cur_pos - base
+        j = pos - base
+        lines = buffer.count('\n', i, j)
+        if lines:
+            self.cur_line = self.cur_line + lines
+            self.cur_line_start = base + buffer.rfind('\n', i, j) + 1
+        self.cur_pos = pos
+        if j > i and buffer[j - 1] == '\n':
+            self.cur_char = BOL
+            self.input_state = 1
+            self.next_pos = pos
+        elif j < len(buffer):
+            c = buffer[j]
+            if c == '\n':
+                self.cur_char = EOL
+                self.input_state = 2
+            else:
+                self.cur_char = c
+                self.input_state = 1
+            self.next_pos = pos + 1
+        else:
+            self.cur_char = EOL
+            self.input_state = 4
+            self.next_pos = pos
+
+    def read_char(self):
+        """Read the next character of the input, refilling the buffer
+        if need be, and return it, or '' at end of file."""
+        buf_index = self.next_pos - self.buf_start_pos
+        if buf_index >= len(self.buffer):
+            discard = self.start_pos - self.buf_start_pos
+            data = self.stream.read(self.read_size)
+            if not data and self.follow:
+                data = self.wait_for_data()
+            self.buffer = self.buffer[discard:] + data
+            self.buf_start_pos = self.buf_start_pos + discard
+            self.classes = None
+            buf_index = buf_index - discard
+            if not data:
+                return ''
+        self.next_pos = self.next_pos + 1
+        return self.buffer[buf_index]
+
+    def wait_for_data(self):
+        """
+        Called in follow mode when the stream has no more data. Waits
+        for more, using wait_for_input(), and returns it, or returns ''
+        once close() has been called.
+        """
+        while not self.closed:
+            self.wait_for_input()
+            data = self.stream.read(self.read_size)
+            if data:
+                return data
+        return ''
+
+    def wait_for_input(self):
+        """
+        Override this method to wait for the stream to grow in some
+        better way than sleeping for |poll_interval| seconds.
+        """
+        time.sleep(self.poll_interval)
+
+    def feed(self, data):
+        """
+        Give the Scanner more input, for a Scanner created with None
+        as its stream, and return a list of the (value, text) tokens
+        which are now complete. A token which more data could extend is
+        held back until the next call of feed() or close(). Only the
+        text of tokens not yet complete is kept. If some of the data
+        cannot be recognised, the tokens completed before it are
+        returned, and UnrecognizedInput is raised by the next call.
+        """
+        stream = self.stream
+        if not isinstance(stream, FeedStream):
+            stream = self.stream = FeedStream()
+        if data:
+            stream.chunks.append(data)
+        tokens = []
+        while 1:
+            try:
+                token = self.read()
+            except Starved:
+                return tokens
+            except Errors.UnrecognizedInput:
+                # The Scanner stays where the error is, so reading
+                # again raises it again
+                if tokens:
+                    return tokens
+                raise
+            tokens.append(token)
+            if token[0] is None:
+                return tokens
+
+    def close(self):
+        """
+        Signal the end of the input. For a Scanner given its input by
+        feed(), returns a list of the remaining tokens, ending with
+        (None, ''). In follow mode, stops waiting for more input, so
+        that the end of the stream is treated as the end of the input;
+        this may be done from another thread or from wait_for_input().
+        """
+        self.closed = 1
+        if self.stream is None:
+            # Given no input at all
+            self.stream = FeedStream()
+        if isinstance(self.stream, FeedStream):
+            self.stream.closed = 1
+            return self.feed('')
+
     def next_char(self):
         input_state = self.input_state
         if self.trace:
             print "Scanner: next:", " "*20, "[%d] %d" % (input_state, self.cur_pos),
         if input_state == 1:
-            self.cur_pos = self.next_pos
+            cur_pos = self.next_pos
             c = self.read_char()
+            self.cur_pos = cur_pos
             if c == '\n':
                 self.cur_char = EOL
                 self.input_state = 2
@@ -273,6 +1050,90 @@ class Scanner:
         if self.trace:
             print "--> [%d] %d %s" % (input_state, self.cur_pos, repr(self.cur_char))
 
+    def checkpoint(self):
+        """
+        Return a dictionary recording where the Scanner has got to, from
+        which restore() can carry on scanning the same input. It holds
+        only strings, numbers and the queued tokens, and copies of the
+        attributes named in |checkpoint_attributes|, so it can be pickled
+        if they can. It should be taken between calls to read().
+        """
+        attributes = {}
+        for name in self.checkpoint_attributes:
+            attributes[name] = copy.deepcopy(getattr(self, name))
+        return {
+            'pos': self.cur_pos,
+            'next_pos': self.next_pos,
+            'line': self.cur_line,
+            'col': self.cur_pos - self.cur_line_start,
+            'position': (self.start_line, self.start_col),
+            'cur_char': self.cur_char,
+            'input_state': self.input_state,
+            'state_name': self.state_name,
+            'queue': self.queue[:],
+            'line_tokens': (self.token_line, self.token_line_pos,
+                            self.token_line_length, self.line_tokens[:]),
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'attributes': attributes,
+        }
+
+    def restore(self, checkpoint):
+        """
+        Carry on scanning from a |checkpoint| returned by checkpoint(),
+        taken while scanning the same input. The stream is seek()ed to
+        the checkpoint's position, which must be its offset in the
+        stream. A string being scanned is kept in memory, so a Scanner
+        given a string must not have read anything before restore().
+        """
+        pos = checkpoint['pos']
+        next_pos = checkpoint['next_pos']
+        if self.stream is not exhausted_stream:
+            stream = self.stream
+            stream.seek(pos)
+            # The current character, if there is one, must be in the
+            # buffer, as next_pos is past it
+            buffer = ''
+            while len(buffer) < next_pos - pos:
+                data = stream.read(next_pos - pos - len(buffer))
+                if not data:
+                    break
+                buffer = buffer + data
+            self.buffer = buffer
+            self.buf_start_pos = pos
+            self.input_complete = 0
+            self.classes = None
+        self.cur_pos = self.start_pos = pos
+        self.next_pos = next_pos
+        self.cur_line = checkpoint['line']
+        self.cur_line_start = pos - checkpoint['col']
+        # Of the last token read, for position()
+        self.start_line, self.start_col = checkpoint['position']
+        self.cur_char = checkpoint['cur_char']
+        self.input_state = checkpoint['input_state']
+        self.begin(checkpoint['state_name'])
+        self.queue = checkpoint['queue'][:]
+        (self.token_line, self.token_line_pos, self.token_line_length,
+         line_tokens) = checkpoint['line_tokens']
+        self.line_tokens = line_tokens[:]
+        self.skipped = checkpoint['skipped']
+        self.errors = checkpoint['errors']
+        for name, value in checkpoint['attributes'].items():
+            setattr(self, name, copy.deepcopy(value))
+
+    def resume(cls, lexicon, stream, checkpoint, name=''):
+        """
+        Scanner.resume(lexicon, stream, checkpoint, name = '')
+
+            Return a new Scanner of this class reading from |stream|,
+            which carries on from |checkpoint| as restore() does.
+        """
+        scanner = cls(lexicon, stream, name)
+        scanner.restore(checkpoint)
+        return scanner
+
+    resume = classmethod(resume)
+
     def position(self):
         """
         Return a tuple (name, line, col) representing the location of
@@ -289,6 +1150,9 @@ class Scanner:
         self.initial_state = (
             self.lexicon.get_initial_state(state_name))
         self.state_name = state_name
+        self.pattern_table = None
+        self.initial_row = None
+        self.prefilter = None
 
     def produce(self, value, text = None):
         """
@@ -303,7 +1167,15 @@ class Scanner:
         """
         if text is None:
             text = self.text
-        self.queue.append((value, text))
+        token_class = self.token_class
+        if token_class is None:
+            self.queue.append((value, text))
+        else:
+            cur_pos = self.cur_pos
+            self.queue.append(token_class(
+                value, text, self.start_pos, cur_pos, self.start_line,
+                self.start_col, self.cur_line, cur_pos - self.cur_line_start,
+                self.start_state))
 
     def eof(self):
         """
@@ -311,5 +1183,38 @@ class Scanner:
         end of file.
         """
 
+class Starved(Exception):
+    """Raised by a FeedStream to interrupt scanning until there is more
+    input."""
+
+
+class FeedStream:
+    """The stream of a Scanner which is given its input by feed()."""
+
+    chunks = None         # data given to feed() not yet read
+    closed = 0            # true once there is no more data to come
+
+    def __init__(self):
+        self.chunks = []
+
+    def read(self, size=-1):
+        if self.chunks:
+            data = ''.join(self.chunks)
+            self.chunks = []
+            return data
+        if not self.closed:
+            raise Starved()
+        return ''
+
+
+class ExhaustedStream:
+    """The stream of a Scanner reset() with a string, whose text is
+    already all in the buffer."""
+
+    def read(self, size=-1):
+        return ''
+
+exhausted_stream = ExhaustedStream()
+
 # For backward compatibility:
 setattr(Scanner, "yield", Scanner.produce)
@@ -0,0 +1,119 @@
+"""Plex input streams.
+
+open_input() opens a file for a Scanner, decompressing it if its name
+ends in .gz, .bz2 or .xz, and by default wraps it in a ReadAheadStream.
+A ReadAheadStream reads large blocks from another stream in a
+background thread, so that reading the file and decompressing it, which
+release the GIL, overlap with scanning. Set the Scanner's |read_size|
+to the block size to take each block as it comes.
+"""
+
+import bz2
+import gzip
+import sys
+import threading
+import Queue
+
+try:
+    import lzma
+except ImportError:
+    # Not in the Python 2 standard library
+    lzma = None
+
+import Errors
+
+BLOCK_SIZE = 0x40000
+
+
+def open_input(file_name, read_ahead=True, block_size=BLOCK_SIZE):
+    """
+    Open the file |file_name| for reading as a Scanner's stream,
+    decompressing it according to its extension. If |read_ahead| is
+    true, the file is read in blocks of |block_size| bytes by a
+    ReadAheadStream.
+    """
+    if file_name.endswith(".gz"):
+        stream = gzip.open(file_name, "rb")
+    elif file_name.endswith(".bz2"):
+        stream = bz2.BZ2File(file_name, "rb")
+    elif file_name.endswith(".xz"):
+        if lzma is None:
+            raise Errors.PlexError(
+                "Reading %s needs the lzma module" % file_name)
+        stream = lzma.open(file_name, "rb")
+    else:
+        stream = open(file_name, "rb")
+    if read_ahead:
+        stream = ReadAheadStream(stream, block_size)
+    return stream
+
+
+class ReadAheadStream:
+    """
+    ReadAheadStream(stream, block_size = BLOCK_SIZE, blocks = 2)
+
+        A stream which reads |stream| in a background thread, in blocks
+        of |block_size|, keeping up to |blocks| blocks ready. Errors
+        reading |stream| are raised by read().
+    """
+
+    stream = None         # the stream read ahead
+    block_size = 0
+    queue = None          # Queue.Queue of blocks, '' at the end
+    pending = ''          # data from the current block not yet read
+    error = None          # sys.exc_info() of an error reading ahead
+    done = 0              # true once the end of the stream has been read
+    stopping = 0          # true once close() has been called
+
+    def __init__(self, stream, block_size=BLOCK_SIZE, blocks=2):
+        self.stream = stream
+        self.block_size = block_size
+        self.queue = Queue.Queue(blocks)
+        thread = threading.Thread(target=self.read_ahead)
+        thread.setDaemon(True)
+        thread.start()
+
+    def read_ahead(self):
+        try:
+            while not self.stopping:
+                data = self.stream.read(self.block_size)
+                self.queue.put(data)
+                if not data:
+                    return
+            self.queue.put('')
+        except Exception:
+            self.error = sys.exc_info()
+            self.queue.put('')
+
+    def read(self, size=-1):
+        """Return up to |size| characters, or all that remain if |size|
+        is negative, reading a block if none are pending."""
+        data = self.pending
+        if not data:
+            if self.done:
+                return ''
+            data = self.queue.get()
+            if not data:
+                self.done = 1
+                if self.error:
+                    error = self.error
+                    self.error = None
+                    raise error[0], error[1], error[2]
+                return ''
+        if size < 0:
+            self.pending = ''
+            chunks = [data]
+            while not self.done:
+                chunks.append(self.read(self.block_size))
+            return ''.join(chunks)
+        self.pending = data[size:]
+        return data[:size]
+
+    def close(self):
+        """Stop reading ahead and close the underlying stream."""
+        self.stopping = 1
+        # Make room for the read-ahead thread to finish
+        while not self.done:
+            self.pending = ''
+            self.read(self.block_size)
+        self.stream.close()
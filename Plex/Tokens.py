@@ -0,0 +1,127 @@
+"""Plex token objects.
+
+A Token is a record of a token with its full span, which a Scanner
+whose |token_class| is set returns from read() in place of a (value,
+text) tuple. It has slots rather than a dictionary, and unpacks like
+the tuple, so that code which only wants the value and text is
+unchanged.
+
+A TokenText stands for the text of a token without copying it out of
+the Scanner's buffer: it keeps a reference to the buffer string, which
+the Scanner never changes in place (a refill makes a new string), and
+the position of the text in it. The text is only sliced out when it is
+asked for, or when the TokenText is pickled. See the lazy text mode of
+Scanners.Scanner.
+"""
+
+
+class TokenText(object):
+    """
+    TokenText(source, index, offset, length)
+
+        The |length| characters of the string |source| starting at
+        |index|, which are at |offset| in the input.
+    """
+
+    __slots__ = ('source', 'index', 'offset', 'length')
+
+    def __init__(self, source, index, offset, length):
+        self.source = source
+        self.index = index
+        self.offset = offset
+        self.length = length
+
+    def text(self):
+        """Return the text as a string."""
+        index = self.index
+        return self.source[index:index + self.length]
+
+    def view(self):
+        """Return a memoryview of the text, without copying it. The
+        source must be a byte string."""
+        index = self.index
+        return memoryview(self.source)[index:index + self.length]
+
+    def __str__(self):
+        return str(self.text())
+
+    def __unicode__(self):
+        return unicode(self.text())
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        if isinstance(other, TokenText):
+            other = other.text()
+        return self.text() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.text())
+
+    def __repr__(self):
+        return "TokenText(%s)" % repr(self.text())
+
+    def __getstate__(self):
+        # Only the text itself, not the whole buffer it is in
+        return (self.text(), self.offset)
+
+    def __setstate__(self, state):
+        self.source, self.offset = state
+        self.index = 0
+        self.length = len(self.source)
+
+
+class Token(object):
+    """
+    Token(value, text, start, end, line, col, end_line, end_col, state_name)
+
+        A token with value |value| and text |text|, which runs from
+        offset |start| of the input up to |end|, that is from column
+        |col| of line |line| up to column |end_col| of line |end_line|
+        (a token ending in a newline ends at column 0 of the next line),
+        and was recognised in the Scanner state |state_name|. Iterating
+        over a Token or indexing it gives the value and the text, as
+        for the tuple returned by Scanner.read().
+    """
+
+    __slots__ = ('value', 'text', 'start', 'end', 'line', 'col',
+                 'end_line', 'end_col', 'state_name')
+
+    def __init__(self, value, text, start, end, line, col, end_line,
+                 end_col, state_name):
+        self.value = value
+        self.text = text
+        self.start = start
+        self.end = end
+        self.line = line
+        self.col = col
+        self.end_line = end_line
+        self.end_col = end_col
+        self.state_name = state_name
+
+    def __iter__(self):
+        yield self.value
+        yield self.text
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, index):
+        return (self.value, self.text)[index]
+
+    def __repr__(self):
+        return "Token(%s, %s, %d:%d, %d:%d-%d:%d, %s)" % (
+            repr(self.value), repr(self.text), self.start, self.end,
+            self.line, self.col, self.end_line, self.end_col,
+            repr(self.state_name))
+
+    def __getstate__(self):
+        return tuple([getattr(self, name) for name in self.__slots__])
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
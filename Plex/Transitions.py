@@ -65,6 +65,25 @@ class TransitionMap:
         """Return the mapping for epsilon, or None."""
         return self.special.get('')
 
+    def get(self, event):
+        """Return the state set for |event|, which is either a single
+        character or one of the special events, or None.
+        """
+        if len(event) != 1:
+            return self.special.get(event)
+        code = ord(event)
+        map = self.map
+        lo = 0
+        hi = len(map) - 1
+        # loop invariant: map[lo] <= code < map[hi] and hi - lo >= 2
+        while hi - lo >= 4:
+            mid = ((lo + hi) / 2) & ~1
+            if code < map[mid]:
+                hi = mid
+            else:
+                lo = mid
+        return map[lo + 1]
+
     def items(self):
         """Return the mapping as a list of ((code1, code2), state_set) and
         (special_event, state_set) pairs.
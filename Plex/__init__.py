@@ -8,6 +8,9 @@ docstrings for more information.
    Lexicon          For constructing a lexical definition
                     to be used by a Scanner.
 
+   Token            A token with its full span, which a Scanner can
+                    return in place of a (value, text) tuple.
+
    Str, Any, AnyBut, AnyChar, Seq, Alt, Opt, Rep, Rep1,
    Bol, Eol, Eof, Empty
 
@@ -21,13 +24,20 @@ docstrings for more information.
 
                     Actions for associating with patterns when
         creating a Lexicon.
+
+   pure             For marking a function used as an action as safe
+                    to skip when tokens are replayed from a cache.
+
+   side_effect      For marking a function used as an action as still
+                    to be called when tokens are only counted.
 """
 
-from Actions import TEXT, IGNORE, Begin
+from Actions import TEXT, IGNORE, Begin, pure, side_effect
 from Lexicons import Lexicon, State
 from Regexps import RE, Seq, Alt, Rep1, Empty, Str, Any, AnyBut, AnyChar, Range
 from Regexps import Opt, Rep, Bol, Eol, Eof, Case, NoCase
 from Scanners import Scanner
+from Tokens import Token
 
 
 
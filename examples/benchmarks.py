@@ -0,0 +1,543 @@
+#
+#   Plex benchmarks
+#
+#   Usage: python benchmarks.py [benchmark_name ...]
+#
+
+import sys
+
+from Plex import *
+from Plex.Timing import time, timekind
+import pascal
+
+def python_spec():
+  letter = Range("AZaz") | Any("_")
+  digit = Range("09")
+  hexdigit = Range("09AFaf")
+  name = letter + Rep(letter | digit)
+  number = Rep1(digit) | (Str("0x") + Rep1(hexdigit))
+  sq_string = (
+    Str("'") +
+    Rep(AnyBut("\\\n'") | (Str("\\") + AnyChar)) +
+    Str("'"))
+  dq_string = (
+    Str('"') +
+    Rep(AnyBut('\\\n"') | (Str("\\") + AnyChar)) +
+    Str('"'))
+  non_dq = AnyBut('"') | (Str('\\') + AnyChar)
+  tq_string = (
+    Str('"""') +
+    Rep(
+      non_dq |
+      (Str('"') + non_dq) |
+      (Str('""') + non_dq)) + Str('"""'))
+  stringlit = sq_string | dq_string | tq_string
+  punct1 = Any(":,;+-*/|&<>=.%`~^")
+  punct2 = Str("==", "<>", "!=", "<=", "<<", ">>", "**")
+  spaces = Rep1(Any(" \t"))
+  indentation = Rep(Str(" ")) | Rep(Str("\t"))
+  lineterm = Str("\n") | Eof
+  comment = Str("#") + Rep(AnyBut("\n"))
+  return [
+    (name,                'name'),
+    (number,              'number'),
+    (stringlit,           'string'),
+    (punct1 | punct2,     TEXT),
+    (Any("([{"),          TEXT),
+    (Any(")]}"),          TEXT),
+    (lineterm,            'newline'),
+    (comment,             IGNORE),
+    (spaces,              IGNORE),
+    (Str("\\\n"),         IGNORE),
+    State('indent', [
+      (indentation + Opt(comment) + lineterm, IGNORE),
+      (indentation,       'indent'),
+    ]),
+  ]
+
+def keywords_spec():
+  words = []
+  for a in "abcdefgh":
+    for b in "aeiou":
+      for c in "nrst":
+        words.append(a + b + c + "word")
+  return [
+    (NoCase(Str(*words)), TEXT),
+    (Rep1(Range("az")), 'ident'),
+    (Rep1(Any(" \n")), IGNORE),
+  ]
+
+lexicon_specs = [
+  ('pascal', lambda **options: pascal.make_lexicon(**options)),
+  ('python', lambda **options: Lexicon(python_spec(), **options)),
+  ('keywords', lambda **options: Lexicon(keywords_spec(), **options)),
+]
+
+def build(make_lexicon, repeat = 5, **options):
+  time1 = time()
+  for i in xrange(repeat):
+    lexicon = make_lexicon(report = 1, **options)
+  time2 = time()
+  return lexicon.report, (time2 - time1) / repeat
+
+def bench_optimize():
+  """NFA size and construction time with and without RE simplification."""
+  for name, make_lexicon in lexicon_specs:
+    plain, plain_time = build(make_lexicon, optimize = False)
+    optimized, optimized_time = build(make_lexicon)
+    print "%-10s NFA states %5d -> %5d  DFA states %5d -> %5d  " \
+          "construction %.3f -> %.3f %s seconds" % (
+      name, plain.nfa_states, optimized.nfa_states,
+      plain.dfa_states, optimized.dfa_states,
+      plain_time, optimized_time, timekind)
+
+def generated_spec(n):
+  spec = []
+  for i in xrange(n):
+    letter = Range("AZaz") | Any("_")
+    digit = Range("09")
+    escape = Str("\\") + AnyChar
+    spec.append((Str("kw%d_" % i) + Rep(letter | digit | escape), i))
+  return spec
+
+def count_live_res():
+  import gc
+  gc.collect()
+  n = 0
+  for obj in gc.get_objects():
+    if isinstance(obj, RE):
+      n = n + 1
+  return n
+
+def bench_interning(n = 2000):
+  """Memory and time for a lexicon of thousands of generated rules."""
+  res_before = count_live_res()
+  time1 = time()
+  spec = generated_spec(n)
+  time2 = time()
+  lexicon = Lexicon(spec, report = 1)
+  time3 = time()
+  print "%d rules: %d live RE objects, building REs %.3f, " \
+        "lexicon %.3f %s seconds" % (
+    n, count_live_res() - res_before, time2 - time1, time3 - time2, timekind)
+
+def many_states_spec(n):
+  spec = []
+  for i in xrange(n):
+    # Each state has a rule whose DFA is exponential in its length
+    spec.append(State('s%d' % i, [
+      (Rep(AnyChar) + Str("ab"[i % 2]) + Seq(*[AnyChar] * (6 + i % 3)), i),
+      (Rep1(Range("az")), 'word'),
+    ]))
+  return spec
+
+def bench_parallel(n = 8):
+  """Construction time for independent states, serial and in parallel."""
+  import multiprocessing, os
+  spec = many_states_spec(n)
+  for processes in (None, 2, multiprocessing.cpu_count()):
+    # Timing.time() measures this process only, so use elapsed time
+    time1 = os.times()[4]
+    Lexicon(spec, processes = processes)
+    time2 = os.times()[4]
+    print "%d states, processes=%s (%d cpus): %.3f elapsed seconds" % (
+      n, processes, multiprocessing.cpu_count(), time2 - time1)
+
+def bench_incremental(n = 1000):
+  """Adding and removing a token compared with rebuilding the lexicon."""
+  spec = generated_spec(n)
+  time1 = time()
+  lexicon = Lexicon(spec, incremental = 1)
+  time2 = time()
+  token_number, = lexicon.add_tokens([(Str("extra") + Rep1(Range("09")), 'x')])
+  time3 = time()
+  lexicon.remove_token(token_number)
+  time4 = time()
+  print "%d rules: build %.3f, add %.3f, remove %.3f %s seconds" % (
+    n, time2 - time1, time3 - time2, time4 - time3, timekind)
+
+def scan_text(lexicon, text, engine):
+  from cStringIO import StringIO
+  scanner = Scanner(lexicon, StringIO(text))
+  scanner.engine = engine
+  time1 = time()
+  while 1:
+    value, text = scanner.read()
+    if value is None:
+      break
+  time2 = time()
+  return time2 - time1
+
+def read_input(file_name):
+  # The example inputs have old Macintosh line endings
+  return open(file_name).read().replace("\r", "\n")
+
+def bench_engines(repeat = 5):
+  """Scanning with the DFA, with re patterns and with character classes."""
+  inputs = [
+    ('pascal', pascal.make_lexicon(), read_input("speedtest.in")),
+    ('long', pascal.make_lexicon(),
+      "%s := %s;\n" % ("a_rather_long_identifier" * 4, "1234567890" * 4) * 300),
+    ('python', Lexicon(python_spec()), read_input("python.in") * 100),
+    ('keywords', Lexicon(keywords_spec()),
+      "identifier BARWORD zanzibar fanword\n" * 1000),
+  ]
+  for name, lexicon, text in inputs:
+    times = []
+    for engine in ('dfa', 're', 'classes'):
+      t = min([scan_text(lexicon, text, engine) for i in xrange(repeat)])
+      times.append(t)
+    print "%-10s %6d chars: dfa %.3f, re %.3f, classes %.3f %s seconds" % (
+      name, len(text), times[0], times[1], times[2], timekind)
+
+def bench_classify(n = 100000):
+  """Classifying many short strings with NumPy and with a Scanner each."""
+  from cStringIO import StringIO
+  import random
+  lexicon = Lexicon(keywords_spec())
+  random.seed(1)
+  strings = ["".join([random.choice("abcdeinorstuwz")
+                      for i in xrange(random.randint(1, 10))])
+             for j in xrange(n)]
+  time1 = time()
+  lexicon.classify(strings)
+  time2 = time()
+  for text in strings:
+    Scanner(lexicon, StringIO(text)).read()
+  time3 = time()
+  print "%d strings: classify %.3f, scanner %.3f %s seconds" % (
+    n, time2 - time1, time3 - time2, timekind)
+
+def bench_scan_many(n = 1000000):
+  """Scanning many short strings with scan_many() and a Scanner each."""
+  from cStringIO import StringIO
+  lexicon = Lexicon(keywords_spec())
+  words = ["barword", "zanzibar fanword", "id", "x y z", "canword\n"]
+  strings = [words[i % len(words)] for i in xrange(n)]
+  time1 = time()
+  for tokens in lexicon.scan_many(strings):
+    pass
+  time2 = time()
+  for text in strings:
+    scanner = Scanner(lexicon, StringIO(text))
+    while scanner.read()[0] is not None:
+      pass
+  time3 = time()
+  print "%d strings: scan_many %.3f, new scanners %.3f %s seconds" % (
+    n, time2 - time1, time3 - time2, timekind)
+
+def log_text(lines):
+  return "".join([
+    "2024-01-%02d host%d sshd: connection from 10.0.%d.%d port %d%s\n" % (
+      i % 28 + 1, i % 7, i % 256, i * 7 % 256, 1024 + i,
+      i % 13 == 0 and " ERROR timeout" or "")
+    for i in xrange(lines)])
+
+def search_spec():
+  octet = Rep1(Range("09"))
+  return [
+    (octet + Str(".") + octet + Str(".") + octet + Str(".") + octet, 'ip'),
+    (Str("ERROR"), 'error'),
+  ]
+
+def bench_search(lines = 20000):
+  """Extracting tokens from log text in search mode and with catch-all rules."""
+  text = log_text(lines)
+  spec = search_spec()
+  searching = Lexicon(spec)
+  catch_all = Lexicon(spec + [(AnyChar, IGNORE)])
+  time1 = time()
+  found = list(searching.search(text))
+  time2 = time()
+  scan_text(catch_all, text, 'dfa')
+  time3 = time()
+  print "%d chars, %d tokens: search %.3f, catch-all %.3f %s seconds" % (
+    len(text), len(found), time2 - time1, time3 - time2, timekind)
+
+def bench_prefilter(lines = 20000):
+  """Search mode for rare literal tokens, with and without the prefilter."""
+  text = log_text(lines)
+  lexicon = Lexicon([
+    (Str("ERROR") + Rep1(Str(" ")) + Rep1(Range("az")), 'error'),
+    (Str("http") + Opt(Str("s")) + Str("://"), 'url'),
+  ])
+  times = []
+  for use_prefilter in (0, 1):
+    scanner = Scanner(lexicon, text)
+    scanner.search = 1
+    if not use_prefilter:
+      scanner.prefilter = 0
+    time1 = time()
+    while scanner.read()[0] is not None:
+      pass
+    times.append(time() - time1)
+  print "%d chars: stepping %.3f, prefilter %.3f %s seconds" % (
+    len(text), times[0], times[1], timekind)
+
+def send_all(senders, text, piece = 0x800):
+  # Interleave the connections, as a server would see them
+  for i in xrange(0, len(text), piece):
+    for sender in senders:
+      sender.sendall(text[i:i + piece])
+  for sender in senders:
+    sender.close()
+
+def scan_connections(lexicon, connections, text, use_threads):
+  import asyncore, socket, threading
+  from Plex.AsyncScanners import AsyncScanner
+  counts = []
+  class Counter(AsyncScanner):
+    def handle_tokens(self, tokens):
+      counts.append(len(tokens))
+  pairs = [socket.socketpair() for i in xrange(connections)]
+  writer = threading.Thread(target = send_all,
+    args = ([sender for sender, receiver in pairs], text))
+  if use_threads:
+    def scan_socket(receiver):
+      scanner = Scanner(lexicon, receiver.makefile('rb'))
+      n = 0
+      while scanner.read()[0] is not None:
+        n = n + 1
+      counts.append(n + 1)
+    readers = [threading.Thread(target = scan_socket, args = (receiver,))
+               for sender, receiver in pairs]
+    for reader in readers:
+      reader.start()
+    writer.start()
+    for reader in readers:
+      reader.join()
+  else:
+    socket_map = {}
+    for sender, receiver in pairs:
+      Counter(lexicon, receiver, socket_map)
+    writer.start()
+    asyncore.loop(1, map = socket_map)
+  writer.join()
+  return sum(counts)
+
+def bench_async(connections = 100, lines = 500):
+  """Scanning many connections with asyncore and with a thread each."""
+  import os
+  lexicon = pascal.make_lexicon()
+  text = "%s := %s; { comment }\n" % ("an_identifier", "12345") * lines
+  for use_threads in (0, 1):
+    # Timing.time() measures this process only, so use elapsed time
+    time1 = os.times()[4]
+    tokens = scan_connections(lexicon, connections, text, use_threads)
+    time2 = os.times()[4]
+    print "%d connections, %d tokens, %s: %.3f elapsed seconds" % (
+      connections, tokens, use_threads and "threads" or "asyncore",
+      time2 - time1)
+
+def bench_read_ahead(repeat = 30):
+  """Scanning compressed files with and without a read-ahead thread."""
+  import bz2, gzip, os, shutil, tempfile
+  from Plex import Streams
+  lexicon = pascal.make_lexicon()
+  text = read_input("speedtest.in") * repeat
+  directory = tempfile.mkdtemp()
+  try:
+    for suffix, open_file in ((".gz", gzip.open), (".bz2", bz2.BZ2File)):
+      file_name = os.path.join(directory, "speedtest" + suffix)
+      f = open_file(file_name, "wb")
+      f.write(text)
+      f.close()
+      times = []
+      for read_ahead in (0, 1):
+        stream = Streams.open_input(file_name, read_ahead)
+        scanner = Scanner(lexicon, stream)
+        if read_ahead:
+          scanner.read_size = Streams.BLOCK_SIZE
+        # Timing.time() measures this process only, so use elapsed time
+        time1 = os.times()[4]
+        while scanner.read()[0] is not None:
+          pass
+        times.append(os.times()[4] - time1)
+        stream.close()
+      print "%-4s %d chars: direct %.3f, read-ahead %.3f elapsed seconds" % (
+        suffix, len(text), times[0], times[1])
+  finally:
+    shutil.rmtree(directory)
+
+def bench_token_cache(repeat = 10):
+  """Replaying tokens from a TokenCache against scanning again."""
+  import os, shutil, tempfile
+  from Plex import Caches
+  lexicon = pascal.make_lexicon()
+  text = read_input("speedtest.in") * repeat
+  directory = tempfile.mkdtemp()
+  try:
+    cache = Caches.TokenCache(directory)
+    times = []
+    for i in xrange(3):
+      time1 = time()
+      scanner = cache.scan(lexicon, text)
+      n = 0
+      while scanner.read()[0] is not None:
+        n = n + 1
+      times.append(time() - time1)
+    print "%d chars, %d tokens: scan and record %.3f, replay %.3f, %.3f %s" % (
+      len(text), n, times[0], times[1], times[2], timekind)
+  finally:
+    shutil.rmtree(directory)
+
+def bench_line_cache(lines = 50000):
+  """Scanning repetitive log lines with and without a LineCache."""
+  from Plex import Caches
+  text = "".join([
+    "host%d sshd: session %s for user u%d\n" % (
+      i % 7, i % 3 and "opened" or "closed", i % 11)
+    for i in xrange(lines)])
+  lexicon = Lexicon([
+    (Rep1(Range("az09")), 'word'),
+    (Str(":"), TEXT),
+    (Rep1(Str(" ")), IGNORE),
+    (Str("\n"), IGNORE),
+  ])
+  times = []
+  for line_cache in (None, Caches.LineCache(1000)):
+    scanner = Scanner(lexicon, text)
+    scanner.line_cache = line_cache
+    time1 = time()
+    while scanner.read()[0] is not None:
+      pass
+    times.append(time() - time1)
+  print "%d lines: scanning %.3f, line cache %.3f %s seconds, %.1f%% hits" % (
+    lines, times[0], times[1], timekind, line_cache.hit_rate() * 100)
+
+def bench_projection(repeat = 10):
+  """Reading only the numbers from Pascal source, filtering or projecting."""
+  lexicon = pascal.make_lexicon()
+  text = read_input("speedtest.in") * repeat
+  times = []
+  for only in (None, ['num']):
+    scanner = Scanner(lexicon, text, only = only)
+    n = 0
+    time1 = time()
+    while 1:
+      value, text_read = scanner.read()
+      if value is None:
+        break
+      if value == 'num':
+        n = n + 1
+    times.append(time() - time1)
+  print "%d chars, %d numbers: filtering %.3f, projection %.3f %s seconds" % (
+    len(text), n, times[0], times[1], timekind)
+
+def bench_count_tokens(repeat = 10):
+  """Counting tokens with count_tokens() and with a read() loop."""
+  lexicon = pascal.make_lexicon()
+  text = read_input("speedtest.in") * repeat
+  scanner = Scanner(lexicon, text)
+  time1 = time()
+  while scanner.read()[0] is not None:
+    pass
+  time2 = time()
+  print "%d chars: read() loop %.3f %s seconds" % (
+    len(text), time2 - time1, timekind)
+  for engine in ('dfa', 're', 'classes'):
+    time1 = time()
+    counts, lines = lexicon.count_tokens(text, engine = engine)
+    time2 = time()
+    print "  count_tokens, %-7s %d tokens, %d lines: %.3f %s seconds" % (
+      engine, sum(counts), lines, time2 - time1, timekind)
+
+def bench_columns(repeat = 10):
+  """Collecting tokens and positions in columns against read() and position()."""
+  import array
+  lexicon = pascal.make_lexicon()
+  text = read_input("speedtest.in") * repeat
+  time1 = time()
+  scanner = Scanner(lexicon, text)
+  tokens = []
+  lines = array.array('i')
+  cols = array.array('i')
+  while 1:
+    token = scanner.read()
+    if token[0] is None:
+      break
+    tokens.append(token)
+    _, line, col = scanner.position()
+    lines.append(line)
+    cols.append(col)
+  time2 = time()
+  columns = lexicon.scan_columns(text)
+  time3 = time()
+  print "%d chars, %d tokens: read() %.3f, scan_columns %.3f %s seconds" % (
+    len(text), len(columns), time2 - time1, time3 - time2, timekind)
+
+def bench_lazy_text(lines = 50000):
+  """Reading token values with and without lazy token text."""
+  log_lexicon = Lexicon([
+    (Str("2024-") + Rep1(AnyBut("\n")), 'entry'),
+    (Str("\n"), IGNORE),
+  ])
+  for name, lexicon, text in (
+      ("log", log_lexicon, log_text(lines)),
+      ("pascal", pascal.make_lexicon(), read_input("speedtest.in") * 10)):
+    times = []
+    for lazy_text in (0, 1):
+      scanner = Scanner(lexicon, text)
+      scanner.lazy_text = lazy_text
+      time1 = time()
+      while scanner.read()[0] is not None:
+        pass
+      times.append(time() - time1)
+    print "%-6s %d chars: copied %.3f, lazy %.3f %s seconds" % (
+      name, len(text), times[0], times[1], timekind)
+
+def bench_token_records(repeat = 10):
+  """Getting tokens with their spans from Token records and from position()."""
+  lexicon = pascal.make_lexicon()
+  text = read_input("speedtest.in") * repeat
+  scanner = Scanner(lexicon, text)
+  spans = []
+  time1 = time()
+  while 1:
+    value, token_text = scanner.read()
+    _, line, col = scanner.position()
+    # The end has to be worked out from the text
+    spans.append((value, token_text, line, col, scanner.start_pos,
+                  scanner.start_pos + len(token_text)))
+    if value is None:
+      break
+  time2 = time()
+  scanner = Scanner(lexicon, text)
+  scanner.token_class = Token
+  tokens = []
+  while 1:
+    token = scanner.read()
+    tokens.append(token)
+    if token.value is None:
+      break
+  time3 = time()
+  print "%d tokens: tuples and position() %.3f, Token records %.3f %s seconds" % (
+    len(tokens), time2 - time1, time3 - time2, timekind)
+
+benchmarks = [
+  ('optimize', bench_optimize),
+  ('interning', bench_interning),
+  ('parallel', bench_parallel),
+  ('incremental', bench_incremental),
+  ('engines', bench_engines),
+  ('classify', bench_classify),
+  ('scan_many', bench_scan_many),
+  ('search', bench_search),
+  ('prefilter', bench_prefilter),
+  ('async', bench_async),
+  ('read_ahead', bench_read_ahead),
+  ('token_cache', bench_token_cache),
+  ('line_cache', bench_line_cache),
+  ('projection', bench_projection),
+  ('count_tokens', bench_count_tokens),
+  ('columns', bench_columns),
+  ('lazy_text', bench_lazy_text),
+  ('token_records', bench_token_records),
+]
+
+if __name__ == "__main__":
+  names = sys.argv[1:]
+  for name, function in benchmarks:
+    if not names or name in names:
+      print "%s: %s" % (name, function.__doc__)
+      function()
@@ -4,7 +4,7 @@
 
 from Plex import *
 
-def make_lexicon():
+def make_lexicon(**options):
 
   letter = Range("AZaz") | Any("_")
   digit = Range("09")
@@ -36,7 +36,7 @@ def make_lexicon():
       (comment_char, IGNORE),
       (comment_end, Begin(''))
     ])
-  ])
+  ], **options)
 
   return lexicon
 
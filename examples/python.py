@@ -10,6 +10,10 @@ class NaughtyNaughty(exceptions.Exception):
 
 class PythonScanner(Scanner):	 
   
+  # Saved and restored along with the position by checkpoint()
+  checkpoint_attributes = (
+    'indentation_stack', 'bracket_nesting_level', 'indentation_char')
+
   def open_bracket_action(self, text):
     self.bracket_nesting_level = self.bracket_nesting_level + 1
     return text
@@ -1,9 +1,17 @@
 #!/usr/bin/python
 
 import cStringIO
+import io
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from Plex import *
+from Plex import AsyncScanners, Caches, Errors, Optimize, Patterns, Streams
+from Plex import Tokens
 
 
 class REUtils(unittest.TestCase):
@@ -49,6 +57,1277 @@ class QuotedString(unittest.TestCase):
         self.assertTrue(value is None)
 
 
+class BuildReport(unittest.TestCase):
+    def setUp(self):
+        letter = Range("AZaz")
+        self.lex = Lexicon(
+            [(letter + Rep(letter), 'ident'),
+             (NoCase(Str("if", "then", "else")), TEXT),
+             (Rep1(Any(" ")), IGNORE),
+             State('other', [(Str("a"), 'a')]),
+             ], report=1)
+
+    def tearDown(self):
+        self.lex = None
+
+    def test_totals(self):
+        report = self.lex.report
+        self.assertEqual(len(self.lex.machine.states), report.dfa_states)
+        self.assertEqual(['', 'other'], sorted(report.states.keys()))
+        self.assertEqual(report.dfa_states,
+                         sum([s.dfa_states for s in report.states.values()]))
+        self.assertTrue(report.table_bytes > 0)
+
+    def test_top_rules(self):
+        top = self.lex.report.top_rules(2)
+        self.assertEqual([1, 2], [token_number for _, token_number, _ in top])
+        self.assertEqual("NoCase(Str('if','then','else'))", top[1][2])
+
+
+def scan_all(lex, in_text):
+    return scan_all_from(Scanner(lex, cStringIO.StringIO(in_text)))
+
+
+def scan_all_from(s):
+    result = []
+    while 1:
+        value, text = s.read()
+        if value is None:
+            return result
+        result.append((value, text))
+
+
+def scan_positions(lex, in_text, engine):
+    s = Scanner(lex, cStringIO.StringIO(in_text))
+    s.engine = engine
+    result = []
+    while 1:
+        value, text = s.read()
+        result.append((value, text, s.position()))
+        if value is None:
+            return result
+
+
+class ConstructionLimits(unittest.TestCase):
+    spec = [
+        (Rep(AnyChar) + Str("a") + AnyChar + AnyChar + AnyChar + AnyChar, 'x'),
+        (Str("b"), 'b'),
+        State('other', [(Rep1(Str("q")), 'q')]),
+        ]
+
+    def test_explosion(self):
+        """Exceeding max_states names the offending rule first"""
+        try:
+            Lexicon(self.spec, max_states=10)
+        except Errors.StateExplosion, e:
+            self.assertEqual('', e.state_name)
+            self.assertEqual(1, e.offenders[0][1])
+        else:
+            self.fail("StateExplosion not raised")
+
+    def test_per_state(self):
+        """Each state gets the whole of max_states to itself"""
+        spec = [State('s%d' % i, [(Str("abcdef"), 'x')]) for i in range(4)]
+        Lexicon(spec, max_states=10)
+        lex = Lexicon(spec, max_states=10, fallback=1)
+        self.assertEqual([], lex.lazy_states)
+        lex = Lexicon(spec, max_states=10, incremental=1)
+        lex.add_tokens([(Str("xyz"), 'y')], 's2')
+        s = Scanner(lex, "xyz")
+        s.begin('s2')
+        self.assertEqual(('y', 'xyz'), s.read())
+
+    def test_fallback(self):
+        """A lazily built state scans like the fully built one"""
+        lazy = Lexicon(self.spec, max_states=10, fallback=1)
+        full = Lexicon(self.spec)
+        self.assertEqual([''], lazy.lazy_states)
+        in_text = "xxabcdefaaaaaaab"
+        self.assertEqual(scan_all(full, in_text),
+                         scan_all(lazy, in_text))
+
+    def test_fallback_report(self):
+        """A build report leaves out lazily built states"""
+        lazy = Lexicon(self.spec, max_states=10, fallback=1, report=1)
+        full = Lexicon(self.spec)
+        self.assertEqual([''], lazy.lazy_states)
+        self.assertEqual(['', 'other'], sorted(lazy.report.states.keys()))
+        in_text = "xxabcdefaaaaaaab"
+        self.assertEqual(scan_all(full, in_text),
+                         scan_all(lazy, in_text))
+
+    def test_parallel_explosion(self):
+        """Limits apply to each state when building in parallel"""
+        try:
+            Lexicon(self.spec, max_states=10, processes=2)
+        except Errors.StateExplosion, e:
+            self.assertEqual('', e.state_name)
+            self.assertEqual(1, e.offenders[0][1])
+        else:
+            self.fail("StateExplosion not raised")
+
+
+class ParallelConstruction(unittest.TestCase):
+    spec = [
+        (Str("if", "then", "else") | Rep1(Range("az")), TEXT),
+        (Rep1(Any(" \n")), IGNORE),
+        (Str("{"), Begin('comment')),
+        State('comment', [
+            (Str("}"), Begin('')),
+            (Rep1(AnyBut("}")), 'comment'),
+            ]),
+        State('digits', [(Rep1(Range("09")), 'number')]),
+        ]
+
+    def test_same_tokens(self):
+        """A lexicon built in parallel scans like one built serially"""
+        in_text = "if x then {any thing} else y"
+        serial = scan_all(Lexicon(self.spec), in_text)
+        parallel = scan_all(Lexicon(self.spec, processes=2), in_text)
+        self.assertEqual(serial, parallel)
+
+    def test_report(self):
+        """The report of a parallel build has the same sizes"""
+        serial = Lexicon(self.spec, report=1).report
+        parallel = Lexicon(self.spec, report=1, processes=2).report
+        self.assertEqual(serial.dfa_states, parallel.dfa_states)
+        self.assertEqual(serial.contributions, parallel.contributions)
+
+
+class IncrementalUpdates(unittest.TestCase):
+    base = [
+        (Str("if", "then"), 'keyword'),
+        (Rep1(Range("az")), 'ident'),
+        (Rep1(Any(" ")), IGNORE),
+        ]
+    in_text = "if x12 then iffy"
+
+    def test_add_and_remove(self):
+        """An updated lexicon scans like one built from scratch"""
+        lex = Lexicon(self.base, incremental=1)
+        numbers = lex.add_tokens([
+            (Str("iffy"), 'iffy'),
+            (Str("x") + Rep1(Range("09")), 'xnum'),
+            ])
+        self.assertEqual([4, 5], numbers)
+        lex.remove_token(1)
+        full = Lexicon(self.base[1:] + [
+            (Str("iffy"), 'iffy'),
+            (Str("x") + Rep1(Range("09")), 'xnum'),
+            ])
+        self.assertEqual(scan_all(full, self.in_text),
+                         scan_all(lex, self.in_text))
+        self.assertEqual(len(full.machine.states), len(lex.machine.states))
+
+    def test_new_state(self):
+        lex = Lexicon(self.base, incremental=1)
+        lex.add_tokens([(Str("}"), Begin(''))], 'comment')
+        self.assertEqual(['', 'comment'],
+                         sorted(lex.machine.initial_states.keys()))
+
+    def test_errors(self):
+        lex = Lexicon(self.base, incremental=1)
+        lex.remove_token(2)
+        self.assertRaises(Errors.InvalidToken, lex.remove_token, 2)
+        self.assertEqual(scan_all(Lexicon([self.base[0], self.base[2]]),
+                                  "if then"),
+                         scan_all(lex, "if then"))
+        self.assertRaises(Errors.PlexError,
+                          Lexicon(self.base).add_tokens, [(Str("x"), 'x')])
+
+    def test_rollback(self):
+        """An update exceeding the limits leaves the lexicon unchanged"""
+        lex = Lexicon(self.base, incremental=1, max_states=20)
+        rules = lex.rules[:]
+        explosive = Rep(AnyChar) + Str("a") + AnyChar + AnyChar + AnyChar
+        self.assertRaises(Errors.StateExplosion,
+                          lex.add_tokens, [(explosive, 'x')])
+        self.assertEqual(rules, lex.rules)
+        self.assertEqual(scan_all(Lexicon(self.base), "if x then iffy"),
+                         scan_all(lex, "if x then iffy"))
+        lex.add_tokens([(Str("x"), 'x')])
+
+
+class RePatterns(unittest.TestCase):
+    spec = [
+        (Str("if", "then"), 'keyword'),
+        (Range("az") + Rep(Range("az09")), 'ident'),
+        (Rep1(Range("09")) + Opt(Str(".") + Rep1(Range("09"))), 'number'),
+        (Rep1(Any(" \n")), IGNORE),
+        (Str("{"), Begin('comment')),
+        State('comment', [
+            (Rep1(AnyBut("}")), IGNORE),
+            (Str("}"), Begin('')),
+            ]),
+        ]
+
+    def test_ll1(self):
+        self.assert_(Patterns.is_ll1(Rep1(Range("09")) + Opt(Str(".")), 0, ()))
+        self.failIf(Patterns.is_ll1(Str("a") | Str("ab"), 0, ()))
+        self.failIf(Patterns.is_ll1(Rep(Str("a")) + Str("a"), 0, ()))
+
+    def test_table(self):
+        patterns = Lexicon(self.spec).get_patterns()
+        table = patterns[''].table
+        # 'i' and 't' can begin a keyword or an identifier
+        self.failIf('i' in table)
+        self.assert_('x' in table and '7' in table)
+        self.assertEqual(256, len(patterns['comment'].table))
+        self.failIf(Lexicon([(Str("a") + Eol, 'a')]).get_patterns())
+
+    def test_same_tokens(self):
+        """The re engine gives the same tokens and positions as the DFA"""
+        lex = Lexicon(self.spec)
+        in_text = "if x1 then 3.14 {a\ncomment}\n\n  thenx 42.5 y\n"
+        self.assertEqual(scan_positions(lex, in_text, 'dfa'),
+                         scan_positions(lex, in_text, 're'))
+
+
+class CharacterClasses(unittest.TestCase):
+    spec = [
+        (NoCase(Str("begin", "end")), 'keyword'),
+        (Range("azAZ") + Rep(Range("azAZ09")), 'ident'),
+        (Rep1(Any(" \n")), IGNORE),
+        (Bol + Str("#") + Rep(AnyBut("\n")), 'directive'),
+        (Str("#"), 'hash'),
+        (Str("x") + Eol, 'x_at_eol'),
+        ]
+
+    def test_classes(self):
+        class_machine = Lexicon(self.spec).get_class_machine()
+        classes = class_machine.classes
+        # Case variants of keyword letters are alike
+        self.assertEqual(classes['G'], classes['g'])
+        self.assertNotEqual(classes['g'], classes['f'])
+        self.assertEqual(classes['q'], classes['z'])
+        self.assertEqual(classes['\x00'], classes['%'])
+        self.assertNotEqual(classes['\n'], classes[' '])
+
+    def test_same_tokens(self):
+        """The classes engine gives the same tokens and positions as the DFA"""
+        lex = Lexicon(self.spec)
+        in_text = "#x\nBEGIN x\nendx # y#\n  x"
+        self.assertEqual(scan_positions(lex, in_text, 'dfa'),
+                         scan_positions(lex, in_text, 'classes'))
+
+
+class Classify(unittest.TestCase):
+    spec = [
+        (NoCase(Str("begin", "end")), 'keyword'),
+        (Range("azAZ") + Rep(Range("azAZ09")), 'ident'),
+        (Rep1(Range("09")) + Opt(Str(".") + Rep1(Range("09"))), 'number'),
+        (Str("x") + Eol, 'x_at_eol'),
+        (Rep1(Str("ab\n")), 'lines'),
+        (Bol + Str("#"), 'hash'),
+        (Str(""), 'empty'),
+        ]
+
+    def test_priorities(self):
+        """DFA states record the priority of their action"""
+        lex = Lexicon(self.spec)
+        for state in lex.machine.states:
+            priority = lex.machine.priorities.get(state['number'])
+            if state['action']:
+                self.assertEqual(lex.rules[-priority - 1][2], state['action'])
+            else:
+                self.assertEqual(None, priority)
+
+    @unittest.skipIf(numpy is None, "needs NumPy")
+    def test_match_whole(self):
+        lex = Lexicon(self.spec)
+        strings = ["", "BeGiN", "beginx", "x", "12.", "12.5", "ab\nab\n",
+                   "ab\nx", "#", "a#"]
+        expected = []
+        for text in strings:
+            s = Scanner(lex, cStringIO.StringIO(text))
+            try:
+                value, token_text = s.read()
+            except Errors.UnrecognizedInput:
+                value = None
+            if value is not None and token_text == text:
+                values = [action for re, action in self.spec]
+                expected.append(values.index(value) + 1)
+            else:
+                expected.append(0)
+        self.assertEqual(expected, list(lex.classify(strings)))
+        self.assertEqual([], list(lex.classify([])))
+
+
+class ScanMany(unittest.TestCase):
+    spec = [
+        (Rep1(Range("az")), 'word'),
+        (Rep1(Any(" \n")), IGNORE),
+        (Bol + Str("#"), 'hash'),
+        (Str("x") + Eof, 'x_at_eof'),
+        (Str("("), Begin('comment')),
+        State('comment', [
+            (Str(")"), Begin('')),
+            (AnyBut(")"), IGNORE),
+        ]),
+        ]
+    texts = ["ab cd", "#a\n#b", "", "a x", "(a", "b\n# x", u"ab"]
+
+    def test_scan_many(self):
+        """scan_many() gives the tokens of a new Scanner for each text"""
+        lex = Lexicon(self.spec)
+        self.assertEqual([scan_all(lex, text) for text in self.texts],
+                         list(lex.scan_many(self.texts)))
+
+    def test_reset(self):
+        """A Scanner reset() in the middle of a text starts again"""
+        lex = Lexicon(self.spec)
+        s = Scanner(lex, cStringIO.StringIO("#a (b"))
+        s.read()
+        s.read()
+        self.assertEqual((None, ''), s.read())
+        self.assertEqual('comment', s.state_name)
+        s.reset(cStringIO.StringIO("b\n#c"), "other")
+        self.assertEqual(('word', 'b'), s.read())
+        self.assertEqual(('hash', '#'), s.read())
+        self.assertEqual(("other", 2, 0), s.position())
+
+    def test_reset_engine(self):
+        """Unicode input is scanned with the DFA without changing the
+        engine used for the next input"""
+        lex = Lexicon(self.spec)
+        for engine in ('re', 'classes'):
+            s = Scanner(lex, '')
+            s.engine = engine
+            for text in self.texts:
+                s.reset(text)
+                self.assertEqual(scan_all(lex, text), scan_all_from(s))
+                self.assertEqual(engine, s.engine)
+            self.assertEqual('dfa', s.input_engine)
+            s.reset("ab")
+            self.assertEqual(None, s.input_engine)
+            self.assertEqual(('word', 'ab'), s.read())
+        # The 'classes' engine ran on the byte string
+        self.assertTrue(s.classes is not None)
+
+
+class SearchMode(unittest.TestCase):
+    spec = [
+        (Rep1(Range("09")), 'number'),
+        (NoCase(Str("error")), 'error'),
+        (Str("ab") + Eol, 'ab_at_eol'),
+        (Bol + Str("#"), 'hash'),
+        ]
+
+    def test_positions(self):
+        lex = Lexicon(self.spec)
+        self.assertEqual(
+            [('number', '12', 1, 1, 1), ('error', 'ERROR', 4, 1, 4),
+             ('hash', '#', 10, 2, 0), ('ab_at_eol', 'ab', 12, 2, 2),
+             ('hash', '#', 15, 3, 0), ('number', '5', 17, 3, 2)],
+            list(lex.search("x12 ERROR\n#zab\n#a5")))
+
+    def test_catch_all(self):
+        """Search mode finds the tokens that a catch-all rule would leave"""
+        spec = self.spec[:3]
+        lex = Lexicon(spec)
+        catch_all = Lexicon(spec + [(AnyChar, IGNORE)])
+        in_text = "abc 123 errorab\nfoo 7 ab\n" * 400
+        expected = scan_all(catch_all, in_text)
+        for engine in ('dfa', 're', 'classes'):
+            s = Scanner(lex, cStringIO.StringIO(in_text))
+            s.search = 1
+            s.engine = engine
+            self.assertEqual(expected, scan_all_from(s))
+
+
+class Prefilters(unittest.TestCase):
+    spec = [
+        (Str("ERROR") + Rep1(Str(" ")) + Rep1(Range("az")), 'error'),
+        (NoCase(Str("http")) + Opt(Str("s")) + Str("://"), 'url'),
+        (Bol + Str("#"), 'hash'),
+        (Str("x") + Eol, 'x_at_eol'),
+        (Str("{{") | Rep1(Range("09")) + Str("%"), 'other'),
+        ]
+
+    def test_leading_patterns(self):
+        def leading(re):
+            return Patterns.leading_pattern(Optimize.optimize(re), 0)
+        self.assertEqual(("\\x45\\x52\\x52\\x4f\\x52\\x20", 6, 0),
+                         leading(self.spec[0][0]))
+        self.assertEqual(
+            ("[\\x68\\x48][\\x74\\x54][\\x74\\x54][\\x70\\x50]", 4, 0),
+            leading(self.spec[1][0]))
+        self.assertEqual(("^\\x23", 1, 1), leading(self.spec[2][0]))
+        self.assertEqual(None, leading(Opt(Str("a")) + Str("b")))
+
+    def test_same_tokens(self):
+        """The prefilter finds the same tokens as trying every position"""
+        lex = Lexicon(self.spec)
+        in_text = "".join(["%s ERROR  abc Https://x\n#{{12%%x" % ("." * i)
+                           for i in xrange(300)])
+        results = []
+        for use_prefilter in (0, 1):
+            s = Scanner(lex, cStringIO.StringIO(in_text))
+            s.search = 1
+            if not use_prefilter:
+                s.prefilter = 0
+            result = []
+            while 1:
+                value, text = s.read()
+                result.append((value, text, s.position()))
+                if value is None:
+                    break
+            results.append((result, s.skipped))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(300 * 6 + 2, len(results[0][0]))
+
+
+class Recovery(unittest.TestCase):
+    spec = [
+        (Rep1(Range("az")), 'word'),
+        (Rep1(Any(" \n")), IGNORE),
+        (Bol + Str("#"), 'hash'),
+        (Str("x") + Eol, 'x_at_eol'),
+        ]
+
+    def test_error_tokens(self):
+        lex = Lexicon(self.spec)
+        in_text = "ab 12 cd#\n#x$$ x\n99"
+        for engine in ('dfa', 're', 'classes'):
+            s = Scanner(lex, cStringIO.StringIO(in_text))
+            s.error_token = 'error'
+            s.engine = engine
+            self.assertEqual(
+                [('word', 'ab'), ('error', '12'), ('word', 'cd'),
+                 ('error', '#'), ('hash', '#'), ('word', 'x'),
+                 ('error', '$$'), ('x_at_eol', 'x'), ('error', '99')],
+                scan_all_from(s))
+            self.assertEqual(4, s.errors)
+
+    def test_no_errors(self):
+        """Recovery mode makes no difference to recognised input"""
+        lex = Lexicon(self.spec)
+        in_text = "ab cd\n#x\n" * 1000
+        s = Scanner(lex, cStringIO.StringIO(in_text))
+        s.error_token = 'error'
+        self.assertEqual(scan_all(lex, in_text), scan_all_from(s))
+        self.assertEqual(0, s.errors)
+
+
+class Checkpoints(unittest.TestCase):
+    class NestingScanner(Scanner):
+        checkpoint_attributes = ('depth',)
+        depth = 0
+
+        def open_action(self, text):
+            self.depth = self.depth + 1
+            self.begin('nested')
+            self.produce('open', text)
+            self.produce('depth', str(self.depth))
+
+        def close_action(self, text):
+            self.depth = self.depth - 1
+            if not self.depth:
+                self.begin('')
+            return 'close'
+
+        lexicon = Lexicon([
+            (Rep1(Range("az")), 'word'),
+            (Rep1(Any(" \n")), IGNORE),
+            (Bol + Str("#"), 'hash'),
+            (Str("("), open_action),
+            State('nested', [
+                (Str("("), open_action),
+                (Str(")"), close_action),
+                (Rep1(AnyBut("()")), 'inner'),
+            ]),
+        ])
+
+    def test_resume(self):
+        """Resuming from any checkpoint gives the rest of the tokens"""
+        import pickle
+        in_text = "ab (c (d\n#) e)\n#f g\n" * 300
+        lex = self.NestingScanner.lexicon
+        for engine in ('dfa', 're', 'classes'):
+            s = self.NestingScanner(lex, cStringIO.StringIO(in_text))
+            s.engine = engine
+            checkpoints = []
+            tokens = []
+            while 1:
+                checkpoints.append(pickle.dumps(s.checkpoint()))
+                token = s.read()
+                tokens.append((token, s.position()))
+                if token[0] is None:
+                    break
+            for i in xrange(0, len(checkpoints), 199):
+                s = self.NestingScanner.resume(
+                    lex, cStringIO.StringIO(in_text),
+                    pickle.loads(checkpoints[i]))
+                s.engine = engine
+                rest = []
+                while 1:
+                    token = s.read()
+                    rest.append((token, s.position()))
+                    if token[0] is None:
+                        break
+                self.assertEqual(tokens[i:], rest)
+
+    def test_resume_lookahead(self):
+        """Checkpoints taken after the scanner has looked at the next
+        character, a newline or the last one, resume where they were"""
+        for spec, in_text in (([(AnyBut("B"), 'c')], "x\ny"),
+                              ([(Str("  x") | AnyBut("x"), 'c')], "  ")):
+            lex = Lexicon(spec)
+            for engine in ('dfa', 're', 'classes'):
+                s = Scanner(lex, cStringIO.StringIO(in_text))
+                s.engine = engine
+                checkpoints = []
+                tokens = []
+                while 1:
+                    checkpoints.append(s.checkpoint())
+                    token = s.read()
+                    tokens.append((token, s.position()))
+                    if token[0] is None:
+                        break
+                for i in xrange(len(checkpoints)):
+                    s = Scanner.resume(lex, cStringIO.StringIO(in_text),
+                                       checkpoints[i])
+                    s.engine = engine
+                    rest = []
+                    while 1:
+                        token = s.read()
+                        rest.append((token, s.position()))
+                        if token[0] is None:
+                            break
+                    self.assertEqual(tokens[i:], rest)
+
+    def test_resume_text(self):
+        lex = self.NestingScanner.lexicon
+        s = self.NestingScanner(lex, "a (b) c")
+        s.read()
+        s.read()
+        checkpoint = s.checkpoint()
+        self.assertEqual(1, checkpoint['attributes']['depth'])
+        s = self.NestingScanner.resume(lex, "a (b) c", checkpoint)
+        self.assertEqual([('depth', '1'), ('inner', 'b'), ('close', ')'),
+                          ('word', 'c')], scan_all_from(s))
+
+
+class FollowMode(unittest.TestCase):
+    spec = [
+        (Rep1(Range("az")), 'word'),
+        (Rep1(Any(" \n")), IGNORE),
+        (Str("x") + Eol, 'x_at_eol'),
+        ]
+
+    class GrowingStream:
+        """A stream whose data arrives in |chunks|, one per wait."""
+
+        def __init__(self, chunks):
+            self.chunks = chunks
+            self.data = ''
+
+        def read(self, size):
+            data = self.data
+            self.data = ''
+            return data
+
+    class FollowingScanner(Scanner):
+        follow = 1
+        waits = 0
+
+        def wait_for_input(self):
+            self.waits = self.waits + 1
+            if self.stream.chunks:
+                self.stream.data = self.stream.chunks.pop(0)
+            else:
+                self.close()
+
+    def test_follow(self):
+        lex = Lexicon(self.spec)
+        for engine in ('dfa', 're', 'classes'):
+            stream = self.GrowingStream(["ab c", "", "d\nx", "\nef x"])
+            s = self.FollowingScanner(lex, stream)
+            s.engine = engine
+            # A token that might go on waits for more data
+            self.assertEqual(('word', 'ab'), s.read())
+            self.assertEqual(1, s.waits)
+            self.assertEqual(('word', 'cd'), s.read())
+            self.assertEqual(3, s.waits)
+            self.assertEqual(('x_at_eol', 'x'), s.read())
+            self.assertEqual(('word', 'ef'), s.read())
+            self.assertEqual(4, s.waits)
+            # Eol only comes with close()
+            self.assertEqual(('x_at_eol', 'x'), s.read())
+            self.assertEqual(5, s.waits)
+            self.assertEqual((None, ''), s.read())
+
+
+class Feeding(unittest.TestCase):
+    spec = [
+        (Rep1(Range("az")), 'word'),
+        (Rep1(Any(" \n")), IGNORE),
+        (Bol + Str("#"), 'hash'),
+        (Str("x") + Eol, 'x_at_eol'),
+        (Str("(*") + Rep(AnyBut("*") | Str("*") + AnyBut(")")) + Str("*)"),
+         'comment'),
+        ]
+
+    def test_feed(self):
+        lex = Lexicon(self.spec)
+        s = Scanner(lex, None)
+        self.assertEqual([], s.feed("a"))
+        self.assertEqual([('word', 'ab')], s.feed("b c"))
+        self.assertEqual([('word', 'cd')], s.feed("d (* x\n#"))
+        self.assertEqual([], s.feed(" *"))
+        self.assertEqual([('comment', '(* x\n# *)'), ('hash', '#')],
+                         s.feed(")\n#x"))
+        self.assertEqual([('x_at_eol', 'x'), (None, '')], s.close())
+
+    def test_any_split(self):
+        """Feeding the input in pieces gives the same tokens"""
+        lex = Lexicon(self.spec)
+        in_text = "ab (* c\n* *)\n#x y\nx z\n" * 20
+        expected = scan_all(lex, in_text) + [(None, '')]
+        for engine in ('dfa', 're', 'classes'):
+            for size in (1, 2, 3, 7, 50):
+                s = Scanner(lex, None)
+                s.engine = engine
+                tokens = []
+                for i in xrange(0, len(in_text), size):
+                    tokens.extend(s.feed(in_text[i:i + size]))
+                tokens.extend(s.close())
+                self.assertEqual(expected, tokens)
+
+    def test_search_mode(self):
+        lex = Lexicon(self.spec)
+        s = Scanner(lex, None)
+        s.search = 1
+        tokens = []
+        for c in "12 ab3 (* ! *)%%x\n":
+            tokens.extend(s.feed(c))
+        tokens.extend(s.close())
+        self.assertEqual([('word', 'ab'), ('comment', '(* ! *)'),
+                          ('x_at_eol', 'x'), (None, '')], tokens)
+
+    def test_recovery_mode(self):
+        lex = Lexicon(self.spec)
+        in_text = "ab 12345 cd\n%%x\n"
+        expected = [('word', 'ab'), ('error', '12345'), ('word', 'cd'),
+                    ('error', '%%'), ('x_at_eol', 'x'), (None, '')]
+        for engine in ('dfa', 're', 'classes'):
+            for size in (1, 2, 3):
+                s = Scanner(lex, None)
+                s.engine = engine
+                s.error_token = 'error'
+                tokens = []
+                for i in xrange(0, len(in_text), size):
+                    tokens.extend(s.feed(in_text[i:i + size]))
+                tokens.extend(s.close())
+                self.assertEqual(expected, tokens)
+                self.assertEqual(2, s.errors)
+
+    def test_unrecognised(self):
+        """Tokens before bad input are returned before the error"""
+        lex = Lexicon([(Str("bBB", " a", " "), 't')])
+        for engine in ('dfa', 're', 'classes'):
+            s = Scanner(lex, None)
+            s.engine = engine
+            self.assertEqual([('t', ' a')], s.feed(" aB bx"))
+            self.assertRaises(Errors.UnrecognizedInput, s.feed, " a")
+            self.assertRaises(Errors.UnrecognizedInput, s.close)
+
+    def test_close_only(self):
+        s = Scanner(Lexicon(self.spec), None)
+        self.assertEqual([(None, '')], s.close())
+
+
+class AsyncScanning(unittest.TestCase):
+    class Collector(AsyncScanners.AsyncScanner):
+        def handle_tokens(self, tokens):
+            self.tokens.extend(tokens)
+
+    def test_sockets(self):
+        import asyncore, socket
+        lex = Lexicon(Feeding.spec)
+        in_text = "ab (* c\n* *)\n#x y\nx z\n" * 200
+        socket_map = {}
+        connections = []
+        for i in xrange(5):
+            sender, receiver = socket.socketpair()
+            collector = self.Collector(lex, receiver, socket_map)
+            collector.tokens = []
+            connections.append((sender, collector))
+        # Small pieces, so that tokens are split between reads
+        for j in xrange(0, len(in_text), 97):
+            for sender, collector in connections:
+                sender.sendall(in_text[j:j + 97])
+            asyncore.loop(0, map = socket_map, count = 1)
+        for sender, collector in connections:
+            sender.close()
+        asyncore.loop(0.1, map = socket_map)
+        expected = scan_all(lex, in_text) + [(None, '')]
+        for sender, collector in connections:
+            self.assertEqual(expected, collector.tokens)
+
+
+class InputStreams(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.in_text = "".join(["x%d := y + %d;\n" % (i, i)
+                                for i in xrange(5000)])
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def write_files(self):
+        import bz2, gzip, os
+        names = []
+        for name, open_file in (("in.gz", gzip.open), ("in.bz2", bz2.BZ2File),
+                                ("in.txt", open)):
+            name = os.path.join(self.directory, name)
+            f = open_file(name, "wb")
+            f.write(self.in_text)
+            f.close()
+            names.append(name)
+        return names
+
+    def test_open_input(self):
+        lex = Lexicon([
+            (Rep1(Range("az09")), 'name'),
+            (Any(":=+;"), TEXT),
+            (Rep1(Any(" \n")), IGNORE),
+            ])
+        expected = scan_all(lex, self.in_text)
+        for name in self.write_files():
+            for read_ahead in (0, 1):
+                stream = Streams.open_input(name, read_ahead, 1000)
+                s = Scanner(lex, stream)
+                s.read_size = 1000
+                self.assertEqual(expected, scan_all_from(s))
+                stream.close()
+
+    def test_read_ahead(self):
+        stream = Streams.ReadAheadStream(
+            cStringIO.StringIO(self.in_text), 1000)
+        self.assertEqual(self.in_text[:10], stream.read(10))
+        self.assertEqual(self.in_text[10:1000], stream.read(5000))
+        self.assertEqual(self.in_text[1000:], stream.read())
+        self.assertEqual('', stream.read(10))
+
+    def test_errors(self):
+        class BrokenStream:
+            def read(self, size):
+                raise IOError("broken")
+        stream = Streams.ReadAheadStream(BrokenStream())
+        self.assertRaises(IOError, stream.read, 10)
+
+
+class TokenCaches(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.in_text = "".join(["x%d := y + %d;\n" % (i, i)
+                                for i in xrange(500)])
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def make_lexicon(self, function, **options):
+        return Lexicon([
+            (Rep1(Range("az09")), 'name'),
+            (Str(":="), function),
+            (Any("+;"), TEXT),
+            (Rep1(Any(" \n")), IGNORE),
+            ], **options)
+
+    def scan_cached(self, cache, lex, in_text):
+        s = cache.scan(lex, cStringIO.StringIO(in_text), "in")
+        result = []
+        while 1:
+            token = s.read()
+            result.append((token, s.position()))
+            if token[0] is None:
+                return result
+
+    def test_replay(self):
+        def assign(scanner, text):
+            scanner.produce('assign', '=')
+            scanner.produce(('op', 1))
+        lex = self.make_lexicon(pure(assign))
+        s = Scanner(lex, self.in_text, "in")
+        expected = []
+        while 1:
+            token = s.read()
+            expected.append((token, s.position()))
+            if token[0] is None:
+                break
+        cache = Caches.TokenCache(self.directory)
+        self.assertEqual(expected, self.scan_cached(cache, lex, self.in_text))
+        self.assertEqual(expected, self.scan_cached(cache, lex, self.in_text))
+        self.assertEqual((1, 1, 0), (cache.hits, cache.misses, cache.bypassed))
+        # A changed input or Lexicon is scanned again
+        self.scan_cached(cache, lex, self.in_text + "z")
+        self.scan_cached(cache, self.make_lexicon('assign'), self.in_text)
+        self.assertEqual((1, 3, 0), (cache.hits, cache.misses, cache.bypassed))
+
+    def test_bypass(self):
+        calls = []
+        def assign(scanner, text):
+            calls.append(text)
+            return 'assign'
+        lex = self.make_lexicon(assign)
+        self.assertEqual([2], lex.uncacheable_tokens())
+        cache = Caches.TokenCache(self.directory)
+        expected = self.scan_cached(cache, lex, self.in_text)
+        self.assertEqual(expected, self.scan_cached(cache, lex, self.in_text))
+        self.assertEqual(1000, len(calls))
+        self.assertEqual((0, 0, 2), (cache.hits, cache.misses, cache.bypassed))
+
+    def test_fingerprint(self):
+        lex1 = self.make_lexicon('assign')
+        lex2 = self.make_lexicon('assign', incremental=1)
+        self.assertEqual(lex1.fingerprint(), lex2.fingerprint())
+        lex2.add_tokens([(Str("-"), TEXT)])
+        self.assertNotEqual(lex1.fingerprint(), lex2.fingerprint())
+
+    def test_function_fingerprint(self):
+        """Functions with the same name but different effects differ"""
+        lex_one = self.make_lexicon(pure(lambda scanner, text: 'one'))
+        lex_two = self.make_lexicon(pure(lambda scanner, text: 'two'))
+        self.assertNotEqual(lex_one.fingerprint(), lex_two.fingerprint())
+        self.assertEqual(lex_one.fingerprint(), self.make_lexicon(
+            pure(lambda scanner, text: 'one')).fingerprint())
+        def returning(value):
+            def assign(scanner, text):
+                return value
+            return pure(assign)
+        self.assertNotEqual(
+            self.make_lexicon(returning('one')).fingerprint(),
+            self.make_lexicon(returning('two')).fingerprint())
+        cache = Caches.TokenCache(self.directory)
+        for lex, value in ((lex_one, 'one'), (lex_two, 'two')):
+            tokens = [token for token, position in
+                      self.scan_cached(cache, lex, self.in_text)]
+            self.assertEqual((value, ':='), tokens[1])
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+
+
+class LineCaches(unittest.TestCase):
+    def make_lexicon(self, function):
+        return Lexicon([
+            (Rep1(Range("az")), 'word'),
+            (Rep1(Range("09")), function),
+            (Str('"'), Begin('string')),
+            (Rep1(Str(" ")), IGNORE),
+            (Str("x") + Eol, 'x_at_eol'),
+            (Bol + Str("#"), 'comment'),
+            (Str("\n"), 'newline'),
+            State('string', [
+                (Rep1(AnyBut('"\n')), 'chars'),
+                (Str('"'), Begin('')),
+                (Str("\n"), IGNORE),
+                ]),
+            ])
+
+    def scan(self, lex, in_text, line_cache):
+        s = Scanner(lex, cStringIO.StringIO(in_text))
+        s.read_size = 10
+        s.line_cache = line_cache
+        result = []
+        while 1:
+            token = s.read()
+            result.append((token, s.position()))
+            if token[0] is None:
+                return result
+
+    def test_replay(self):
+        def number(scanner, text):
+            scanner.produce('number', text)
+            scanner.produce('half', str(int(text) // 2))
+        lex = self.make_lexicon(pure(number))
+        self.assertTrue(lex.line_cacheable())
+        lines = ['ab 12 x', '#ab cd', '"ab', 'cd" x', '', 'ab 7']
+        in_text = "\n".join(lines * 100) + "\nab"
+        expected = self.scan(lex, in_text, None)
+        line_cache = Caches.LineCache(3)
+        self.assertEqual(expected, self.scan(lex, in_text, line_cache))
+        self.assertEqual((0, 600, 0), (line_cache.hits, line_cache.misses,
+                                       line_cache.bypassed))
+        line_cache = Caches.LineCache(10)
+        self.assertEqual(expected, self.scan(lex, in_text, line_cache))
+        self.assertEqual((594, 6), (line_cache.hits, line_cache.misses))
+        self.assertEqual(0.99, line_cache.hit_rate())
+
+    def test_unrecognised(self):
+        """Tokens before bad input on a line come before the error"""
+        lex = self.make_lexicon('number')
+        in_text = "ab 12\ncd 3!\nef\n"
+        for line_cache in (None, Caches.LineCache()):
+            s = Scanner(lex, cStringIO.StringIO(in_text))
+            s.line_cache = line_cache
+            result = []
+            try:
+                while 1:
+                    result.append((s.read(), s.position()))
+            except Errors.UnrecognizedInput, e:
+                result.append(e.position)
+            self.assertEqual([
+                (('word', 'ab'), ('', 1, 0)),
+                (('number', '12'), ('', 1, 3)),
+                (('newline', '\n'), ('', 1, 5)),
+                (('word', 'cd'), ('', 2, 0)),
+                (('number', '3'), ('', 2, 3)),
+                ('', 2, 4),
+                ], result)
+            self.assertRaises(Errors.UnrecognizedInput, s.read)
+            if line_cache is not None:
+                self.assertEqual(1, len(line_cache.entries))
+
+    def test_bypass(self):
+        lex = self.make_lexicon('number')
+        self.assertTrue(lex.line_cacheable())
+        lex = self.make_lexicon(lambda scanner, text: 'number')
+        self.assertFalse(lex.line_cacheable())
+        in_text = "ab 12\n" * 10
+        line_cache = Caches.LineCache()
+        self.assertEqual(self.scan(lex, in_text, None),
+                         self.scan(lex, in_text, line_cache))
+        self.assertEqual((0, 0, 11), (line_cache.hits, line_cache.misses,
+                                      line_cache.bypassed))
+        lex = Lexicon([(Rep1(Any(" \n")), IGNORE)])
+        self.assertFalse(lex.line_cacheable())
+
+
+class Projection(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        def number(scanner, text):
+            self.calls.append(text)
+            return int(text)
+        self.lex = Lexicon([
+            (Rep1(Range("az")), 'name'),
+            (Rep1(Range("09")), number),
+            (Any("+-"), TEXT),
+            (Str("="), TEXT),
+            (Str('"'), Begin('string')),
+            (Rep1(Str(" ")), IGNORE),
+            State('string', [
+                (Rep1(AnyBut('"')), 'chars'),
+                (Str('"'), Begin('')),
+                ]),
+            ])
+        self.in_text = 'a = b + 12 - "c 3" + d - 4'
+
+    def scan(self, only, engine='dfa'):
+        s = Scanner(self.lex, cStringIO.StringIO(self.in_text), only=only)
+        s.engine = engine
+        return scan_all_from(s)
+
+    def test_values(self):
+        for engine in ('dfa', 're', 'classes'):
+            self.assertEqual([('name', 'a'), ('name', 'b'), ('name', 'd')],
+                             self.scan(['name'], engine))
+            self.assertEqual(['c 3'], [text for value, text in
+                                       self.scan(('chars',), engine)])
+        self.assertEqual([], self.calls)
+
+    def test_token_numbers(self):
+        self.assertEqual([(12, '12'), (4, '4')], self.scan([2]))
+        self.assertEqual(['12', '4'], self.calls)
+        self.assertEqual([('+', '+'), ('-', '-'), ('+', '+'), ('-', '-')],
+                         self.scan([3]))
+        self.assertTrue(self.lex.project([3]) is self.lex.project(set([3])))
+
+    def test_side_effects(self):
+        """Calls changing the state are made for tokens left out"""
+        def open_string(scanner, text):
+            scanner.begin('string')
+            return 'open'
+        lex = Lexicon([
+            (Rep1(Range("az")), 'name'),
+            (Str('"'), side_effect(open_string)),
+            (Rep1(Str(" ")), IGNORE),
+            State('string', [
+                (Rep1(AnyBut('"')), 'chars'),
+                (Str('"'), Begin('')),
+                ]),
+            ])
+        in_text = 'a "b c" d'
+        self.assertEqual([('name', 'a'), ('name', 'd')],
+                         scan_all_from(Scanner(lex, in_text, only=['name'])))
+        self.assertEqual([('chars', 'b c')],
+                         scan_all_from(Scanner(lex, in_text, only=['chars'])))
+
+
+class CountTokens(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        def number(scanner, text):
+            self.calls.append(text)
+            return 'number'
+        def newline(scanner, text):
+            self.calls.append(scanner.position())
+        self.lex = Lexicon([
+            (Rep1(Range("az")), 'name'),
+            (Rep1(Range("09")), number),
+            (Str("{"), Begin('comment')),
+            (Rep1(Str(" ")), IGNORE),
+            (Str("\n"), side_effect(newline)),
+            State('comment', [
+                (AnyBut("}"), IGNORE),
+                (Str("}"), Begin('')),
+                ]),
+            ])
+
+    def test_counts(self):
+        in_text = "ab 12 {x 3\n} cd\n4 ef"
+        for engine in ('dfa', 're', 'classes'):
+            self.calls = []
+            counts, lines = self.lex.count_tokens(
+                cStringIO.StringIO(in_text), engine=engine)
+            self.assertEqual([0, 3, 2, 1, 4, 1, 4, 1], list(counts))
+            self.assertEqual(3, lines)
+            self.assertEqual([('', 2, 4)], self.calls)
+
+    def test_unicode(self):
+        """A unicode string is counted whatever the engine asked for"""
+        for engine in ('dfa', 're', 'classes'):
+            counts, lines = self.lex.count_tokens(u"ab 12\n", engine=engine)
+            self.assertEqual([0, 1, 1, 0, 1, 1, 0, 0], list(counts))
+            self.assertEqual(2, lines)
+        self.assertRaises(Errors.PlexTypeError, self.lex.count_tokens,
+                          io.StringIO(u"ab 12\n"), engine='classes')
+
+    def test_unrecognised(self):
+        self.assertRaises(Errors.UnrecognizedInput,
+                          self.lex.count_tokens, "ab !")
+
+
+class ColumnOutput(unittest.TestCase):
+    def setUp(self):
+        self.lex = Lexicon([
+            (Rep1(Range("az")), 'name'),
+            (Rep1(Range("09")), 'number'),
+            (Any("+-"), TEXT),
+            (Str("{"), Begin('comment')),
+            (Rep1(Any(" \n")), IGNORE),
+            State('comment', [
+                (AnyBut("}"), IGNORE),
+                (Str("}"), Begin('')),
+                ]),
+            ])
+        self.in_text = "ab + 12 {x\n3}\n cd - 4\n"
+
+    def test_columns(self):
+        for engine in ('dfa', 're', 'classes'):
+            columns = self.lex.scan_columns(
+                cStringIO.StringIO(self.in_text), engine=engine)
+            self.assertEqual(6, len(columns))
+            self.assertEqual([1, 3, 2, 1, 3, 2], list(columns.rule))
+            self.assertEqual([0, 3, 5, 15, 18, 20], list(columns.start))
+            self.assertEqual([2, 4, 7, 17, 19, 21], list(columns.end))
+            self.assertEqual([1, 1, 1, 3, 3, 3], list(columns.line))
+            self.assertEqual([0, 3, 5, 1, 4, 6], list(columns.col))
+            self.assertEqual(scan_all(self.lex, self.in_text),
+                             columns.tokens(self.in_text))
+
+    def test_unicode(self):
+        """Unicode strings are scanned whatever the engine asked for"""
+        in_text = unicode(self.in_text)
+        for engine in ('dfa', 're', 'classes'):
+            columns = self.lex.scan_columns(in_text, engine=engine)
+            self.assertEqual([0, 3, 5, 15, 18, 20], list(columns.start))
+            self.assertEqual(scan_all(self.lex, in_text),
+                             columns.tokens(in_text))
+
+    def test_value_table(self):
+        value_table = self.lex.value_table()
+        self.assertEqual(8, len(value_table))
+        self.assertEqual([None, 'name', 'number', TEXT, IGNORE],
+                         value_table[:4] + value_table[5:6])
+
+    @unittest.skipIf(numpy is None, "needs NumPy")
+    def test_numpy(self):
+        columns = self.lex.scan_columns(self.in_text)
+        arrays = columns.arrays()
+        self.assertEqual(numpy.int64, arrays['start'].dtype)
+        self.assertEqual([0, 3, 5, 15, 18, 20], list(arrays['start']))
+        records = columns.structured_array()
+        self.assertEqual([1, 3, 2, 1, 3, 2], list(records['rule']))
+        self.assertEqual([0, 3, 5, 1, 4, 6], list(records['col']))
+
+
+class LazyText(unittest.TestCase):
+    def setUp(self):
+        self.lex = Lexicon([
+            (Rep1(Range("az")), 'name'),
+            (Rep1(Range("09")), lambda scanner, text: int(str(text))),
+            (Any("+-"), TEXT),
+            (Rep1(Any(" \n")), IGNORE),
+            ])
+        self.in_text = "".join(["abc + %d - xyz\n" % i for i in xrange(200)])
+
+    def test_tokens(self):
+        expected = scan_all(self.lex, self.in_text)
+        s = Scanner(self.lex, cStringIO.StringIO(self.in_text))
+        s.read_size = 10
+        s.lazy_text = 1
+        tokens = scan_all_from(s)
+        # The texts stay valid however often the buffer was refilled
+        self.assertEqual(expected, tokens)
+        value, text = tokens[-1]
+        self.assertTrue(isinstance(text, Tokens.TokenText))
+        self.assertEqual(len(self.in_text) - 4, text.offset)
+        self.assertEqual(3, len(text))
+        self.assertEqual('xyz', str(text))
+        self.assertEqual('xyz', text.view().tobytes())
+        self.assertEqual(['+', '-'], [str(value) for value, text in tokens[1:4:2]])
+
+    def test_ignore(self):
+        s = Scanner(self.lex, "  abc")
+        s.lazy_text = 1
+        self.assertEqual('', s.scan_a_token()[0])
+        self.assertEqual('abc', s.scan_a_token()[0])
+
+
+class TokenRecords(unittest.TestCase):
+    def setUp(self):
+        self.lex = Lexicon([
+            (Rep1(Range("az")), 'name'),
+            (Str('"'), Begin('string')),
+            (Rep1(Str(" ")), IGNORE),
+            (Str("\n"), 'newline'),
+            State('string', [
+                (Rep1(AnyBut('"\n')), 'chars'),
+                (Str('"'), Begin('')),
+                ]),
+            ])
+        self.in_text = 'ab "cd ef" g\n"x"\nh'
+
+    def scan(self, engine='dfa', line_cache=None):
+        s = Scanner(self.lex, cStringIO.StringIO(self.in_text))
+        s.engine = engine
+        s.line_cache = line_cache
+        s.token_class = Token
+        result = []
+        while 1:
+            token = s.read()
+            self.assertTrue(isinstance(token, Token))
+            result.append((token.value, token.text, token.start, token.end,
+                           token.line, token.col, token.end_line,
+                           token.end_col, token.state_name))
+            if token[0] is None:
+                return result
+
+    def test_spans(self):
+        expected = [
+            ('name', 'ab', 0, 2, 1, 0, 1, 2, ''),
+            ('chars', 'cd ef', 4, 9, 1, 4, 1, 9, 'string'),
+            ('name', 'g', 11, 12, 1, 11, 1, 12, ''),
+            ('newline', '\n', 12, 13, 1, 12, 2, 0, ''),
+            ('chars', 'x', 14, 15, 2, 1, 2, 2, 'string'),
+            ('newline', '\n', 16, 17, 2, 3, 3, 0, ''),
+            ('name', 'h', 17, 18, 3, 0, 3, 1, ''),
+            (None, '', 18, 18, 3, 1, 3, 1, ''),
+            ]
+        for engine in ('dfa', 're', 'classes'):
+            self.assertEqual(expected, self.scan(engine))
+        self.assertEqual(expected, self.scan(line_cache=Caches.LineCache()))
+
+    def test_unpacking(self):
+        token = Token('name', 'ab', 0, 2, 1, 0, 1, 2, '')
+        value, text = token
+        self.assertEqual(('name', 'ab'), (value, text))
+        self.assertEqual('ab', token[1])
+        self.assertRaises(AttributeError, setattr, token, 'extra', 1)
+
+    def test_checkpoint(self):
+        """Queued records and lazy texts survive a pickled checkpoint"""
+        import pickle
+        def split(scanner, text):
+            scanner.produce('head', text)
+            scanner.produce('tail', text)
+        lex = Lexicon([
+            (Rep1(Range("az")), split),
+            (Rep1(Any(" \n")), IGNORE),
+            ])
+        in_text = "ab cd\nef"
+        for lazy_text in (0, 1):
+            s = Scanner(lex, cStringIO.StringIO(in_text))
+            s.token_class = Token
+            s.lazy_text = lazy_text
+            s.read()
+            self.assertEqual(1, len(s.queue))
+            for protocol in (0, 2):
+                checkpoint = pickle.loads(
+                    pickle.dumps(s.checkpoint(), protocol))
+                r = Scanner.resume(lex, cStringIO.StringIO(in_text),
+                                   checkpoint)
+                r.token_class = Token
+                tokens = []
+                while 1:
+                    token = r.read()
+                    tokens.append((token.value, str(token.text),
+                                   token.start, token.end, token.line,
+                                   token.col))
+                    if token.value is None:
+                        break
+                self.assertEqual([
+                    ('tail', 'ab', 0, 2, 1, 0),
+                    ('head', 'cd', 3, 5, 1, 3),
+                    ('tail', 'cd', 3, 5, 1, 3),
+                    ('head', 'ef', 6, 8, 2, 0),
+                    ('tail', 'ef', 6, 8, 2, 0),
+                    (None, '', 8, 8, 2, 2),
+                    ], tokens)
+
+
+class Optimizer(unittest.TestCase):
+    def test_merge_ranges(self):
+        """Overlapping and adjacent ranges become one"""
+        re = Optimize.optimize(Any("abc") | Range("cz"))
+        self.assertEqual((97, 123), re.range)
+
+    def test_factor_prefix(self):
+        """Alternatives with a common prefix share its NFA states"""
+        re = Optimize.optimize(Str("for", "from", "fun"))
+        self.assertTrue(isinstance(re, Seq))
+        self.assertEqual((102, 103), re.re_list[0].range)
+
+    def test_smaller_nfa(self):
+        spec = [(NoCase(Str("then", "than", "this")), TEXT),
+                (Rep1(Range("az")), 'ident')]
+        plain = Lexicon(spec, report=1, optimize=False)
+        optimized = Lexicon(spec, report=1)
+        self.assertTrue(
+            optimized.report.nfa_states < plain.report.nfa_states)
+        for in_text in ("then", "thanx", "th", "THIS"):
+            results = []
+            for lex in (plain, optimized):
+                s = Scanner(lex, cStringIO.StringIO(in_text))
+                results.append(s.read())
+            self.assertEqual(results[0], results[1])
+
+
+class Interning(unittest.TestCase):
+    def test_shared(self):
+        """Structurally identical REs are the same object"""
+        self.assertTrue(Str("a") is Str("a"))
+        self.assertTrue(Range("AZaz") | Any("_") is Range("AZaz") | Any("_"))
+
+    def test_labels(self):
+        """Labels never leak between shared REs"""
+        self.assertEqual("Str('ab')", str(Str("ab")))
+        self.assertEqual("Seq(Char('a'),Char('b'))",
+                         str(Seq(Regexps.Char('a'), Regexps.Char('b'))))
+        self.assertEqual("Empty", str(Empty))
+        self.assertEqual("Seq()", str(Seq()))
+
+    def test_first_set(self):
+        re = Opt(Str("x")) + NoCase(Any("ab")) | Eol
+        self.assertEqual((((65, 67), (97, 99), (120, 121)), ('eol',)),
+                         re.first_set())
+
+
 if __name__ == '__main__':
     unittest.main()
 